@@ -31,8 +31,9 @@ def run():
     # Create LHS sample
     s = p.parstudy(nvals=[3])
 
-    # Run model with parameter samples
-    s.run( ncpus=2, workdir_base='workdir', outfile='results.dat', logfile='log.dat',verbose=False,reuse_dirs=True)
+    # Run model with parameter samples, samples with results already in results.dat 
+    # (e.g. from an interrupted run) are skipped
+    s.run( cpus=2, workdir_base='workdir', outfile='results.dat', logfile='log.dat',verbose=False,reuse_dirs=True,resume=True)
 
     # Look at response histograms, correlations, and panels
     print 'Parameter Response'
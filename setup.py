@@ -17,5 +17,5 @@ setup(name='MATK',
 		'matk.lmfit',
 		'matk.lmfit.uncertainties',
 		'matk.pyDOE'],
-	py_modules=['matk','emcee','lhs','parameter','sampleset','minimizer','pest_io','ordereddict','observation','__init__'],
+	py_modules=['matk','emcee','lhs','parameter','sampleset','minimizer','pest_io','ordereddict','observation','workers','cache','staging','qmc','__init__'],
 	)
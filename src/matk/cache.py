@@ -0,0 +1,160 @@
+''' Least recently used cache of model responses keyed on parameter values '''
+import os
+import cPickle as pickle
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+class ModelCache(object):
+    """ MATK model cache class - Stores simulated values of recent model runs
+        keyed on parameter values, discarding the least recently used
+        entries when full
+    """
+    def __init__(self, maxsize=1000, digits=None, filename=None):
+        self.maxsize = maxsize
+        self.digits = digits
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Number of records in cache file
+        self._records = 0
+        if self.filename is not None and os.path.isfile(self.filename):
+            self.load()
+            # Rewrite file without discarded runs and incompletely appended runs, so that runs are appended after valid runs
+            self.save()
+    @property
+    def maxsize(self):
+        """ Maximum number of cached model runs, None for no limit
+        """
+        return self._maxsize
+    @maxsize.setter
+    def maxsize(self,value):
+        if value is not None and not value > 0:
+            print "Error: Cache size must be greater than zero"
+            return
+        self._maxsize = value
+        self._trim()
+    @property
+    def digits(self):
+        """ Number of significant digits parameter values are rounded to before
+            comparison, None for exact comparison
+        """
+        return self._digits
+    @digits.setter
+    def digits(self,value):
+        self._digits = value
+    @property
+    def filename(self):
+        """ Name of file that model runs are appended to as entries are added, None to keep cache in memory only
+        """
+        return self._filename
+    @filename.setter
+    def filename(self,value):
+        self._filename = value
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self, parvalues):
+        return self.key(parvalues) in self._entries
+    def key(self, parvalues):
+        """ Cache key of parameter values
+
+            :param parvalues: Parameter values in order of matk.pars.keys()
+            :type parvalues: lst(fl64)
+            :returns: tuple(fl64)
+        """
+        if self.digits is None:
+            return tuple([float(v) for v in parvalues])
+        return tuple([float('%.*e' % (self.digits-1, v)) for v in parvalues])
+    def get(self, parvalues):
+        """ Get simulated values of model run with parameter values, counting hits and misses
+
+            :param parvalues: Parameter values in order of matk.pars.keys()
+            :type parvalues: lst(fl64)
+            :returns: OrderedDict(fl64) -- simulated values keyed by observation names, None if not cached
+        """
+        k = self.key(parvalues)
+        sims = self._entries.pop(k, None)
+        if sims is None:
+            self.misses += 1
+            return None
+        self._entries[k] = sims
+        self.hits += 1
+        return OrderedDict(sims)
+    def put(self, parvalues, sims):
+        """ Add simulated values of model run with parameter values
+
+            :param parvalues: Parameter values in order of matk.pars.keys()
+            :type parvalues: lst(fl64)
+            :param sims: Simulated values keyed by observation names
+            :type sims: OrderedDict(fl64)
+        """
+        k = self.key(parvalues)
+        self._entries.pop(k, None)
+        self._entries[k] = OrderedDict(sims)
+        self._trim()
+        if self.filename is not None:
+            if self.maxsize is not None and self._records >= 2*self.maxsize:
+                # Rewrite file without discarded runs
+                self.save()
+            else:
+                f = open(self.filename, 'ab')
+                pickle.dump((k,self._entries[k]), f, pickle.HIGHEST_PROTOCOL)
+                f.close()
+                self._records += 1
+    def clear(self, remove_file=True):
+        """ Remove all cached model runs and reset hit and miss counters
+
+            :param remove_file: If True, the cache file is removed as well
+            :type remove_file: bool
+        """
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._records = 0
+        if remove_file and self.filename is not None and os.path.isfile(self.filename):
+            os.remove(self.filename)
+    def save(self, filename=None):
+        """ Write cached model runs to file
+
+            :param filename: Name of file, if None, ModelCache.filename is used
+            :type filename: str
+        """
+        if filename is None: filename = self.filename
+        # Write to temporary file of this process first so that an interrupted write does not corrupt the cache
+        tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmpfile, 'wb')
+        pickle.dump(self._entries.items(), f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmpfile, filename)
+        if filename == self.filename: self._records = len(self._entries)
+    def load(self, filename=None):
+        """ Add model runs from file written by save and runs appended to it by put
+
+            :param filename: Name of file, if None, ModelCache.filename is used
+            :type filename: str
+        """
+        if filename is None: filename = self.filename
+        f = open(filename, 'rb')
+        records = 0
+        while True:
+            try:
+                rec = pickle.load(f)
+            except Exception:
+                # End of file, or incomplete run left by a process stopped while appending it
+                break
+            # File written by save holds a list of runs, put appends single runs
+            if isinstance(rec, list): items = rec
+            else: items = [rec]
+            for k,sims in items:
+                self._entries.pop(k, None)
+                self._entries[k] = sims
+            records += len(items)
+        f.close()
+        if filename == self.filename: self._records += records
+        self._trim()
+    def _trim(self):
+        if getattr(self, '_entries', None) is None or self.maxsize is None: return
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -16,6 +16,9 @@
 import scipy.stats as stats
 import numpy
 from numpy.linalg import cholesky,inv
+from scipy.linalg import solve_triangular
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.csgraph import connected_components
 from numpy.random import uniform, shuffle
 
 def lhsFromSample(sample,siz=100):
@@ -60,7 +63,7 @@ def lhsFromDensity(kde,siz=100):
     return v
 
 
-def lhs(dist, parms, siz=100, noCorrRestr=False, corrmat=None, seed=None):
+def lhs(dist, parms, siz=100, noCorrRestr=False, corrmat=None, seed=None, dtype='float64', criterion=None, iterations=None, blocksize=1048576):
     '''
     Latin Hypercube sampling of any distribution.
     dist is is a scipy.stats random number generator 
@@ -74,6 +77,11 @@ def lhs(dist, parms, siz=100, noCorrRestr=False, corrmat=None, seed=None):
         - `siz` :number or shape tuple for the output sample
         - `noCorrRestr`: if true, does not enforce correlation structure on the sample.
         - `corrmat`: Correlation matrix
+        - `seed`: Random seed
+        - `dtype`: Data type of sample, e.g. 'float32' to halve the memory of the returned sample. Variables are transformed in float64 in blocks into the sample, the rank indices of all variables (and the design of criterion) are held in full.
+        - `criterion`: Space-filling criterion of pyDOE.lhs, e.g. 'maximin' or 'centermaximin', the design is optimized in the unit hypercube and transformed to the distributions. Not used with corrmat.
+        - `iterations`: Number of iterations of the criterion optimization
+        - `blocksize`: Approximate number of values transformed at a time
     '''
     if seed:
         numpy.random.seed( seed )
@@ -83,76 +91,232 @@ def lhs(dist, parms, siz=100, noCorrRestr=False, corrmat=None, seed=None):
     else:
         assert len(dist) == len(parms)
         dists = dist
-    indices=rank_restr(nvars=len(dists), smp=siz, noCorrRestr=noCorrRestr, Corrmat=corrmat)
-    smplist = []
-    for j,d in enumerate(dists):
+    for d in dists:
         if not isinstance(d, (stats.rv_discrete,stats.rv_continuous)):
             raise TypeError('dist is not a scipy.stats distribution object')
-        n=siz
-        if isinstance(siz,(tuple,list)):
-            n=numpy.product(siz)
-        #force type to float for sage compatibility
-        pars = tuple([float(k) for k in parms[j]])
-        #perc = numpy.arange(1.,n+1)/(n+1)
+    n=siz
+    if isinstance(siz,(tuple,list)):
+        n=numpy.product(siz)
+    nvars = len(dists)
+    if criterion is not None:
+        if corrmat is not None:
+            raise TypeError('corrmat cannot be used with criterion')
+        from pyDOE import lhs as doe_lhs
+        # Positions of samples are already paired
+        indices = None
+        design = doe_lhs(nvars, samples=n, criterion=criterion, iterations=iterations)
+        s_pos = lambda j0,j1: design[:,j0:j1]
+    else:
+        indices=rank_restr(nvars=nvars, smp=siz, noCorrRestr=noCorrRestr, Corrmat=corrmat)
+        indices -= 1
+        # Random positions within the n strata of each variable, drawn for a block of variables at a time
         step = 1./(n)
         perc = numpy.arange(0, 1, step) #class boundaries
-        s_pos = [uniform(i, i+ step) for i in perc[:]]#[i+ step/2. for i in perc[:]]
-        v = d(*pars).ppf(s_pos)
-        #print len(v), step, perc
-        index=map(int,indices[j]-1)
-        v = v[index]
+        s_pos = lambda j0,j1: uniform(perc, perc+step, size=(j1-j0,n)).T
+    # Blocks of variables are transformed into the sample, drawing positions in the order of variables
+    v = numpy.empty((n,nvars), dtype=dtype)
+    ncols = max(1, blocksize//n)
+    for j0 in xrange(0, nvars, ncols):
+        j1 = min(j0+ncols, nvars)
+        _dist_call('ppf', dists[j0:j1], parms[j0:j1], s_pos(j0,j1), indices=None if indices is None else indices[j0:j1], out=v[:,j0:j1])
+    if nvars == 1:
+        v = v[:,0]
         if isinstance(siz,(tuple,list)):
             v.shape = siz
-        smplist.append(v)
-    if len(dists) == 1:
-        return smplist[0]
-    return numpy.array(smplist).transpose()
+    return v
+
+def dist_ppf(dists, parms, u, indices=None, dtype='float64'):
+    '''
+    Transform points in the unit hypercube to distributions with their
+    percent point functions. ppf calls of variables with the same 
+    distribution are batched, passing parameters as columns.
+
+    :Parameters:
+        - `dists`: list of scipy.stats distributions, one for each column of u
+        - `parms`: list of tuples of parameters of dists
+        - `u`: array of points in the unit hypercube, a column for each variable
+        - `indices`: array with a row for each variable of the order of the rows of u, None to keep the order
+        - `dtype`: Data type of sample
+    :return: an array with a column for each variable
+    '''
+    return _dist_call('ppf', dists, parms, u, indices=indices, dtype=dtype)
+
+def dist_cdf(dists, parms, x):
+    '''
+    Transform samples of distributions to the unit hypercube with their
+    cumulative distribution functions, the inverse of dist_ppf.
+
+    :Parameters:
+        - `dists`: list of scipy.stats distributions, one for each column of x
+        - `parms`: list of tuples of parameters of dists
+        - `x`: array of samples, a column for each variable
+    :return: an array with a column for each variable
+    '''
+    return _dist_call('cdf', dists, parms, x)
 
-def rank_restr(nvars=4, smp=100, noCorrRestr=False, Corrmat=None):
+def _dist_call(method, dists, parms, a, indices=None, dtype='float64', out=None):
+    n,nvars = a.shape
+    groups = {}
+    for j,d in enumerate(dists):
+        groups.setdefault(id(d),[]).append(j)
+    v = numpy.empty((n,nvars), dtype=dtype) if out is None else out
+    for js in groups.values():
+        d = dists[js[0]]
+        #force type to float for sage compatibility
+        pars = numpy.array([[float(k) for k in parms[j]] for j in js]).reshape(len(js),-1)
+        vs = getattr(d,method)(a[:,js], *pars.T)
+        for i,j in enumerate(js):
+            v[:,j] = vs[:,i] if indices is None else vs[indices[j],i]
+    return v
+
+def lhs_augment(u, n, seed=None):
+    '''
+    Latin hypercube points to add to existing points in the unit hypercube.
+    The N existing points and n new points are treated as a sample with
+    N+n strata of each variable, and new points are placed in randomly 
+    chosen strata that no existing point is in. If n is a multiple of N 
+    and the existing points are a Latin hypercube, the combined points are 
+    a Latin hypercube.
+
+    :Parameters:
+        - `u`: array of existing points, a column for each variable
+        - `n`: number of points to add
+        - `seed`: Random seed
+    :return: an array of n new points
+    '''
+    if seed:
+        numpy.random.seed( seed )
+    N,nvars = u.shape
+    m = N+n
+    v = numpy.empty((n,nvars))
+    for j in xrange(nvars):
+        occupied = numpy.zeros(m, dtype=bool)
+        occupied[numpy.clip(numpy.floor(u[:,j]*m).astype(int), 0, m-1)] = True
+        # At most N strata are occupied, so there are at least n empty strata
+        strata = numpy.random.permutation(numpy.where(~occupied)[0])[:n]
+        v[:,j] = (strata + uniform(size=n))/m
+    return v
+
+def rank_restr(nvars=4, smp=100, noCorrRestr=False, Corrmat=None, chunksize=65536):
     """
-    Returns the indices for sampling variables with  
-    the desired correlation structure.
+    Returns the indices (an array with a row for each variable) 
+    for sampling variables with the desired correlation structure.
+    Correlations are induced with the Iman-Conover method. Variables are
+    split into the blocks of a block diagonal correlation matrix, and
+    variables without correlations to others, which are decorrelated
+    jointly. Each block is transformed with triangular solves on chunks
+    of samples, avoiding inverses of the full correlation matrix.
     
     :Parameters:
         - `nvars`: number of variables
         - `smp`: number of samples
         - `noCorrRestr`: No correlation restriction if True
-        - `Corrmat`: Correlation matrix. If None, assure uncorrelated samples.
+        - `Corrmat`: Correlation matrix, dense or scipy.sparse. If None, assure uncorrelated samples.
+        - `chunksize`: Number of samples transformed at a time
     """
     if isinstance(smp,(tuple,list)):
             smp=numpy.product(smp)
     def shuf(s):
         """
-        Shuffle a vector, making shure to make a copy of the original
+        Shuffle a vector in place once for each variable
         :param s: A vector of values
-        :return: a list of arrays
+        :return: an array with a row for each variable
         """
-        s1=[]
+        s1=numpy.empty((nvars,len(s)), dtype=s.dtype)
         for i in xrange(nvars):
             shuffle(s)
-            s1.append(s.copy())
+            s1[i] = s
         return s1
     if noCorrRestr or nvars ==1:
         inds = numpy.arange(smp)
         x = shuf(inds)
     else:
-        if Corrmat == None:
-            C=numpy.core.numeric.identity(nvars)
-        else:
-            if Corrmat.shape[0] != nvars:
-                raise TypeError('Correlation matrix must be of rank %s'%nvars)
-            C=numpy.matrix(Corrmat)
+        if Corrmat is not None and Corrmat.shape[0] != nvars:
+            raise TypeError('Correlation matrix must be of rank %s'%nvars)
         s0=numpy.arange(1.,smp+1)/(smp+1.)
         s=stats.norm().ppf(s0)
         s1 = shuf(s)
-        S=numpy.matrix(s1)
-        P=cholesky(C)
-        Q=cholesky(numpy.corrcoef(S))
-
-        Final=S.transpose()*inv(Q).transpose()*P.transpose()
-        x = [stats.stats.rankdata(Final.transpose()[i,]) for i in xrange(nvars)]
+        # All rows of s1 are permutations of s, so they share mean and variance
+        s1 -= s.mean()
+        var = numpy.dot(s1[0],s1[0])
+        x = numpy.empty((nvars,smp), dtype=int)
+        r = numpy.arange(1,smp+1)
+        for inds,C in corr_blocks(Corrmat, nvars):
+            S = s1 if len(inds) == nvars else s1[inds]
+            # Correlation matrix of scores, accumulated over chunks
+            G = numpy.zeros((len(inds),len(inds)))
+            for k in xrange(0,smp,chunksize):
+                G += numpy.dot(S[:,k:k+chunksize], S[:,k:k+chunksize].T)
+            Q=cholesky(G/var)
+            P=None if C is None else cholesky(C)
+            # Final = P Q^-1 S
+            for k in xrange(0,smp,chunksize):
+                F = solve_triangular(Q, S[:,k:k+chunksize], lower=True, overwrite_b=True, check_finite=False)
+                if P is not None: F = numpy.dot(P, F)
+                S[:,k:k+chunksize] = F
+            # Rank each variable
+            for i,j in enumerate(inds):
+                x[j,S[i].argsort()] = r
     return x
 
+def corr_blocks(Corrmat, nvars):
+    """
+    Split a correlation matrix into the blocks of correlated variables
+    of a block diagonal matrix. Variables without correlations to others
+    are returned as one block with a correlation matrix of None (identity).
+
+    :Parameters:
+        - `Corrmat`: Correlation matrix, dense or scipy.sparse, or None
+        - `nvars`: number of variables
+    :return: a list of tuples of variable indices and correlation matrix of block
+    """
+    if Corrmat is None:
+        return [(numpy.arange(nvars),None)]
+    A = csr_matrix(Corrmat)
+    A.eliminate_zeros()
+    ncomp,labels = connected_components(A, directed=False)
+    blocks = []
+    free = []
+    for c in xrange(ncomp):
+        inds = numpy.where(labels == c)[0]
+        if len(inds) == 1:
+            free.append(inds[0])
+        else:
+            blocks.append((inds,A[inds][:,inds].toarray()))
+    if len(free) > 1:
+        blocks.insert(0,(numpy.array(free),None))
+    elif len(free) == 1:
+        # A single variable without correlations is left unchanged
+        blocks.insert(0,(numpy.array(free),numpy.ones((1,1))))
+    return blocks
+
+def corr_report(x, Corrmat, type='spearman', printout=True):
+    """
+    Compare correlation coefficients of a sample to target correlation matrix
+
+    :Parameters:
+        - `x`: Sample, a column for each variable
+        - `Corrmat`: Target correlation matrix, dense or scipy.sparse. If None, identity.
+        - `type`: Type of correlation coefficient, spearman (rank) or pearson
+        - `printout`: If True, print maximum and root mean square difference
+    :return: a tuple of target and achieved correlation matrices and maximum and root mean square differences of off-diagonal coefficients
+    """
+    x = numpy.asarray(x)
+    if Corrmat is None: C = numpy.identity(x.shape[1])
+    elif issparse(Corrmat): C = Corrmat.toarray()
+    else: C = numpy.asarray(Corrmat)
+    if type == 'spearman':
+        x = numpy.array([stats.rankdata(c) for c in x.T]).T
+    elif not type == 'pearson':
+        raise TypeError('type must be spearman or pearson')
+    R = numpy.corrcoef(x, rowvar=0)
+    d = numpy.abs(R-C)[~numpy.eye(len(C),dtype=bool)]
+    maxdiff = d.max() if len(d) else 0.
+    rmsdiff = numpy.sqrt((d**2).mean()) if len(d) else 0.
+    if printout:
+        print "Correlation (%s) of sample vs. target: max difference %g, rms difference %g" % (type, maxdiff, rmsdiff)
+    return C, R, maxdiff, rmsdiff
+
 if __name__=='__main__':
     dist = stats.uniform,stats.uniform
     parms = (0,1.),(0,1.)
@@ -2,17 +2,21 @@ import sys, os
 import pdb
 from parameter import Parameter
 from observation import Observation
-from sampleset import SampleSet
+from sampleset import SampleSet, ResultsWriter, read_outfile, load_binary
 import numpy 
 from lhs import *
+import qmc
 import cPickle as pickle
 from shutil import rmtree
 import itertools
-from multiprocessing import Process, Manager, Pool, freeze_support
-from multiprocessing.queues import Queue, JoinableQueue
+from multiprocessing import freeze_support
 import traceback
+from time import time, sleep
 from copy import deepcopy
 import pest_io
+from workers import WorkerPool, call, Timeout
+from cache import ModelCache
+from staging import link_tree, reset_tree
 try:
     from collections import OrderedDict
 except ImportError:
@@ -24,7 +28,7 @@ class matk(object):
     """
     def __init__(self, model='', model_args=None, model_kwargs=None, cpus=1,
                  workdir_base=None, workdir=None, results_file=None,
-                 seed=None, sample_size=10, hosts={}):
+                 seed=None, sample_size=10, hosts={}, vectorized=False, template_dir=None):
         '''Initialize MATK object
         :param model: Python function whose first argument is a dictionary of parameters and returns model outputs
         :type model: str
@@ -46,8 +50,17 @@ class matk(object):
         :type sample_size: int
         :param hosts: Host names to run on (i.e. on a cluster), hostname provided as kwarg to model (hostname=<hostname>)
         :type hosts: lst(str)
+        :param vectorized: If True, model is called with a dictionary of arrays of parameter values (one element per sample) keyed by parameter names and returns a matrix of responses with a row for each sample
+        :type vectorized: bool
+        :param template_dir: Directory of model input files that working directories are staged from by hard linking its read-only files and copying other files
+        :type template_dir: str
         :returns: object -- MATK object
         '''
+        self._workers = None
+        self._cache = None
+        self._host_stats = None
+        self._exprs_compiled = None
+        self._exprs_evaluated = None
         self.model = model
         self.model_args = model_args
         self.model_kwargs = model_kwargs
@@ -58,12 +71,30 @@ class matk(object):
         self.seed = seed
         self.sample_size = sample_size
         self.hosts = hosts
+        self.vectorized = vectorized
+        self.template_dir = template_dir
       
         self.pars = OrderedDict()
         self.obs = OrderedDict()
         self.sampleset = OrderedDict()
         self.workdir_index = 0
         self._current = False # Flag indicating if simulated values are associated with current parameters
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_workers'] = None
+        # Model runs are cached by the process owning the MATK object only
+        odict['_cache'] = None
+        # Expressions are compiled again when needed
+        odict['_exprs_compiled'] = None
+        return odict
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+    def __enter__(self):
+        self.start()
+        return self
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
     @property
     def model(self):
         """ Python function that runs model
@@ -72,6 +103,8 @@ class matk(object):
     @model.setter
     def model(self,value):
         self._model = value       
+        self._invalidate_workers()
+        self._invalidate_cache()
     @property
     def model_args(self):
         """ Tuple of extra arguments to MATK model expected to come after parameter dictionary
@@ -86,6 +119,8 @@ class matk(object):
             return
         else:
             self._model_args = value
+        self._invalidate_workers()
+        self._invalidate_cache()
     @property
     def model_kwargs(self):
         """ Dictionary of extra keyword arguments to MATK model expected to come after parameter dictionary and model_args
@@ -100,6 +135,17 @@ class matk(object):
             return
         else:
             self._model_kwargs = value       
+        self._invalidate_workers()
+        self._invalidate_cache()
+    @property
+    def vectorized(self):
+        """ If True, the model evaluates many parameter sets in a single call
+        """
+        return self._vectorized
+    @vectorized.setter
+    def vectorized(self,value):
+        self._vectorized = value
+        self._invalidate_workers()
     @property
     def cpus(self):
         """ Set number of cpus to use for concurrent model evaluations
@@ -109,6 +155,33 @@ class matk(object):
     def cpus(self,value):
         self._cpus = value
     @property
+    def workers(self):
+        """ Persistent worker pool created by start, None if not started
+        """
+        return self._workers
+    @property
+    def host_stats(self):
+        """ Statistics of each host in the last parallel run (runs, failures, timeouts, time, throughput, blacklisted), see WorkerPool.host_stats
+        """
+        return self._host_stats
+    @property
+    def cache(self):
+        """ Cache of model runs used by forward (see enable_cache), None if caching is disabled
+        """
+        return self._cache
+    @property
+    def cache_hits(self):
+        """ Number of forward calls that used cached simulated values
+        """
+        if self._cache is None: return 0
+        return self._cache.hits
+    @property
+    def cache_misses(self):
+        """ Number of forward calls that ran the model with caching enabled
+        """
+        if self._cache is None: return 0
+        return self._cache.misses
+    @property
     def workdir_base(self):
         """ Set the base name for parallel working directories
         """
@@ -133,6 +206,23 @@ class matk(object):
     def workdir_index(self,value):
         self._workdir_index = value
     @property
+    def template_dir(self):
+        """ Directory of model input files that new working directories are staged from. Subdirectories 
+            are created and read-only files are hard linked, so that large input files are not copied for each run. 
+            Files with write permission, which a model could modify in place, and files that cannot be linked 
+            are copied; remove write permission from large input files to have them linked. 
+            In parallel runs with save=False, each worker reuses a pooled working directory, which is restored 
+            to the state of the template before each run, instead of creating and deleting a directory for each sample.
+        """
+        return self._template_dir
+    @template_dir.setter
+    def template_dir(self,value):
+        if value is not None and not os.path.isdir(value):
+            print "Error: Template directory " + str(value) + " does not exist"
+            return
+        self._template_dir = None if value is None else os.path.abspath(value)
+        self._invalidate_workers()
+    @property
     def results_file(self):
         """ Set the name of the results_file for parallel runs   
         """
@@ -178,6 +268,7 @@ class matk(object):
             self.pars[name] = Parameter(name,parent=self,value=value,vary=vary,min=min,max=max,expr=expr,discrete_vals=[],discrete_counts=[],**kwargs)
         else:
             self.pars.__setitem__( name, Parameter(name,parent=self,value=value,vary=vary,min=min,max=max,expr=expr,discrete_vals=[],discrete_counts=[],**kwargs))
+        self._invalidate_workers()
     def add_obs(self,name, sim=None, weight=1.0, value=None):
         ''' Add observation to problem
             
@@ -195,6 +286,7 @@ class matk(object):
             self.obs[name] = Observation(name,sim=sim,weight=weight,value=value)
         else:
             self.obs.__setitem__( name, Observation(name,sim=sim,weight=weight,value=value))
+        self._invalidate_workers()
     def create_sampleset(self,samples,name=None,responses=None,indices=None,index_start=1):
         """ Add sample set to problem
             
@@ -250,27 +342,50 @@ class matk(object):
         if not os.path.isfile(file):
             print 'No file '+file+' found...'
             return
-        fp = open(file)
-        # parse file
-        npar = int(fp.readline().rstrip().split(':')[1])
-        nobs = int(fp.readline().rstrip().split(':')[1])
-        headers = fp.readline().rstrip().split()
-        data = numpy.array([[float(num) for num in line.split()] for line in fp if not line.isspace()])
-        indices = numpy.array([int(v) for v in data[:,0]])
+        out = read_outfile(file)
+        if out is None:
+            print 'No samples found in '+file
+            return
+        parnames, obsnames, indices, samples, responses = out
         # add parameters
-        for header,dat in zip(headers[1:npar+1],data[:,1:npar+1].T):
+        for header,dat in zip(parnames,samples.T):
             if header not in self.pars:
                 self.add_par(header,min = numpy.min(dat),max = numpy.max(dat))
         # add observations
-        for header in headers[npar+1:]: 
+        for header in obsnames: 
             if header not in self.obs:
                 self.add_obs(header)
         # create samples
-        samples = data[:,1:npar+1]
-        if nobs > 0:
-            responses = data[:,npar+1:]
-        else: responses = None
         return self.create_sampleset(samples,name=name,responses=responses,indices=indices)
+    def load_sampleset(self, file, name=None, mmap=True):
+        """ Read MATK binary file written by SampleSet.save and assemble corresponding sampleset with responses.
+        
+        :param file: Path to MATK binary file
+        :type file: str
+        :param name: Name of sample set, if None, the name stored in the file is used if it is not already taken
+        :type name: str
+        :param mmap: If True, samples and responses are memory-mapped from file rather than read into memory
+        :type mmap: bool
+        """
+        if not os.path.isfile(file):
+            print 'No file '+file+' found...'
+            return
+        d = load_binary(file, mmap=mmap)
+        if name is None and d['name'] is not None and str(d['name']) not in self.sampleset:
+            name = str(d['name'])
+        # add parameters
+        mins = d['mins'] if d['mins'] is not None else [None]*len(d['parnames'])
+        maxs = d['maxs'] if d['maxs'] is not None else [None]*len(d['parnames'])
+        for header,mn,mx,dat in zip(d['parnames'],mins,maxs,d['samples'].T):
+            if header not in self.pars:
+                if mn is None: mn = numpy.min(dat)
+                if mx is None: mx = numpy.max(dat)
+                self.add_par(header,min=mn,max=mx)
+        # add observations
+        for header in d['obsnames']: 
+            if header not in self.obs:
+                self.add_obs(header)
+        return self.create_sampleset(d['samples'],name=name,responses=d['responses'],indices=d['indices'])
     def copy_sampleset(self,oldname,newname=None):
         """ Copy sampleset
 
@@ -279,7 +394,10 @@ class matk(object):
             :param newname: Name of new sampleset
             :type newname: str
         """
-        return self.create_sampleset(self.sampleset[oldname].samples.values,name=newname,responses=self.sampleset[oldname].responses.values,indices=self.sampleset[oldname].indices)
+        ss = self.create_sampleset(self.sampleset[oldname].samples.values,name=newname,responses=self.sampleset[oldname].responses.values,indices=self.sampleset[oldname].indices)
+        if self.sampleset[oldname].sequence is not None:
+            ss._sequence = dict(self.sampleset[oldname].sequence)
+        return ss
     @property
     def simvalues(self):
         """ Simulated values
@@ -421,11 +539,16 @@ class matk(object):
         if not self.workdir is None:
             # If folder doesn't exist
             if not os.path.isdir( self.workdir ):
-                os.makedirs( self.workdir )
+                if self.template_dir is not None:
+                    link_tree( self.template_dir, self.workdir )
+                else:
+                    os.makedirs( self.workdir )
                 return 0
             # or if reusing directories
             elif reuse_dirs:
-                pass
+                # Restore template files that were removed or replaced
+                if self.template_dir is not None:
+                    reset_tree( self.template_dir, self.workdir, clean=False )
                 return 0
             # or throw error
             else:
@@ -449,51 +572,43 @@ class matk(object):
             :returns: int -- 0: Successful run, 1: workdir exists 
         """
         if not workdir is None: self.workdir = workdir
-        if not self.workdir is None:
-            curdir = os.getcwd()
-            status = self.make_workdir( workdir=self.workdir, reuse_dirs=reuse_dirs)
-            os.chdir( self.workdir )
-            if status:
-                return 1
-        else:
-            curdir = None
+        curdir = None
         if hasattr( self.model, '__call__' ):
             try:
-                if pardict is None:
-                    pardict = dict([(k,par.value) for k,par in self.pars.items()])
-                else: self.parvalues = pardict
-                if self.model_args is None and self.model_kwargs is None:
-                    if hostname is None: sims = self.model( pardict )
-                    else: 
-                        if processor is None: sims = self.model( pardict, hostname=hostname )
-                        else: sims = self.model( pardict, hostname=hostname, processor=processor )
-                elif not self.model_args is None and self.model_kwargs is None:
-                    if hostname is None: sims = self.model( pardict, *self.model_args )
-                    else: 
-                        if processor is None: sims = self.model( pardict, *self.model_args, hostname=hostname )
-                        else: sims = self.model( pardict, *self.model_args, hostname=hostname, processor=processor )
-                elif self.model_args is None and not self.model_kwargs is None:
-                    if hostname is None: sims = self.model( pardict, **self.model_kwargs )
-                    else:
-                        if processor is None: sims = self.model( pardict, hostname=hostname, **self.model_kwargs )
-                        else: sims = self.model( pardict, hostname=hostname, processor=processor, **self.model_kwargs )
-                elif not self.model_args is None and not self.model_kwargs is None:
-                    if hostname is None: sims = self.model( pardict, *self.model_args, **self.model_kwargs )
-                    else:
-                        if processor is None: sims = self.model( pardict, *self.model_args, hostname=hostname, **self.model_kwargs )
-                        else: sims = self.model( pardict, *self.model_args, hostname=hostname, processor=processor, **self.model_kwargs )
+                if pardict is not None: self.parvalues = pardict
+                # Parameter values evaluated before (e.g. samples of a parallel run) are not evaluated again
+                if any([par.expr is not None for par in self.pars.values()]) and not self._exprs_evaluated == (self._exprs_key(), self.parvalues):
+                    self.parvalues = self._eval_exprs( [self.parvalues] )[0]
+                    self._exprs_evaluated = (self._exprs_key(), self.parvalues)
+                pardict = dict([(k,par.value) for k,par in self.pars.items()])
+                # Cached runs do not need a working directory
+                if self._cache is not None:
+                    parvalues = self.parvalues
+                    sims = self._cache.get(parvalues)
+                    if sims is not None:
+                        self._set_simvalues(sims)
+                        self._current = True
+                        return OrderedDict(zip(self.obsnames,self.simvalues))
+                if not self.workdir is None:
+                    if self.make_workdir( workdir=self.workdir, reuse_dirs=reuse_dirs): return 1
+                    curdir = os.getcwd()
+                    os.chdir( self.workdir )
+                if self.vectorized:
+                    names, sims = self._call_vectorized( [self.parvalues], hostname=hostname, processor=processor )
+                    sims = OrderedDict(zip(names,sims[0]))
+                else:
+                    sims = self._call_model( pardict, hostname=hostname, processor=processor )
                 self._current = True
-                if not curdir is None: os.chdir( curdir )
                 if sims is not None:
                     if isinstance(sims,(float,int)): sims = [sims]
                     if len(sims):
                         self._set_simvalues(sims)
                         simdict = OrderedDict(zip(self.obsnames,self.simvalues))
+                        if self._cache is not None: self._cache.put(parvalues, simdict)
                         return simdict
                 else: return None
             except:
                 errstr = traceback.format_exc()                
-                if not curdir is None: os.chdir( curdir )
                 s = "-"*60+'\n'
                 if job_number is not None:
                     s += "Exception in job "+str(job_number)+":\n"
@@ -503,10 +618,88 @@ class matk(object):
                 s += "-"*60
                 print s
                 return s
+            finally:
+                if not curdir is None: os.chdir( curdir )
         else:
             print "Error: Model is not a Python function"
-            if not curdir is None: os.chdir( curdir )
             return 1
+    def forward_vectorized(self, parsets, workdir=None, reuse_dirs=False, job_number=None, hostname=None, processor=None):
+        """ Run vectorized MATK model on many parameter sets in a single model call
+
+            :param parsets: Matrix of parameter values with npar columns in order of matk.pars.keys()
+            :type parsets: lst(fl64),ndarray(fl64)
+            :param workdir: Name of directory where model will be run. It will be created if it does not exist
+            :type workdir: str
+            :param reuse_dirs: If True and workdir exists, the model will reuse the directory
+            :type reuse_dirs: bool
+            :param job_number: Sample id
+            :type job_number: int
+            :param hostname: Name of host to run job on, will be passed to MATK model as kwarg 'hostname'
+            :type hostname: str
+            :param processor: Processor id to run job on, will be passed to MATK model as kwarg 'processor'
+            :type processor: str or int
+            :returns: ndarray(fl64) -- Matrix of responses with a row for each parameter set and columns in order of matk.obs.keys(), or error string if model call fails
+        """
+        if not workdir is None: self.workdir = workdir
+        curdir = None
+        try:
+            if not self.workdir is None:
+                if self.make_workdir( workdir=self.workdir, reuse_dirs=reuse_dirs): return 1
+                curdir = os.getcwd()
+                os.chdir( self.workdir )
+            names, sims = self._call_vectorized( parsets, hostname=hostname, processor=processor )
+            # Create missing observations and set simulated values to last parameter set
+            self._set_simvalues(OrderedDict(zip(names,sims[-1])))
+            if not names == self.obsnames:
+                out = numpy.empty((sims.shape[0],len(self.obs)))
+                out.fill(numpy.NAN)
+                obsnames = self.obsnames
+                for j,nm in enumerate(names):
+                    out[:,obsnames.index(nm)] = sims[:,j]
+                sims = out
+            self._current = False
+            return sims
+        except:
+            errstr = traceback.format_exc()                
+            s = "-"*60+'\n'
+            if job_number is not None:
+                s += "Exception in job "+str(job_number)+":\n"
+            else:
+                s += "Exception in model call:\n"
+            s += errstr
+            s += "-"*60
+            print s
+            return s
+        finally:
+            if not curdir is None: os.chdir( curdir )
+    def _call_model(self, pardict, hostname=None, processor=None):
+        """ Call model with parameter dictionary, model_args, model_kwargs, hostname and processor
+        """
+        args = () if self.model_args is None else self.model_args
+        kwargs = {} if self.model_kwargs is None else dict(self.model_kwargs)
+        if hostname is not None:
+            kwargs['hostname'] = hostname
+            if processor is not None: kwargs['processor'] = processor
+        return self.model( pardict, *args, **kwargs )
+    def _call_vectorized(self, parsets, hostname=None, processor=None):
+        """ Call vectorized model with dictionary of parameter value arrays
+
+            :returns: tuple(lst(str),ndarray(fl64)) -- observation names and responses with a row for each parameter set
+        """
+        parsets = numpy.asarray(parsets, dtype=float)
+        sims = self._call_model( OrderedDict(zip(self.parnames,parsets.T)), hostname=hostname, processor=processor )
+        if isinstance( sims, dict ):
+            names = list(sims.keys())
+            sims = numpy.column_stack([numpy.asarray(sims[k],dtype=float).reshape(-1) for k in names])
+        else:
+            sims = numpy.asarray(sims, dtype=float).reshape(parsets.shape[0],-1)
+            if sims.shape[1] == len(self.obs):
+                names = self.obsnames
+            elif len(self.obs) == 0:
+                names = ['obs'+str(i+1) for i in range(sims.shape[1])]
+            else:
+                raise ValueError("Number of simulated values returned by vectorized model ("+str(sims.shape[1])+") does not match created observations ("+str(len(self.obs))+")")
+        return names, sims
     def lmfit(self,maxfev=0,report_fit=True,cpus=1,epsfcn=None,xtol=1.e-7,ftol=1.e-7,
               workdir=None, verbose=False, **kwargs):
         """ Calibrate MATK model using lmfit package
@@ -583,7 +776,7 @@ class matk(object):
         if verbose: print 'SSR: ', numpy.sum([v**2 for v in self.residuals])
         return self.residuals
     def __jacobian( self, params, cpus=1, epsfcn=None, workdir_base=None,verbose=False,save=False,
-                   reuse_dirs=True):
+                   reuse_dirs=True, vectorized=None, method='forward'):
         ''' Numerical Jacobian calculation
         '''
         # Collect parameter values
@@ -596,25 +789,63 @@ class matk(object):
             hs = epsfcn * numpy.ones(len(a))
         else:
             hs = numpy.array(epsfcn)
-        # Forward differences
-        humat = numpy.identity(len(a))*hs
-        parset = [a]*humat.shape[0] + humat
-        parset = numpy.append(parset,[a],axis=0)
-        self.create_sampleset(parset,name='_jac_')
+        J, sims, nruns = self._fd_jacobian( a, hs, method=method, cpus=cpus, workdir_base=workdir_base, 
+                                          save=False, reuse_dirs=reuse_dirs, vectorized=vectorized )
+        # Jacobian of residuals
+        return -J
+    def _fd_jacobian( self, a, hs, method='forward', sims=None, topars=None, cpus=1, workdir_base=None, 
+                     save=True, reuse_dirs=False, vectorized=None ):
+        ''' Finite difference derivatives of simulated values. Model runs required by the 
+            method are performed in a single sampleset run. Simulated values at a are reused 
+            if they are current or cached (see enable_cache) instead of being rerun.
 
+            :param a: Values of variables to differentiate with respect to
+            :type a: ndarray(fl64)
+            :param hs: Finite difference increment of each variable
+            :type hs: ndarray(fl64)
+            :param method: 'forward' (npar runs, plus one if simulated values at a are unknown) or 'central' (2*npar runs) differences
+            :type method: str
+            :param sims: Simulated values at a if known
+            :type sims: ndarray(fl64)
+            :param topars: Function mapping variable values to parameter values in order of matk.pars.keys(); if None, variables are parameter values
+            :type topars: function
+            :returns: tuple(ndarray(fl64),ndarray(fl64),int) -- derivatives with a row for each observation and a column for each variable, simulated values at a (None if unknown), and number of model runs
+        '''
+        if topars is None: topars = lambda x: x
+        a = numpy.array(a, dtype=float)
+        hs = numpy.array(hs, dtype=float)*numpy.ones(len(a))
+        p0 = numpy.array(topars(a), dtype=float)
+        if sims is None:
+            if self._current and numpy.array_equal(self.parvalues, p0):
+                sims = numpy.array(self.simvalues, dtype=float)
+            elif self._cache is not None and p0.tolist() in self._cache:
+                sims = numpy.array(self._cache.get(p0).values(), dtype=float)
+        # Collect parameter sets
+        hmat = numpy.identity(len(a))*hs
+        if method == 'central':
+            parset = [topars(v) for v in numpy.concatenate([a-hmat,a+hmat])]
+        elif method == 'forward':
+            parset = [topars(v) for v in a+hmat]
+            if sims is None: parset.append(p0)
+        else:
+            print "Error: Finite difference method must be 'forward' or 'central'"
+            return
+        self.create_sampleset(numpy.array(parset),name='_jac_')
         # Perform simulations on parameter sets
         self.sampleset['_jac_'].run( cpus=cpus, verbose=False,
-                         workdir_base=workdir_base, save=False, reuse_dirs=reuse_dirs )
-        sims = self.sampleset['_jac_'].responses.values
-        diffsims = sims[:len(a)]
-        zerosims = sims[-1]
-        ##print 'diffsims: ', diffsims, diffsims.shape
-        #print 'zerosims: ', zerosims, zerosims.shape
-        J = []
-        for h,d in zip(hs,diffsims):
-            J.append((zerosims-d)/h)
-        self.parvalues = a
-        return numpy.array(J).T
+                         workdir_base=workdir_base, save=save, reuse_dirs=reuse_dirs, vectorized=vectorized )
+        out = self.sampleset['_jac_'].responses.values
+        if method == 'central':
+            J = [(u-l)/(2*h) for l,u,h in zip(out[:len(a)],out[len(a):],hs)]
+        else:
+            if sims is None: sims = out[-1]
+            J = [(u-sims)/h for u,h in zip(out[:len(a)],hs)]
+        # Reset parameter values and, if known, simulated values at a
+        self.parvalues = p0
+        if sims is not None:
+            self._set_simvalues(sims)
+            self._current = True
+        return numpy.array(J).T, sims, len(parset)
 
     def levmar(self,workdir=None,reuse_dirs=False,max_iter=1000,full_output=True):
         """ Calibrate MATK model using levmar package
@@ -645,7 +876,7 @@ class matk(object):
         out = levmar.leastsq(_f, vs, meas, args=(self,), Dfun=None, max_iter=max_iter, full_output=full_output)
         #TODO Put levmar results into MATK object
         return out
-    def lhs(self, name=None, siz=None, noCorrRestr=False, corrmat=None, seed=None, index_start=1):
+    def lhs(self, name=None, siz=None, noCorrRestr=False, corrmat=None, seed=None, index_start=1, dtype='float64', report=False, criterion=None, iterations=None):
         """ Draw lhs samples of parameter values from scipy.stats module distribution
         
             :param name: Name of sample set to be created
@@ -654,12 +885,20 @@ class matk(object):
             :type siz: int
             :param noCorrRestr: If True, correlation structure is not enforced on sample, use if siz is less than number of parameters
             :type noCorrRestr: bool
-            :param corrmat: Correlation matrix
+            :param corrmat: Correlation matrix, block diagonal matrices (dense or scipy.sparse) are sampled block by block
             :type corrmat: matrix
             :param seed: Random seed to allow replication of samples
             :type seed: int
             :param index_start: Starting value for sample indices
             :type: int
+            :param dtype: Data type of samples, e.g. 'float32' to halve the memory of the sample of very large samples; parameters are transformed in float64 blocks into the sample
+            :type dtype: str
+            :param report: If True, print the difference between rank correlation coefficients of samples and corrmat
+            :type report: bool
+            :param criterion: Space-filling design criterion, 'maximin' maximizes the minimum distance between samples (enhanced stochastic evolutionary optimization of pyDOE), 'centermaximin' also places samples at the center of strata; cannot be used with corrmat
+            :type criterion: str
+            :param iterations: Number of iterations of criterion optimization
+            :type iterations: int
             :returns: matrix -- Parameter samples
           
         """
@@ -671,31 +910,300 @@ class matk(object):
         else:
             siz = self.sample_size
         # Take distribution keyword and convert to scipy.stats distribution object
+        dists = self._dists()
+        dist_pars = self.pardist_pars
+        if criterion is not None and corrmat is not None:
+            print "Error: corrmat cannot be used with criterion"
+            return
+        x = lhs(dists, dist_pars, siz=siz, noCorrRestr=noCorrRestr, corrmat=corrmat, seed=seed, dtype=dtype, criterion=criterion, iterations=iterations)
+        if report: corr_report(x, corrmat)
+        x = self._eval_exprs( x )
+        return self.create_sampleset( x, name=name, index_start=index_start )
+    def sobol(self, name=None, siz=None, scramble=True, skip=0, seed=None, index_start=1):
+        """ Draw samples of parameter values from the Sobol low-discrepancy sequence, 
+            transformed to the scipy.stats distributions of parameters. 
+            A sequence is continued by calling sobol again with skip set to the 
+            number of samples drawn before and the same seed.
+        
+            :param name: Name of sample set to be created
+            :type name: str
+            :param siz: Number of samples to generate, powers of 2 are best balanced
+            :type siz: int
+            :param scramble: If True, the sequence is randomized, avoiding the sample at the lower bounds of parameters
+            :type scramble: bool
+            :param skip: Number of initial samples of the sequence to skip
+            :type skip: int
+            :param seed: Random seed of scrambling
+            :type seed: int
+            :param index_start: Starting value for sample indices
+            :type: int
+            :returns: SampleSet object
+        """
+        return self._qmc( 'sobol', name=name, siz=siz, scramble=scramble, skip=skip, seed=seed, index_start=index_start )
+    def halton(self, name=None, siz=None, scramble=True, skip=0, seed=None, index_start=1):
+        """ Draw samples of parameter values from the Halton low-discrepancy sequence, 
+            transformed to the scipy.stats distributions of parameters. 
+            A sequence is continued by calling halton again with skip set to the 
+            number of samples drawn before and the same seed.
+        
+            :param name: Name of sample set to be created
+            :type name: str
+            :param siz: Number of samples to generate
+            :type siz: int
+            :param scramble: If True, the digits of the sequence are randomly permuted
+            :type scramble: bool
+            :param skip: Number of initial samples of the sequence to skip
+            :type skip: int
+            :param seed: Random seed of scrambling
+            :type seed: int
+            :param index_start: Starting value for sample indices
+            :type: int
+            :returns: SampleSet object
+        """
+        return self._qmc( 'halton', name=name, siz=siz, scramble=scramble, skip=skip, seed=seed, index_start=index_start )
+    def _qmc(self, method, name=None, siz=None, scramble=True, skip=0, seed=None, index_start=1):
+        if seed:
+            self.seed = seed
+        if siz:
+            self.sample_size = siz
+        else:
+            siz = self.sample_size
+        # Scrambling is drawn from seed, keep it so that the sequence can be continued
+        if scramble and seed is None:
+            seed = numpy.random.randint(2**31-1)
+        x = self._qmc_samples( method, siz, scramble=scramble, skip=skip, seed=seed )
+        ss = self.create_sampleset( x, name=name, index_start=index_start )
+        ss._sequence = {'method':method, 'scramble':scramble, 'seed':seed, 'skip':skip+siz}
+        return ss
+    def _qmc_samples(self, method, siz, scramble=True, skip=0, seed=None):
+        u = getattr(qmc,method)(siz, len(self.pars), skip=skip, scramble=scramble, seed=seed)
+        x = dist_ppf(self._dists(), self.pardist_pars, u)
+        return self._eval_exprs( x )
+    def _dists(self):
+        # Convert distribution keywords to scipy.stats distribution objects
         dists = []
         for dist in self.pardists:
             eval( 'dists.append(stats.' + dist + ')' )
-        dist_pars = self.pardist_pars
-        x = lhs(dists, dist_pars, siz=siz, noCorrRestr=noCorrRestr, corrmat=corrmat, seed=seed)
-        for j,p in enumerate(self.pars.values()):
-            if p.expr is not None:
-                for i,r in enumerate(x):
-                    x[i,j] = self.__eval_expr( p.expr, r )
-        return self.create_sampleset( x, name=name, index_start=index_start )
-    def child( self, in_queue, out_list, reuse_dirs, save, hostname, processor):
-        for pars,smp_ind,lst_ind in iter(in_queue.get, ('','','')):
+        return dists
+    def start(self, cpus=None, task_timeout=None, max_failures=None):
+        """ Start persistent worker processes that are reused by parallel runs 
+            (e.g. SampleSet.run, Jac, calibrate, lmfit, emcee) until shutdown is called.
+            MATK objects can also be used as context managers, e.g. "with prob: ...".
+
+            :param cpus: number of cpus; alternatively, dictionary of lists of processor ids keyed by hostnames. If None, matk.cpus is used.
+            :type cpus: int,dict(lst)
+            :param task_timeout: Number of seconds after which parameter sets still running are run again on idle workers, the first result to arrive is used
+            :type task_timeout: fl64
+            :param max_failures: Number of successive failed or timed out runs on a host after which the host is blacklisted
+            :type max_failures: int
+            :returns: WorkerPool object
+        """
+        if cpus is not None: self.cpus = cpus
+        if not isinstance( self.cpus, (int,dict) ):
+            print "Error: cpus argument is neither an integer nor a dictionary!"
+            return
+        if self._workers is not None:
+            if self._workers.started and self._workers.cpus == self.cpus:
+                if task_timeout is not None: self._workers.task_timeout = task_timeout
+                if max_failures is not None: self._workers.max_failures = max_failures
+                return self._workers
+            self._workers.shutdown()
+        self._workers = WorkerPool(self, self.cpus, task_timeout=task_timeout, max_failures=max_failures)
+        self._workers.start()
+        return self._workers
+    def shutdown(self):
+        """ Stop worker processes started by start
+        """
+        if self._workers is not None:
+            self._workers.shutdown()
+            self._workers = None
+    def enable_cache(self, maxsize=1000, digits=None, filename=None):
+        """ Cache simulated values of model runs so that forward does not rerun the model
+            for parameter values it has recently been run with (e.g. final evaluations of 
+            calibrations or revisited positions of emcee walkers). The cache is cleared if
+            the model, model_args or model_kwargs are changed.
+
+            :param maxsize: Maximum number of cached model runs, least recently used runs are discarded first; None for no limit
+            :type maxsize: int
+            :param digits: Number of significant digits parameter values are rounded to before comparison; if None, parameter values must match exactly
+            :type digits: int
+            :param filename: File that cached runs are written to as they are added; if the file exists, cached runs are loaded from it. If the model is changed, the file is kept but no longer written to
+            :type filename: str
+            :returns: ModelCache object
+        """
+        self._cache = ModelCache(maxsize=maxsize, digits=digits, filename=filename)
+        return self._cache
+    def disable_cache(self):
+        """ Stop caching model runs, cached runs are discarded (files written by the cache are kept)
+        """
+        self._cache = None
+    def _invalidate_cache(self):
+        """ Discard cached model runs after the model has changed. The cache file holds runs
+            of the previous model, so it is kept but runs of the new model are not written to it.
+        """
+        if getattr(self, '_cache', None) is not None:
+            self._cache.clear(remove_file=False)
+            if self._cache.filename is not None:
+                print "Warning: Model changed, cache file "+self._cache.filename+" is kept but no longer written to"
+                self._cache.filename = None
+    def _invalidate_workers(self):
+        """ Flag running worker processes as holding an outdated copy of the MATK object
+        """
+        if getattr(self, '_workers', None) is not None:
+            self._workers.stale = True
+    def child( self, in_queue, out_list, hostname, processor, cancelled=None, stopped=None):
+        pid = os.getpid()
+        # Runs are looked up in and added to the cache by the parent process (see _iparallel)
+        self._cache = None
+        for task in iter(in_queue.get, None):
+            # Leave tasks to workers on other hosts if host has been blacklisted
+            if stopped is not None and stopped.value:
+                in_queue.put(task)
+                break
+            # Skip tasks of cancelled batches
+            if cancelled is not None and task[1] <= cancelled.value: continue
+            out_list.put(('start', task[1], task[2], None, pid, hostname, None))
+            t0 = time()
+            if task[0] == 'call':
+                kind, batch, lst_ind, func, arg = task
+                resp = call(func, arg)
+            else:
+                kind, batch, lst_ind, smp_inds, parsets, opts = task
+                resp = self._run_chunk(parsets, smp_inds, opts, hostname, processor)
+            out_list.put(('done', batch, lst_ind, resp, pid, hostname, time()-t0))
+    def _run_chunk(self, parsets, smp_inds, opts, hostname=None, processor=None):
+        """ Run model on a chunk of parameter sets
+
+            :returns: tuple(lst(int),lst(str),ndarray(fl64),lst(tuple),lst(tuple)) -- sample indices, observation names, responses with a row for each parameter set (None if all runs failed), (row, output) for failed runs, and (failure class, number of attempts) for each parameter set
+        """
+        self.workdir_base = opts['workdir_base']
+        # Reuse a pooled working directory staged from the template if working directories are not saved
+        pooled = self.template_dir is not None and self.workdir_base is not None and not opts['save']
+        reuse_dirs = opts['reuse_dirs'] or pooled
+        if opts['vectorized']:
+            # Vectorized models are called once on the whole chunk
+            self._set_run_workdir(smp_inds[0], pooled)
+            def run(retry):
+                sims = self.forward_vectorized(parsets, reuse_dirs=reuse_dirs or retry, job_number=smp_inds[0], 
+                                               hostname=hostname, processor=processor)
+                # Observation names are returned with responses, since runs with a timeout create
+                # missing observations in a forked process (see Timeout)
+                if isinstance( sims, numpy.ndarray ): return OrderedDict(zip(self.obsnames,sims.T))
+                return sims
+            status, kind, attempts = self._retry(run, opts)
+            if not opts['save'] and not self.workdir is None and not pooled:
+                rmtree( self.workdir )
+            if isinstance( status, OrderedDict ):
+                return smp_inds, status.keys(), numpy.column_stack(status.values()), [], [(kind,attempts)]*len(smp_inds)
+            else:
+                return smp_inds, None, None, [(0,status)]+[(i,None) for i in range(1,len(smp_inds))], [(kind,attempts)]*len(smp_inds)
+        names = None
+        sims = None
+        errs = []
+        kinds = []
+        for i,(pars,smp_ind) in enumerate(zip(parsets,smp_inds)):
             self.workdir_index = smp_ind
-            if self.workdir_base is not None:
-                self.workdir = self.workdir_base + '.' + str(self.workdir_index)
+            self._set_run_workdir(smp_ind, pooled)
             self.parvalues = pars
-            status = self.forward(reuse_dirs=reuse_dirs, job_number=smp_ind, hostname=hostname, processor=processor)
-            out_list.put([lst_ind, smp_ind, status])
-            if not save and not self.workdir is None:
+            # Expressions were evaluated for all parameter sets by _iparallel
+            self._exprs_evaluated = (self._exprs_key(), self.parvalues)
+            status, kind, attempts = self._retry(lambda retry: self.forward(reuse_dirs=reuse_dirs or retry, 
+                                                 job_number=smp_ind, hostname=hostname, processor=processor), opts)
+            kinds.append((kind,attempts))
+            if isinstance( status, OrderedDict ):
+                # Collect responses of chunk in a single array
+                if sims is None:
+                    names = status.keys()
+                    sims = numpy.empty((len(smp_inds),len(names)))
+                    sims.fill(numpy.NAN)
+                sims[i] = status.values()
+            else:
+                errs.append((i,status))
+            if not opts['save'] and not self.workdir is None and not pooled:
                 rmtree( self.workdir )
-            in_queue.task_done()
-        in_queue.task_done()
+        return smp_inds, names, sims, errs, kinds
+    def _set_run_workdir(self, smp_ind, pooled=False):
+        """ Set working directory of a model run in a parallel run, restoring pooled working directories
+            to the state of the template directory
+
+            :param smp_ind: Sample index
+            :type smp_ind: int
+            :param pooled: If True, the working directory of this process is reused
+            :type pooled: bool
+        """
+        if self.workdir_base is None:
+            self.workdir = None
+        elif pooled:
+            self.workdir = self.workdir_base + '.pool.' + str(os.getpid())
+            if os.path.isdir( self.workdir ): reset_tree( self.template_dir, self.workdir )
+        else:
+            self.workdir = self.workdir_base + '.' + str(smp_ind)
+    def _retry(self, run, opts):
+        """ Call run until it succeeds or opts['retries'] retries of failed and timed out runs are used up,
+            waiting opts['backoff']*2**k seconds before retry k+1. Runs are stopped after opts['timeout'] seconds.
+
+            :param run: Function running the model, called with True for retries
+            :type run: function
+            :param opts: Run options
+            :type opts: dict
+            :returns: tuple(any,str,int) -- output of the last run, failure class ('success', 'error', 'timeout', 'workdir' or 'noresult') and number of attempts
+        """
+        timeout = opts.get('timeout')
+        retries = opts.get('retries', 0)
+        backoff = opts.get('backoff', 1.)
+        attempt = 0
+        while True:
+            attempt += 1
+            timer = Timeout(timeout)
+            status = timer.call(lambda: run(attempt > 1))
+            if timer.expired: kind = 'timeout'
+            elif isinstance( status, (OrderedDict,numpy.ndarray) ): kind = 'success'
+            elif isinstance( status, str ): kind = 'error'
+            elif status is None: kind = 'noresult'
+            else: kind = 'workdir'
+            if kind not in ['error','timeout'] or attempt > retries:
+                return status, kind, attempt
+            if backoff: sleep(backoff*2**(attempt-1))
     def parallel(self, parsets, cpus=1, workdir_base=None, save=True,
-                reuse_dirs=False, indices=None, verbose=True, logfile=None):
+                reuse_dirs=False, indices=None, verbose=True, logfile=None, chunksize=None, vectorized=None,
+                outfile=None, append=False, task_timeout=None, max_failures=None, timeout=None, retries=0, backoff=1.):
+
+        # Determine number of samples
+        if isinstance( parsets, numpy.ndarray ): n = parsets.shape[0]
+        elif isinstance( parsets, list ): n = len(parsets)
+
+        results = None
+        for lst_ind, smp_inds, names, sims, errs, status in self._iparallel(parsets, cpus=cpus, workdir_base=workdir_base, 
+                save=save, reuse_dirs=reuse_dirs, indices=indices, verbose=verbose, logfile=logfile, 
+                chunksize=chunksize, vectorized=vectorized, outfile=outfile, append=append, 
+                task_timeout=task_timeout, max_failures=max_failures, timeout=timeout, retries=retries, backoff=backoff):
+            if sims is not None:
+                if results is None:
+                    results = numpy.empty((n,sims.shape[1]))
+                    results.fill(numpy.NAN)
+                results[lst_ind:lst_ind+len(smp_inds)] = sims
 
+        # Responses of failed runs are NaN, also if all runs failed
+        if results is None and len(self.obs) > 0:
+            results = numpy.empty((n,len(self.obs)))
+            results.fill(numpy.NAN)
+        if results is not None and results.shape[1] == 1:
+            if numpy.all(numpy.isnan(results)):
+                results = None
+
+        return results, parsets   
+    def _iparallel(self, parsets, cpus=1, workdir_base=None, save=True,
+                reuse_dirs=False, indices=None, verbose=True, logfile=None, chunksize=None, vectorized=None,
+                outfile=None, append=False, task_timeout=None, max_failures=None, timeout=None, retries=0, backoff=1., 
+                in_process=True):
+        """ Generator of parallel model run results, yielding chunks as they finish as tuple(list index of
+            first parameter set in chunk, sample indices, observation names, responses with a row for each 
+            parameter set in the chunk or None if all runs failed, list of (row, output) for failed runs,
+            list of (failure class, number of attempts) for each parameter set). 
+            Parameter sets not yet started are cancelled if the generator is closed before it is exhausted.
+            A vectorized model with a single cpu is run in this process if in_process is True, otherwise 
+            in chunks by a worker process, so that the calling process keeps its working directory.
+        """
         if not os.name is "posix":
             # Use freeze_support for PCs
             freeze_support()
@@ -705,45 +1213,62 @@ class matk(object):
         if not workdir_base is None: self.workdir_base = workdir_base
         if self.workdir_base is None: self.workdir = None
 
-        #if len(hosts) > 0:
-        if isinstance( cpus, dict):
-            hosts = cpus
-            cpus = sum([len(v) for v in hosts.values()])
-            processors = [v for l in hosts.values() for v in l]
-            hostnames = [k for k,v in hosts.items() for n in v]
-            self.cpus = hosts
-        elif isinstance(self.cpus,dict) and len(self.cpus) > 0:
-            hosts = self.cpus
-            cpus = sum([len(v) for v in hosts.values()])
-            processors = [v for l in hosts.values() for v in l]
-            hostnames = [k for k,v in hosts.items() for n in v]
-        elif isinstance(cpus, int):
-            hostnames = [None]*cpus
-            processors = [None]*cpus
-        else:
-            print "Error: cpus argument is neither an integer nor a dictionary!"
-            return
-
-        # Determine number of samples and adjust cpus if samples < cpus requested
+        # Determine number of samples
         if isinstance( parsets, numpy.ndarray ): n = parsets.shape[0]
         elif isinstance( parsets, list ): n = len(parsets)
-        if n < cpus: cpus = n
+        # Evaluate parameters with expressions for all parameter sets at once
+        parsets = self._eval_exprs( parsets )
 
-        # Start cpus model runs
-        resultsq = Queue()
-        work = JoinableQueue()
-        pool = []
-        for i in range(cpus):
-            p = Process(target=self.child, args=(work, resultsq, reuse_dirs, save, hostnames[i],processors[i]))
-            p.daemon = True
-            p.start()
-            pool.append(p)
+        if indices is None: indices = range(1,n+1)
+        if vectorized is None: vectorized = self.vectorized
+        if chunksize is None:
+            if vectorized: chunksize = 'auto'
+            else: chunksize = 1
 
-        iter_args = itertools.chain( parsets, ('',)*cpus )
-        iter_smpind = itertools.chain( indices, ('',)*cpus )
-        iter_lstind = itertools.chain( range(len(parsets)), ('',)*cpus )
-        for item in zip(iter_args,iter_smpind,iter_lstind):
-            work.put(item)
+        # Use persistent workers if started, otherwise start workers for this run only
+        pool = self._workers
+        if pool is not None and pool.started:
+            if pool.stale: pool.restart()
+            if task_timeout is not None: pool.task_timeout = task_timeout
+            if max_failures is not None: pool.max_failures = max_failures
+        else:
+            if isinstance( cpus, dict):
+                self.cpus = cpus
+            elif isinstance(self.cpus,dict) and len(self.cpus) > 0:
+                cpus = self.cpus
+            elif not isinstance(cpus, int):
+                print "Error: cpus argument is neither an integer nor a dictionary!"
+                return
+            if vectorized and cpus == 1 and in_process:
+                # Run vectorized model in this process
+                pool = None
+            else:
+                pool = WorkerPool(self, cpus, task_timeout=task_timeout, max_failures=max_failures)
+                # Adjust cpus if samples < cpus requested
+                pool.start(nmax=n)
+
+        if pool is None:
+            opts = {'workdir_base':self.workdir_base, 'save':save, 'reuse_dirs':reuse_dirs, 'vectorized':vectorized,
+                    'timeout':timeout, 'retries':retries, 'backoff':backoff}
+            chunks = [(0, self._run_chunk(parsets, indices, opts))]
+        elif self._cache is not None and not vectorized:
+            # Only parameter sets that are not cached are sent to workers
+            cached = []
+            todo = []
+            for i in range(n):
+                sims = self._cache.get( parsets[i] )
+                if sims is None: todo.append(i)
+                else: cached.append((i,indices[i],sims))
+            batch = pool.submit([parsets[i] for i in todo], [indices[i] for i in todo], workdir_base=self.workdir_base, 
+                                save=save, reuse_dirs=reuse_dirs, chunksize=chunksize, vectorized=vectorized, timeout=timeout, 
+                                retries=retries, backoff=backoff)
+            stale = pool.stale
+            chunks = self._cache_chunks(pool.results(batch, len(todo)), parsets, cached, todo)
+        else:
+            batch = pool.submit(parsets, indices, workdir_base=self.workdir_base, save=save, reuse_dirs=reuse_dirs, 
+                                chunksize=chunksize, vectorized=vectorized, timeout=timeout, retries=retries, backoff=backoff)
+            stale = pool.stale
+            chunks = pool.results(batch, n)
         
         if verbose or logfile: 
             if logfile: f = open(logfile, 'w')
@@ -752,56 +1277,104 @@ class matk(object):
                 s += " %16s" % nm
             header = True
 
-        results = [[numpy.NAN]]*len(parsets)
-        for i in range(len(parsets)):
-            lst_ind, smp_ind, resp = resultsq.get()
-            if isinstance( resp, str):
-                if logfile: 
-                    f.write(resp+'\n')
-                    f.flush()
-            else:
-                if isinstance( resp, OrderedDict):
-                    self._set_simvalues(resp)
-                    results[lst_ind] = resp.values()
-                if verbose or logfile:
-                    if header:
-                        for nm in self.obsnames:
-                            s += " %16s" % nm
+        if outfile: 
+            writer = ResultsWriter(outfile, self.parnames, self.obsnames, append=append)
+
+        try:
+            for lst_ind, (smp_inds, names, sims, errs, status) in chunks:
+                if outfile:
+                    writer.write(smp_inds, parsets[lst_ind:lst_ind+len(smp_inds)], sims, names)
+                if sims is not None:
+                    last = max([i for i in range(len(smp_inds)) if i not in dict(errs)])
+                    self._set_simvalues(OrderedDict(zip(names,sims[last])))
+                if verbose or logfile: 
+                    errd = dict(errs)
+                    for i,smp_ind in enumerate(smp_inds):
+                        if isinstance( errd.get(i), str):
+                            if logfile: 
+                                f.write(errd[i]+'\n')
+                                f.flush()
+                            continue
+                        if header:
+                            for nm in self.obsnames:
+                                s += " %16s" % nm
+                            s += '\n'
+                            if verbose: print s,
+                            if logfile: 
+                                f.write( s )
+                                f.flush()
+                            header = False
+                        s = "%-8d" % smp_ind
+                        for v in parsets[lst_ind+i]:
+                            s += " %16lf" % v
+                        if sims is not None and i not in errd:
+                            for v in sims[i]:
+                                s += " %16lf" % v
                         s += '\n'
                         if verbose: print s,
                         if logfile: 
                             f.write( s )
                             f.flush()
-                        header = False
-                    s = "%-8d" % smp_ind
-                    for v in parsets[lst_ind]:
-                        s += " %16lf" % v
-                    if results[lst_ind] is not numpy.NAN:
-                        for v in results[lst_ind]:
-                            s += " %16lf" % v
-                    s += '\n'
-                    if verbose: print s,
-                    if logfile: 
-                        f.write( s )
-                        f.flush()
-        if logfile: f.close()
+                yield lst_ind, smp_inds, names, sims, errs, status
+        finally:
+            if logfile: f.close()
+            if outfile: writer.close()
 
-        for i in range(len(results)):
-            if results[i] is numpy.NAN:
-                if len(self.obs) > 0:
-                    results[i] = [numpy.NAN]*len(self.obs)
+            pooled = self.template_dir is not None and self.workdir_base is not None and not save
+            # Processes whose pooled working directories belong to this run
+            if pool is None: pids = [os.getpid()]
+            else: pids = pool.pids
+            busy = set()
+            if pool is not None:
+                # Parameter sets of interrupted runs and queued copies of stragglers are not started
+                pool.cancel(batch)
+                self._host_stats = pool.host_stats
+                # Observations created from results are already known to the workers
+                pool.stale = stale
+                if pool is not self._workers:
+                    pool.shutdown()
+                elif pooled:
+                    # Persistent workers may still be running copies of stragglers in their working directories
+                    busy = pool.running()
 
-        for p in pool:
-            p.join()
+            # Remove pooled working directories of this run, directories in use are removed after a later run
+            if pooled:
+                for pid in pids:
+                    d = self.workdir_base + '.pool.' + str(pid)
+                    if pid not in busy and os.path.isdir( d ): rmtree( d )
 
-        # Clean parent
-        self.workdir = saved_workdir
-        results = numpy.array(results)
-        if results.shape[1] == 1:
-            if all(numpy.isnan(r[0]) for r in results):
-                results = None
+            # Clean parent
+            self.workdir = saved_workdir
+    def _cache_chunks(self, chunks, keys, cached, todo):
+        """ Generator of chunk results of cached model runs followed by chunks of parameter sets run by 
+            workers, adding successful runs to the cache. Chunks are split into runs of consecutive 
+            parameter sets so that list indices of chunks refer to all parameter sets.
 
-        return results, parsets   
+            :param chunks: Chunk results of parameter sets run by workers with list indices into todo
+            :type chunks: generator
+            :param keys: Parameter sets with parameter expressions evaluated
+            :type keys: ndarray(fl64)
+            :param cached: (list index, sample index, simulated values) of cached parameter sets
+            :type cached: lst(tuple)
+            :param todo: List indices of parameter sets run by workers
+            :type todo: lst(int)
+        """
+        for i,smp_ind,sims in cached:
+            yield i, ([smp_ind], sims.keys(), numpy.array([sims.values()]), [], [('success',0)])
+        for lst_ind, (smp_inds, names, sims, errs, status) in chunks:
+            rows = todo[lst_ind:lst_ind+len(smp_inds)]
+            errd = dict(errs)
+            if sims is not None:
+                for i,r in enumerate(rows):
+                    if i not in errd: self._cache.put(keys[r], OrderedDict(zip(names,sims[i])))
+            start = 0
+            for k in range(1,len(rows)+1):
+                if k < len(rows) and rows[k] == rows[k-1]+1: continue
+                sub_errs = [(i-start,e) for i,e in errs if start <= i < k]
+                if sims is None or len(sub_errs) == k-start: sub_sims = None
+                else: sub_sims = sims[start:k]
+                yield rows[start], (smp_inds[start:k], names, sub_sims, sub_errs, status[start:k])
+                start = k
     def parstudy(self, name=None, nvals=2):
         ''' Generate parameter study samples
         
@@ -846,11 +1419,15 @@ class matk(object):
         parsets = mns + ds/(levels-1)*(mxs-mns)
         return self.create_sampleset(parsets, name=name)
     def Jac( self, h=None, cpus=1, workdir_base=None,
-                    save=True, reuse_dirs=False, verbose=False ):
+                    save=True, reuse_dirs=False, verbose=False, vectorized=None, method='forward' ):
         ''' Numerical Jacobian calculation
 
             :param h: Parameter increment, single value or array with npar values
             :type h: fl64 or ndarray(fl64)
+            :param method: Finite difference method, 'forward' or 'central'; simulated values at current parameter values are reused by forward differences if current
+            :type method: str
+            :param vectorized: If True, all perturbed parameter sets are evaluated in a single model call; if None, matk.vectorized is used
+            :type vectorized: bool
             :returns: ndarray(fl64) -- Jacobian matrix
         '''
         try: import lmfit
@@ -863,10 +1440,10 @@ class matk(object):
         for k,p in self.pars.items():
             params.add(k,value=p.value,vary=p.vary,min=p.min,max=p.max,expr=p.expr) 
 
-        return self.__jacobian( params, cpus=cpus, epsfcn=h, workdir_base=workdir_base,verbose=verbose,save=save, reuse_dirs=reuse_dirs)
+        return self.__jacobian( params, cpus=cpus, epsfcn=h, workdir_base=workdir_base,verbose=verbose,save=save, reuse_dirs=reuse_dirs, vectorized=vectorized, method=method)
 
     def calibrate( self, cpus=1, maxiter=100, lambdax=0.001, minchange=1.0e-16, minlambdax=1.0e-6, verbose=False,
-                  workdir=None, reuse_dirs=False, h=1.e-6):
+                  workdir=None, reuse_dirs=False, h=1.e-6, method='central', switch=0.1, broyden=0, nlambda=1):
         """ Calibrate MATK model using Levenberg-Marquardt algorithm based on 
             original code written by Ernesto P. Adorio PhD. 
             (UPDEPP at Clarkfield, Pampanga)
@@ -883,19 +1460,84 @@ class matk(object):
             :type minlambdax: fl4
             :param verbose: If True, additional information written to screen during calibration
             :type verbose: bool
-            :returns: best fit parameters found by routine
-            :returns: best Sum of squares.
-            :returns: covariance matrix
+            :param h: Parameter increment for finite difference Jacobian, single value or array with npar values
+            :type h: fl64 or ndarray(fl64)
+            :param method: Finite difference method for Jacobian, 'forward', 'central' or 'auto' (forward differences until the sum of squares improves by less than the fraction switch in an iteration, then central differences)
+            :type method: str
+            :param switch: Relative reduction in sum of squares below which 'auto' method switches to central differences
+            :type switch: fl64
+            :param broyden: Maximum number of successive iterations in which the Jacobian is updated with a Broyden rank-one correction instead of being recomputed by finite differences; if 0, the Jacobian is recomputed every iteration
+            :type broyden: int
+            :param nlambda: Number of Marquardt lambdas tested concurrently in each iteration (lambda*10**k, k=0,...,nlambda-1), so that failed upgrades do not require additional serial model runs; if 1, lambdas are tested one at a time
+            :type nlambda: int
+            :returns: CalibrationResult object with final parameter values, sum of squared residuals, Jacobian and covariance, per-iteration history (history), model run counts (nfev: upgrade runs, jac_runs: runs for finite difference Jacobians, njev: finite difference Jacobians, nupdates: Broyden updates) and wall time of each phase (times)
         """
         from minimizer import Minimizer
         fitter = Minimizer(self)
-        fitter.calibrate(cpus=cpus,maxiter=maxiter,lambdax=lambdax,minchange=minchange,
-                         minlambdax=minlambdax,verbose=verbose,workdir=workdir,reuse_dirs=reuse_dirs,h=h)
-    def __eval_expr(self, exprstr, parset):
-        aeval = Interpreter()
-        for val,nm in zip(parset,self.pars.keys()):
-            aeval.symtable[nm] = val
-        return aeval(exprstr)
+        return fitter.calibrate(cpus=cpus,maxiter=maxiter,lambdax=lambdax,minchange=minchange,
+                         minlambdax=minlambdax,verbose=verbose,workdir=workdir,reuse_dirs=reuse_dirs,h=h,
+                         method=method,switch=switch,broyden=broyden,nlambda=nlambda)
+    def _eval_exprs(self, x):
+        """ Evaluate parameters with expressions for a matrix of parameter sets. Expressions are
+            evaluated on whole columns of x; expressions that cannot be evaluated on arrays 
+            (e.g. using python's max) are evaluated row by row. Parameters with expressions that
+            cannot be evaluated are set to NaN and an error is printed.
+
+            :param x: Matrix of parameter values with npar columns in order of matk.pars.keys()
+            :type x: ndarray(fl64)
+            :returns: ndarray(fl64) -- x with columns of parameters with expressions replaced by evaluated values
+        """
+        if not any([p.expr is not None for p in self.pars.values()]): return x
+        aeval, symbols, exprs = self._compile_exprs()
+        x = numpy.array(x, ndmin=2)
+        if not x.dtype.kind == 'f': x = x.astype('float')
+        names = self.pars.keys()
+        # Columns are views of x, so evaluated parameters are available to subsequent expressions
+        for j,nm in enumerate(names):
+            aeval.symtable[nm] = x[:,j]
+        for j,exprstr,node in exprs:
+            v, err = _run_expr( aeval, node, exprstr )
+            try:
+                if err is not None: raise ValueError
+                v = numpy.asarray( v, dtype='float' )
+                if v.ndim > 1 or (v.ndim == 1 and not len(v) == x.shape[0]): raise ValueError
+                x[:,j] = v
+            except (TypeError,ValueError):
+                errs = []
+                for i,r in enumerate(x):
+                    for k,nm in enumerate(names):
+                        aeval.symtable[nm] = r[k]
+                    v, err = _run_expr( aeval, node, exprstr )
+                    if v is None:
+                        errs.append(err)
+                        x[i,j] = numpy.nan
+                    else: x[i,j] = v
+                if len(errs):
+                    print "Error: Expression "+exprstr+" of parameter "+names[j]+" could not be evaluated for "+str(len(errs))+" of "+str(x.shape[0])+" parameter sets, values set to NaN"
+                    if errs[0] is not None: print errs[0]
+                for k,nm in enumerate(names):
+                    aeval.symtable[nm] = x[:,k]
+        # Do not keep references to x in the interpreter
+        for nm in names:
+            if nm in symbols: aeval.symtable[nm] = symbols[nm]
+            else: aeval.symtable.pop(nm, None)
+        return x
+    def _compile_exprs(self):
+        """ Interpreter and parsed expressions of parameters with expressions, compiled once
+            and compiled again if parameters or expressions change
+
+            :returns: tuple(Interpreter,dict,lst(tuple)) -- interpreter, its initial symbols, and (column, expression, parsed expression) of each parameter with an expression
+        """
+        key = self._exprs_key()
+        if self._exprs_compiled is None or not self._exprs_compiled[0] == key:
+            aeval = Interpreter()
+            symbols = dict(aeval.symtable)
+            exprs = [(j,p.expr,aeval.parse(p.expr)) for j,p in enumerate(self.pars.values()) if p.expr is not None]
+            self._exprs_compiled = (key, aeval, symbols, exprs)
+        return self._exprs_compiled[1:]
+    def _exprs_key(self):
+        # Parameter names and expressions that compiled expressions and evaluated parameter values depend on
+        return tuple([(nm,p.expr) for nm,p in self.pars.items()])
     def MCMC( self, nruns=10000, burn=1000, init_error_std=1., max_error_std=100., verbose=1 ):
         ''' Perform Markov Chain Monte Carlo sampling using pymc package
 
@@ -974,7 +1616,11 @@ class matk(object):
             sys.stderr.write("Warning: failed to import emcee module. ({})\n".format(exc))
         if lnprob is None:
             lnprob = logposterior(self)
-        sampler = emcee.EnsembleSampler(nwalkers, len(self.parnames), lnprob, threads=self.cpus)
+        if self._workers is not None and self._workers.started:
+            if self._workers.stale: self._workers.restart()
+            sampler = emcee.EnsembleSampler(nwalkers, len(self.parnames), lnprob, pool=self._workers)
+        else:
+            sampler = emcee.EnsembleSampler(nwalkers, len(self.parnames), lnprob, threads=self.cpus)
         if pos0 == None:
             try:
                 from pyDOE import lhs
@@ -987,6 +1633,21 @@ class matk(object):
         sampler.run_mcmc(pos0, nsamples)
         return sampler.chain[:, burnin:, :].reshape((-1, len(self.parnames)))
 
+def _run_expr( aeval, node, exprstr ):
+    """ Run parsed expression with interpreter
+
+        :returns: tuple(any,str) -- value of expression and error message, value is None if the expression cannot be evaluated
+    """
+    aeval.error = []
+    aeval.errmsg = None
+    try:
+        v = aeval.run( node, expr=exprstr )
+    except RuntimeError:
+        v = None
+    if len(aeval.error):
+        return None, "\n".join(aeval.error[0].get_error())
+    return v, None
+
 class logposterior(object):
     def __init__(self, prob, var=1):
         self.prob = prob
@@ -1,5 +1,6 @@
 from lmfit.minimizer import Minimizer as LmfitMinimizer
 import numpy
+from time import time
 try:
     from collections import OrderedDict
 except ImportError:
@@ -68,49 +69,66 @@ class Minimizer(LmfitMinimizer):
             par.value = par.from_internal(val)
 
     def __jacobian( self, h=1.e-3, cpus=1, workdir_base=None,
-                    save=True, reuse_dirs=False ):
+                    save=True, reuse_dirs=False, method='central' ):
         ''' Numerical Jacobian calculation
 
             :param h: Parameter increment, single value or array with npar values
             :type h: fl64 or ndarray(fl64)
-            :returns: ndarray(fl64) -- Jacobian matrix
+            :param method: Finite difference method, 'forward' or 'central'
+            :type method: str
+            :returns: tuple(ndarray(fl64),int) -- Jacobian matrix of residuals and number of model runs
         '''
-        # Collect parameter sets
-        a = self.vars
-        # If current simulated values are associated with current parameter values...
-        if self._parent._current:
-            sims = self._parent.simvalues
-        if isinstance(h, (tuple,list)):
-            h = numpy.array(h)
-        elif not isinstance(h, numpy.ndarray):
-            h = numpy.ones(len(a))*h
-        hlmat = numpy.identity(len(self.vars))*-h
-        humat = numpy.identity(len(self.vars))*h
-        hmat = numpy.concatenate([hlmat,humat])
-        parset = []
-        for hs in hmat:
-            int_pars = self.__get_internal_parvalues(hs+a)
-            parset.append(int_pars)
-        parset = numpy.array(parset)
-        self._parent.create_sampleset(parset,name='_jac_')
-
-        self._parent.sampleset['_jac_'].run( cpus=cpus, verbose=False,
-                         workdir_base=workdir_base, save=save, reuse_dirs=reuse_dirs )
-        # Perform simulations on parameter sets
-        obs = self._parent.sampleset['_jac_'].responses.values
-        a_ls = obs[0:len(a)]
-        a_us = obs[len(a):]
-        J = []
-        for a_l,a_u,hs in zip(a_ls,a_us,h):
-            J.append((a_l-a_u)/(2*hs))
-        self._parent.parvalues = a
-        # If current simulated values are associated with current parameter values...
-        if self._parent._current:
-            self._parent._set_simvalues(sims)
-        return numpy.array(J).T
+        J, sims, nruns = self._parent._fd_jacobian( self.vars, h, method=method, topars=self.__get_internal_parvalues,
+                          cpus=cpus, workdir_base=workdir_base, save=save, reuse_dirs=reuse_dirs )
+        # Jacobian of residuals
+        return -J, nruns
+
+    def __lambda_search( self, deltas, bestSS, cpus=1 ):
+        ''' Evaluate parameter upgrades of increasing Marquardt lambdas in a single parallel sampleset run.
+            The first upgrade that improves the sum of squared residuals is selected, as it would be
+            by testing lambdas one at a time, otherwise the best upgrade.
+
+            :param deltas: Parameter upgrades, one for each lambda in increasing order
+            :type deltas: lst(ndarray(fl64))
+            :param bestSS: Sum of squared residuals to improve on
+            :type bestSS: fl64
+            :returns: tuple(int,ndarray(fl64),fl64) -- index of selected upgrade, its residuals and sum of squared residuals
+        '''
+        parset = numpy.array([self.__get_internal_parvalues(self.vars+d) for d in deltas])
+        self._parent.create_sampleset(parset,name='_lambda_')
+        self._parent.sampleset['_lambda_'].run( cpus=cpus, verbose=False, save=False )
+        self.nfev += len(deltas)
+        ss = self._parent.sampleset['_lambda_']
+        if ss.responses is None:
+            # All runs failed
+            out = numpy.empty((len(deltas),len(self._parent.obs)))
+            out.fill(numpy.nan)
+        else:
+            out = ss.responses.values
+        obsvalues = numpy.array(self._parent.obsvalues, dtype=float)
+        weights = numpy.array(self._parent.obsweights, dtype=float)
+        resids = (obsvalues - out)/weights
+        # Sum in the same order as matk.ssr
+        SSs = numpy.array([sum(rs**2) for rs in resids])
+        # Failed runs are never selected
+        SSs[numpy.isnan(SSs)] = numpy.inf
+        improved = numpy.where(SSs < bestSS)[0]
+        if len(improved): i = improved[0]
+        else: i = numpy.argmin(SSs)
+        if numpy.isinf(SSs[i]):
+            # No upgrade could be evaluated, keep current parameters
+            self.__set_internal_parvalues(self.vars)
+            self.update_constraints()
+            return i, resids[i], SSs[i]
+        # Set parameters and simulated values to selected upgrade
+        self.__set_internal_parvalues(self.vars+deltas[i])
+        self.update_constraints()
+        self._parent._set_simvalues(out[i])
+        self._parent._current = True
+        return i, resids[i], SSs[i]
 
     def calibrate( self, cpus=1, maxiter=100, lambdax=0.001, minchange=1.0e-16, minlambdax=1.0e-6, verbose=False,
-                  workdir=None, reuse_dirs=False, h=1.e-6):
+                  workdir=None, reuse_dirs=False, h=1.e-6, method='central', switch=0.1, broyden=0, nlambda=1):
         """ Calibrate MATK model using Levenberg-Marquardt algorithm based on 
             original code written by Ernesto P. Adorio PhD. 
             (UPDEPP at Clarkfield, Pampanga)
@@ -127,47 +145,76 @@ class Minimizer(LmfitMinimizer):
             :type minlambdax: fl4
             :param verbose: If True, additional information written to screen during calibration
             :type verbose: bool
-            :returns: best fit parameters found by routine
-            :returns: best Sum of squares.
-            :returns: covariance matrix
+            :param h: Parameter increment for finite difference Jacobian, single value or array with npar values
+            :type h: fl64 or ndarray(fl64)
+            :param method: Finite difference method for Jacobian, 'forward', 'central' or 'auto'. 'auto' uses forward differences until an iteration reduces the sum of squares by less than the fraction switch, and central differences after that
+            :type method: str
+            :param switch: Relative reduction in sum of squares below which 'auto' method switches to central differences
+            :type switch: fl64
+            :param broyden: Maximum number of successive iterations in which the Jacobian is updated with a Broyden rank-one correction from the residuals of the last step instead of being recomputed by finite differences; the Jacobian is also recomputed when a step based on an updated Jacobian fails. If 0, the Jacobian is recomputed every iteration
+            :type broyden: int
+            :param nlambda: Number of Marquardt lambdas tested in each iteration. If greater than 1, parameter upgrades for lambda*10**k, k=0,...,nlambda-1, are evaluated in a single parallel run and the upgrade with the smallest lambda that improves the sum of squares is used
+            :type nlambda: int
+            :returns: CalibrationResult object
         """
+        t0 = time()
+        res = CalibrationResult()
         self.prepare_fit()
-        
+
         n = len(self._parent.obs) # Number of observations
         m = len(self._parent.pars) # Number of parameters
         #a = self.vars # Initial parameter values
         besta = self.vars # Best parameters start as current parameters
-        self.__residual(self.vars)
+        t = time()
+        r = numpy.array(self.__residual(self.vars))
+        res.times['upgrade'] += time()-t
+        sims = self._parent.simvalues
         bestSS = SS = self._parent.ssr # Sum of squared error
+        res.history.append({'iteration':0, 'ssr':SS, 'lambda':lambdax, 'parvalues':self._parent.parvalues, 'step':0., 'accepted':True})
         Cov = None
         iscomp = True
         ncount = 0
         flag   = 0
+        if method == 'auto': jac_method = 'forward'
+        else: jac_method = method
+        nbroyden = 0 # Number of successive Broyden updates
         for p in range(1, maxiter+1):
             if verbose: print "marquardt(): iteration=", p
             # If iscomp, recalculate JtJ and beta
             if (iscomp) :
-                # Compute Jacobian
-                J = self.__jacobian( cpus=cpus, h=h )
+                # Compute Jacobian, unless updated with Broyden correction
+                if nbroyden == 0:
+                    t = time()
+                    J, nruns = self.__jacobian( cpus=cpus, h=h, method=jac_method )
+                    res.times['jacobian'] += time()-t
+                    res.njev += 1
+                    res.jac_runs += nruns
                 # Compute Hessian
                 JtJ = numpy.dot(J.T,J)
                 if (lambdax == 0.0) :
                     break
-                # Form RHS beta vector
-                r = numpy.array(self.__residual(self.vars))
+                # Form RHS beta vector from residuals at current parameters
                 beta = -numpy.dot(J.T,r)
 
-            # Update A with new lambdax
-            A = JtJ * (numpy.ones(m) + numpy.identity(m)*lambdax)
+            # Lambdas to test
+            lambdas = [lambdax]
+            for k in range(1,nlambda): lambdas.append(10.0 * lambdas[-1])
 
-            # Solve for delta
+            # Solve for delta of each lambda
+            t = time()
             try:
-                delta = numpy.linalg.solve(A, beta)
+                deltas = []
+                for l in lambdas:
+                    # Update A with new lambdax
+                    A = JtJ * (numpy.ones(m) + numpy.identity(m)*l)
+                    deltas.append(numpy.linalg.solve(A, beta))
+                delta = deltas[0]
             except numpy.linalg.linalg.LinAlgError as err:
                 print "Error: Unable to solve for update vector - " + str(err)
                 break
             else:
                 code=0
+            res.times['solve'] += time()-t
             totabsdelta = numpy.sum(numpy.abs(delta))
             if verbose:
                 print "JtJ:"
@@ -180,24 +227,56 @@ class Minimizer(LmfitMinimizer):
                     print 'Cov: '
                     print Cov
                 print "beta = ", beta
-                print "delta=", delta
+                print "delta=", delta if len(deltas) == 1 else deltas
                 print "SS =",SS
-                print "lambdax=", lambdax
+                print "lambdax=", lambdax if len(lambdas) == 1 else lambdas
                 print "total abs delta=", totabsdelta
             if (code == 0):
-                # Compute new parameters
-                newa = self.vars + delta
-                # and new sum of squares
-                self.__residual(newa)
-                newSS = self._parent.ssr
+                t = time()
+                if len(lambdas) == 1:
+                    # Compute new parameters
+                    newa = self.vars + delta
+                    # and new sum of squares
+                    newr = numpy.array(self.__residual(newa))
+                    newSS = self._parent.ssr
+                else:
+                    # Compute new parameters and sums of squares of all lambdas concurrently
+                    i, newr, newSS = self.__lambda_search( deltas, bestSS, cpus=cpus )
+                    delta = deltas[i]
+                    newa = self.vars + delta
+                    if newSS < bestSS: 
+                        lambdax = lambdas[i]
+                        # Upgrades with smaller lambdas failed
+                        if i > 0: ncount = 0
+                    # The failed step below increases lambda beyond the largest lambda tested, 
+                    # or retries the lambdas with a recomputed Jacobian after Broyden updates
+                    elif nbroyden == 0: lambdax = lambdas[-1]
+                    else: lambdax = lambdas[0]
+                    if verbose: print "lambdax = ", lambdas[i]
+                res.times['upgrade'] += time()-t
+                lambda_tested = lambdas[i] if len(lambdas) > 1 else lambdax
                 if verbose: print "newSS = ", newSS
+                res.history.append({'iteration':p, 'ssr':newSS, 'lambda':lambda_tested, 'parvalues':self._parent.parvalues, 
+                                    'step':numpy.linalg.norm(delta), 'accepted':newSS < bestSS})
                 # Update current parameter vector?
                 if (newSS < bestSS):
                     if verbose: print "improved values found!"
+                    # Switch to central differences once progress slows
+                    if method == 'auto' and jac_method == 'forward' and (SS - newSS) < switch*SS:
+                        if verbose: print "switching to central differences"
+                        jac_method = 'central'
+                    # Broyden rank-one update of Jacobian
+                    if nbroyden < broyden:
+                        J = J + numpy.outer(newr - r - numpy.dot(J,delta), delta)/numpy.dot(delta,delta)
+                        nbroyden += 1
+                        res.nupdates += 1
+                    else: nbroyden = 0
                     besta  = newa
                     bestSS = newSS
                     bestJtJ = JtJ
                     self.vars = newa
+                    r = newr
+                    sims = self._parent.simvalues
                     iscomp = True
                     if verbose:
                         print "new a:"
@@ -218,10 +297,22 @@ class Minimizer(LmfitMinimizer):
                             flag = 3
                             break
                     SS = newSS
+                elif nbroyden > 0:
+                    # Recompute Jacobian if step based on updated Jacobian fails
+                    if verbose: print "recomputing Jacobian"
+                    self.__set_internal_parvalues(self.vars)
+                    self._parent._set_simvalues(sims)
+                    self._parent._current = True
+                    nbroyden = 0
+                    iscomp = True
                 else :
                     iscomp = False
                     lambdax = 10.0 * lambdax
                     ncount = 0
+                    # Stop if lambda is so large that upgrades no longer change parameters
+                    if numpy.all(self.vars + deltas[-1] == self.vars):
+                        flag = 0
+                        break
             else :
                 flag = 1
                 break
@@ -229,7 +320,19 @@ class Minimizer(LmfitMinimizer):
             if Cov is None: flag = 4
             if (p >= maxiter) :
                 flag = 2
+        t = time()
         self.__residual(besta)
+        res.times['upgrade'] += time()-t
+        res.flag = flag
+        res.parvalues = self._parent.parvalues
+        res.ssr = self._parent.ssr
+        res.jacobian = -J
+        try:
+            res.covariance = numpy.linalg.inv(JtJ)
+        except numpy.linalg.linalg.LinAlgError:
+            res.covariance = None
+        res.nfev = self.nfev
+        res.times['total'] = time()-t0
         if verbose:
             print 'Parameter: '
             print self._parent.parvalues
@@ -243,5 +346,127 @@ class Minimizer(LmfitMinimizer):
             else:
                 print 'Cov: '
                 print Cov
+        return res
 
-
+class CalibrationResult(object):
+    """ MATK calibration result class - Final parameter values, sum of squared residuals,
+        Jacobian and covariance of a calibration along with the history of its iterations,
+        the number of model runs and the time spent in each phase
+    """
+    def __init__(self):
+        self.history = []
+        self.parvalues = None
+        self.ssr = None
+        self.jacobian = None
+        self.covariance = None
+        self.flag = None
+        self.nfev = 0
+        self.jac_runs = 0
+        self.njev = 0
+        self.nupdates = 0
+        self.times = OrderedDict([('jacobian',0.),('solve',0.),('upgrade',0.),('total',0.)])
+    @property
+    def history(self):
+        """ List of dictionaries, one for the initial parameters and one for each parameter upgrade, 
+            with keys 'iteration', 'ssr' (sum of squared residuals), 'lambda' (Marquardt lambda), 
+            'parvalues' (parameter values), 'step' (norm of parameter upgrade) and 'accepted' 
+            (True if the upgrade reduced the sum of squared residuals)
+        """
+        return self._history
+    @history.setter
+    def history(self,value):
+        self._history = value
+    @property
+    def parvalues(self):
+        """ Calibrated parameter values
+        """
+        return self._parvalues
+    @parvalues.setter
+    def parvalues(self,value):
+        self._parvalues = value
+    @property
+    def ssr(self):
+        """ Sum of squared residuals of calibrated parameter values
+        """
+        return self._ssr
+    @ssr.setter
+    def ssr(self,value):
+        self._ssr = value
+    @property
+    def jacobian(self):
+        """ Jacobian (derivatives of simulated values with respect to internal parameter values) 
+            used for the last parameter upgrade, one row per observation
+        """
+        return self._jacobian
+    @jacobian.setter
+    def jacobian(self,value):
+        self._jacobian = value
+    @property
+    def covariance(self):
+        """ Parameter covariance matrix, inverse of J^T J of the last Jacobian, None if singular
+        """
+        return self._covariance
+    @covariance.setter
+    def covariance(self,value):
+        self._covariance = value
+    @property
+    def flag(self):
+        """ Termination flag: 0 - converged, 1 - singular matrix, 2 - maximum iterations reached, 
+            3 - lambda below minimum, 4 - covariance not computed
+        """
+        return self._flag
+    @flag.setter
+    def flag(self,value):
+        self._flag = value
+    @property
+    def nfev(self):
+        """ Number of model runs for parameter upgrades
+        """
+        return self._nfev
+    @nfev.setter
+    def nfev(self,value):
+        self._nfev = value
+    @property
+    def jac_runs(self):
+        """ Number of model runs for finite difference Jacobians
+        """
+        return self._jac_runs
+    @jac_runs.setter
+    def jac_runs(self,value):
+        self._jac_runs = value
+    @property
+    def njev(self):
+        """ Number of finite difference Jacobians
+        """
+        return self._njev
+    @njev.setter
+    def njev(self,value):
+        self._njev = value
+    @property
+    def nupdates(self):
+        """ Number of Broyden updates of Jacobian
+        """
+        return self._nupdates
+    @nupdates.setter
+    def nupdates(self,value):
+        self._nupdates = value
+    @property
+    def nruns(self):
+        """ Total number of model runs
+        """
+        return self.nfev + self.jac_runs
+    @property
+    def times(self):
+        """ Wall times in seconds of the 'jacobian', 'solve' and 'upgrade' phases and the 'total' calibration
+        """
+        return self._times
+    @times.setter
+    def times(self,value):
+        self._times = value
+    def __repr__(self):
+        s = 'Flag: ' + str(self.flag) + '\n'
+        s += 'SSR: ' + str(self.ssr) + '\n'
+        s += 'Iterations: ' + str(len(self.history)-1) + '\n'
+        s += 'Model runs: ' + str(self.nruns) + ' (' + str(self.jac_runs) + ' Jacobian, ' + str(self.nfev) + ' upgrade)\n'
+        s += 'Parameters: ' + str(self.parvalues) + '\n'
+        return s
@@ -1,13 +1,183 @@
 ''' Utilities to handle reading and writing PEST files '''
 from lmfit.asteval import Interpreter
 from glob import glob
+import os
 import re
+import mmap
+import numpy
 from numpy import recarray, array
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
+_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$') # Expressions that are parameter names
+_templates = {} # Templates read from files keyed by absolute file name
+_instructions = {} # Instructions read from files keyed by absolute file name
+_mmap_bytes = 1<<20 # Model output files larger than this are memory mapped
+_cols = re.compile(r'\s*(\d+)\s*:\s*(\d+)') # Columns of fixed and semi-fixed observations
+_item = re.compile(r'\S+')
+_ws = re.compile(r'[ \t\r]+')
+_tok = re.compile(r'[ \t\r]*([^ \t\r\n]+)')
+
+class Template(object):
+    ''' MATK PEST template class - PEST template file parsed once into literal text and compiled 
+        parameter expressions, so that model input files can be written for many parameter sets 
+        without re-reading and re-parsing the template
+
+        :param f: File handle or file name of PEST template file
+        :type f: str or file handle
+    '''
+    def __init__( self, f ):
+        self._literals = None
+        self._exprs = []
+        self._aeval = Interpreter()
+        # Symbols of the interpreter, restored after each render
+        self._symbols = dict(self._aeval.symtable)
+        # Check if f is a string or file and read in lines
+        if isinstance( f, file ): 
+            t = f.read()
+            self._filename = f.name
+            f.close()
+        elif isinstance( f, str ): 
+            self._filename = f
+            with open( f, 'r') as fh:
+                t = fh.read()
+                fh.close()
+
+        # Make sure file is PEST TPL file
+        lh = t.split('\n')[0]
+        k = lh.split()
+        if k[0] != 'ptf':
+            print self._filename+" does not appear to be a PEST template file"
+            return
+        self._marker = k[1] # Collect parameter identifier character
+        t = re.sub( lh+'\n', '', t)
+
+        # Split text into literal text and parameter expressions between pairs of markers
+        parts = t.split(self._marker)
+        if len(parts) % 2 == 0:
+            # Unmatched marker is literal text
+            parts[-2:] = [parts[-2]+self._marker+parts[-1]]
+        self._literals = parts[0::2]
+        for pstr in parts[1::2]:
+            pstr = pstr.strip()
+            if _name.match(pstr): node = None
+            else: node = self._aeval.parse(pstr)
+            self._exprs.append((pstr,node))
+    @property
+    def filename(self):
+        ''' Name of template file
+        '''
+        return self._filename
+    @property
+    def marker(self):
+        ''' Parameter identifier character
+        '''
+        return self._marker
+    @property
+    def expressions(self):
+        ''' List of parameter expressions in order of appearance in template
+        '''
+        return [pstr for pstr,node in self._exprs]
+    def render( self, pardict ):
+        ''' Create text of model input file
+
+            :param pardict: Dictionary of parameter values
+            :type pardict: dict
+            :returns: str -- text of model input file, None if a parameter is missing from pardict or an expression cannot be evaluated
+        '''
+        if self._literals is None: return None
+        symtable = self._aeval.symtable
+        for k,v in pardict.items():
+            symtable[k] = v
+        try:
+            vs = []
+            for pstr,node in self._exprs:
+                if node is None:
+                    if pstr not in pardict:
+                        print "Error: Parameter "+pstr+" in template file "+self._filename+" is not in parameter dictionary"
+                        return None
+                    vs.append(str(pardict[pstr]))
+                else:
+                    v = self._evaluate(pstr,node)
+                    if v is None:
+                        print "Error: Expression "+pstr+" in template file "+self._filename+" could not be evaluated"
+                        return None
+                    vs.append(str(v))
+        finally:
+            # Remove parameter values, so that they are not used by later renders
+            for k in pardict.keys():
+                if k in self._symbols: symtable[k] = self._symbols[k]
+                else: symtable.pop(k, None)
+        out = [None]*(2*len(vs)+1)
+        out[0::2] = self._literals
+        out[1::2] = vs
+        return ''.join(out)
+    def write( self, pardict, outflnm ):
+        ''' Write model input file
+
+            :param pardict: Dictionary of parameter values
+            :type pardict: dict
+            :param outflnm: Name of model input file to be written
+            :type outflnm: str
+        '''
+        t = self.render( pardict )
+        if t is None: return
+        fout = open( outflnm, 'w' )
+        fout.write(t)
+        fout.close()
+    def write_batch( self, parsets, outflnms, parnames=None ):
+        ''' Write a model input file for each of a number of parameter sets
+
+            :param parsets: Parameter sets, either dictionaries of parameter values or rows of parameter values in order of parnames
+            :type parsets: lst(dict) or ndarray(fl64)
+            :param outflnms: Names of model input files, one per parameter set; alternatively, a file name containing '%d', which is replaced by the parameter set number starting at 1
+            :type outflnms: lst(str) or str
+            :param parnames: Parameter names of columns of parsets, required if parsets are not dictionaries
+            :type parnames: lst(str)
+            :returns: lst(str) -- names of files written
+        '''
+        if isinstance( outflnms, str ):
+            outflnms = [outflnms % (i+1) for i in range(len(parsets))]
+        if not len(outflnms) == len(parsets):
+            print "Error: Number of file names ("+str(len(outflnms))+") does not match number of parameter sets ("+str(len(parsets))+")"
+            return
+        for pars,outflnm in zip(parsets,outflnms):
+            if not isinstance( pars, dict ):
+                if parnames is None:
+                    print "Error: Parameter names required for parameter sets that are not dictionaries"
+                    return
+                pars = dict(zip(parnames,pars))
+            self.write( pars, outflnm )
+        return outflnms
+    def _evaluate( self, pstr, node ):
+        if node is None: node = self._aeval.parse(pstr)
+        self._aeval.error = []
+        try:
+            return self._aeval.run( node, expr=pstr )
+        except RuntimeError:
+            if len(self._aeval.error) > 0:
+                print "\n".join(self._aeval.error[0].get_error())
+            return None
+
+def template( f ):
+    ''' Get PEST template object of template file. Templates read from file names are cached 
+        and only read again if the file is modified.
+
+        :param f: File handle or file name of PEST template file
+        :type f: str or file handle
+        :returns: Template object
+    '''
+    if not isinstance( f, str ): return Template( f )
+    st = os.stat( f )
+    key = os.path.abspath( f )
+    t = _templates.get( key )
+    if t is None or not t[0] == (st.st_mtime, st.st_size):
+        t = ((st.st_mtime, st.st_size), Template( f ))
+        _templates[key] = t
+    return t[1]
+
 def tpl_write( pardict, f, outflnm ):
     ''' Write model input file using PEST template file
 
@@ -18,49 +188,245 @@ def tpl_write( pardict, f, outflnm ):
         :param outflnm: Name of model input file to be written
         :type outflnm: str
     '''
-    # Check if f is a string or file and read in lines
-    if isinstance( f, file ): 
-        t = f.read()
-        fnm = f.name
-        f.close()
-    elif isinstance( f, str ): 
-        fnm = f
-        with open( f, 'r') as fh:
-            t = fh.read()
-            fh.close()
-
-    # Make sure file is PEST TPL file
-    lh = t.split('\n')[0]
-    k = lh.split()
-    if k[0] != 'ptf':
-        print fnm+" does not appear to be a PEST template file"
-        return
-    else: 
-        tok = k[1] # Collect parameter identifier character
-        t = re.sub( lh+'\n', '', t)
+    template( f ).write( pardict, outflnm )
+
+def tpl_write_batch( parsets, f, outflnms, parnames=None ):
+    ''' Write model input files for a number of parameter sets using PEST template file
 
-    # Complile regex pattern
-    p = re.compile(tok+'[^'+tok+']*'+tok)
-    # Find all parameter identifiers in file
-    ms = p.findall(t)
-    pd = {} # Pattern dictionary
-    # Create evaluation interpreter
-    aeval = Interpreter()
-    for k,v in pardict.items():
-        aeval.symtable[k] = v
-    # Evaluate all unique expressions
-    for m in ms:
-        pstr = m.split(tok)[1].strip()
-        if pstr not in pd:
-            pd[m] = aeval(pstr)
-    # Perform substitutions
-    for k,v in pd.items():
-        t = re.sub( re.escape(k), str(v), t)
-
-    # Write output file
-    fout = open( outflnm, 'w' )
-    fout.write(t)
-    fout.close()
+        :param parsets: Parameter sets, either dictionaries of parameter values or rows of parameter values in order of parnames
+        :type parsets: lst(dict) or ndarray(fl64)
+        :param f: File handle or file name of PEST template file
+        :type f: str or file handle
+        :param outflnms: Names of model input files, one per parameter set; alternatively, a file name containing '%d', which is replaced by the parameter set number starting at 1
+        :type outflnms: lst(str) or str
+        :param parnames: Parameter names of columns of parsets, required if parsets are not dictionaries
+        :type parnames: lst(str)
+        :returns: lst(str) -- names of files written
+    '''
+    return template( f ).write_batch( parsets, outflnms, parnames=parnames )
+
+class Instruction(object):
+    ''' MATK PEST instruction class - PEST instruction file compiled once into a list of operations
+        (line advances, primary and secondary markers, whitespace and tab moves, and fixed, 
+        semi-fixed and non-fixed observations) that is applied to model output files to extract 
+        simulated values
+
+        :param f: File handle or file name of PEST instruction file
+        :type f: str or file handle
+    '''
+    def __init__( self, f ):
+        self._ops = None
+        self._obsnames = []
+        # Check if f is a string or file and read in lines
+        if isinstance( f, file ): 
+            t = f.read()
+            self._filename = f.name
+            f.close()
+        elif isinstance( f, str ): 
+            self._filename = f
+            with open( f, 'r') as fh:
+                t = fh.read()
+                fh.close()
+
+        # Make sure file is PEST INS file
+        lines = t.splitlines()
+        k = lines[0].split()
+        if k[0] != 'pif':
+            print self._filename+" does not appear to be a PEST instruction file"
+            return
+        self._marker = k[1] # Collect marker delimiter
+        # Join lines starting with & to the preceding instruction line
+        joined = []
+        for i,l in enumerate(lines[1:]):
+            if l.lstrip().startswith('&') and len(joined):
+                joined[-1][1] += ' '+l.lstrip()[1:]
+            else:
+                joined.append([i+2,l])
+        self._ops = []
+        for lineno,l in joined:
+            self._ops.extend( self._compile( l, lineno ) )
+        self._obsnames = [op[1] for op in self._ops if op[0] in ['obs','fixed','semifixed'] and not op[1] == 'dum']
+    @property
+    def filename(self):
+        ''' Name of instruction file
+        '''
+        return self._filename
+    @property
+    def marker(self):
+        ''' Marker delimiter character
+        '''
+        return self._marker
+    @property
+    def obsnames(self):
+        ''' List of observation names in order of appearance in instruction file
+        '''
+        return self._obsnames
+    def read( self, outflnm, obsnames=None ):
+        ''' Extract simulated values from model output file
+
+            :param outflnm: Name of model output file
+            :type outflnm: str
+            :param obsnames: Observation names in order of returned values, e.g. matk.obsnames; observations not in the instruction file are NaN. If None, Instruction.obsnames is used
+            :type obsnames: lst(str)
+            :returns: ndarray(fl64) -- simulated values
+        '''
+        if self._ops is None: return None
+        f = open( outflnm, 'rb' )
+        try:
+            # Map large files into memory instead of reading them
+            if os.fstat( f.fileno() ).st_size > _mmap_bytes:
+                buf = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            else:
+                buf = f.read()
+            vals = self._apply( buf, outflnm )
+        finally:
+            f.close()
+        vals = numpy.array( vals )
+        if obsnames is None or obsnames == self._obsnames: return vals
+        # Reorder values to obsnames
+        pos = dict([(nm,i) for i,nm in enumerate(self._obsnames)])
+        out = numpy.empty( len(obsnames) )
+        out.fill( numpy.nan )
+        for i,nm in enumerate(obsnames):
+            j = pos.get(nm)
+            if j is not None: out[i] = vals[j]
+        return out
+    def _compile( self, l, lineno ):
+        # Compile instruction line into list of operations
+        ops = []
+        pos = 0
+        n = len(l)
+        primary = True # Markers are primary until an item other than a line advance
+        while pos < n:
+            c = l[pos]
+            if c.isspace():
+                pos += 1
+                continue
+            if c in [self._marker,'!','[','(']:
+                close = {'!':'!','[':']','(':')'}.get(c, self._marker)
+                end = l.find( close, pos+1 )
+                if end < 0:
+                    raise ValueError( "Unmatched "+c+" in line "+str(lineno)+" of "+self._filename )
+                text = l[pos+1:end]
+                pos = end+1
+                if c == self._marker and primary:
+                    # Primary markers preceded by a line advance are searched for from the current line
+                    ops.append( ('primary', text, len(ops) > 0) )
+                elif c == self._marker:
+                    ops.append( ('secondary', text) )
+                elif c == '!':
+                    ops.append( ('obs', text.strip().lower() if text.strip().lower() == 'dum' else text.strip()) )
+                else:
+                    m = _cols.match( l, pos )
+                    if m is None:
+                        raise ValueError( "Missing columns of observation "+text+" in line "+str(lineno)+" of "+self._filename )
+                    pos = m.end()
+                    ops.append( ('fixed' if c == '[' else 'semifixed', text.strip(), int(m.group(1)), int(m.group(2))) )
+                primary = False
+                continue
+            m = _item.match( l, pos )
+            item = m.group(0)
+            pos = m.end()
+            if item[0] in 'lL' and item[1:].isdigit():
+                ops.append( ('l', int(item[1:])) )
+                continue
+            elif item in ['w','W']:
+                ops.append( ('w',) )
+            elif item[0] in 'tT' and item[1:].isdigit():
+                ops.append( ('t', int(item[1:])) )
+            else:
+                raise ValueError( "Unknown instruction "+item+" in line "+str(lineno)+" of "+self._filename )
+            primary = False
+        if len(ops) and not ops[0][0] in ['l','primary']:
+            raise ValueError( "Line "+str(lineno)+" of "+self._filename+" does not start with a line advance or primary marker" )
+        return ops
+    def _apply( self, buf, outflnm ):
+        # Apply operations to text of model output file, cur is the cursor position and 
+        # ls, le, nl are the start and end of the current line and the start of the next line
+        vals = []
+        size = len(buf)
+        ls = le = cur = None
+        nl = 0
+        for op in self._ops:
+            kind = op[0]
+            if kind == 'l':
+                for i in range(op[1]):
+                    if nl > size: raise ValueError( "Unexpected end of file in "+outflnm )
+                    ls = nl
+                    le = buf.find( '\n', ls )
+                    if le < 0: le = size
+                    nl = le+1
+                cur = ls
+            elif kind == 'primary':
+                # Search from current line if preceded by a line advance, otherwise from next line
+                i = buf.find( op[1], ls if op[2] else nl )
+                if i < 0: raise ValueError( "Marker "+op[1]+" not found in "+outflnm )
+                ls = buf.rfind( '\n', 0, i )+1
+                le = buf.find( '\n', i )
+                if le < 0: le = size
+                nl = le+1
+                cur = i+len(op[1])
+            elif kind == 'secondary':
+                i = buf.find( op[1], cur, le )
+                if i < 0: raise ValueError( "Marker "+op[1]+" not found on line starting at byte "+str(ls)+" of "+outflnm )
+                cur = i+len(op[1])
+            elif kind == 'w':
+                m = _ws.search( buf, cur, le )
+                if m is None: raise ValueError( "No whitespace after byte "+str(cur)+" of "+outflnm )
+                cur = m.end()
+            elif kind == 't':
+                cur = ls+op[1]-1
+            elif kind == 'fixed':
+                v = _float( buf[ls+op[2]-1:min(ls+op[3],le)], op[1], outflnm )
+                if not op[1] == 'dum': vals.append( v )
+                cur = ls+op[3]
+            else:
+                if kind == 'obs': start = cur
+                else: start = ls+op[2]-1
+                m = _tok.match( buf, start, le )
+                if m is None: raise ValueError( "Value of observation "+op[1]+" not found in "+outflnm )
+                v = _float( m.group(1), op[1], outflnm )
+                if not op[1] == 'dum': vals.append( v )
+                cur = m.end()
+        return vals
+
+def _float( s, obsnm, outflnm ):
+    try:
+        return float(s)
+    except ValueError:
+        # Fortran double precision exponent
+        try: return float(s.strip().replace('D','E').replace('d','e'))
+        except ValueError: raise ValueError( "Value "+s.strip()+" of observation "+obsnm+" in "+outflnm+" is not a number" )
+
+def instruction( f ):
+    ''' Get PEST instruction object of instruction file. Instructions read from file names are cached 
+        and only read again if the file is modified.
+
+        :param f: File handle or file name of PEST instruction file
+        :type f: str or file handle
+        :returns: Instruction object
+    '''
+    if not isinstance( f, str ): return Instruction( f )
+    st = os.stat( f )
+    key = os.path.abspath( f )
+    t = _instructions.get( key )
+    if t is None or not t[0] == (st.st_mtime, st.st_size):
+        t = ((st.st_mtime, st.st_size), Instruction( f ))
+        _instructions[key] = t
+    return t[1]
+
+def ins_read( f, outflnm, obsnames=None ):
+    ''' Extract simulated values from model output file using PEST instruction file
+
+        :param f: File handle or file name of PEST instruction file
+        :type f: str or file handle
+        :param outflnm: Name of model output file
+        :type outflnm: str
+        :param obsnames: Observation names in order of returned values, e.g. matk.obsnames; observations not in the instruction file are NaN. If None, observations are in order of the instruction file
+        :type obsnames: lst(str)
+        :returns: ndarray(fl64) -- simulated values
+    '''
+    return instruction( f ).read( outflnm, obsnames=obsnames )
 
 def read_par_files( *files ):
     ''' Read in one or more PEST parameter files
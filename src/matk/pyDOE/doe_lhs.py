@@ -22,7 +22,9 @@ def lhs(n, samples=None, criterion=None, iterations=None):
         given, the design is simply randomized.
     iterations : int
         The number of iterations in the maximin and correlations algorithms
-        (Default: 5).
+        (Default: 5). The maximin designs are optimized with the enhanced 
+        stochastic evolutionary algorithm, where this is the number of outer 
+        iterations.
     
     Returns
     -------
@@ -147,21 +149,122 @@ def _lhscentered(n, samples):
 ################################################################################
 
 def _lhsmaximin(n, samples, iterations, lhstype):
-    maxdist = 0
-    
     # Maximize the minimum distance between points
-    for i in xrange(iterations):
-        if lhstype=='maximin':
-            Hcandidate = _lhsclassic(n, samples)
+    if lhstype=='maximin':
+        H = _lhsclassic(n, samples)
+    else:
+        H = _lhscentered(n, samples)
+    
+    return _lhsese(H, iterations)
+
+################################################################################
+
+def _lhsese(H, iterations, p=10):
+    """
+    Optimize a latin-hypercube design for the phi_p space-filling criterion 
+    (maximin as p goes to infinity) with the enhanced stochastic evolutionary 
+    algorithm (Jin, Chen and Sudjianto, 2005). Designs are changed by 
+    exchanging two elements of a column, so that they remain latin-hypercubes
+    and phi_p is updated from the distances of the two exchanged points only.
+    
+    Parameters
+    ----------
+    H : 2d-array
+        An m-by-n latin-hypercube design
+    iterations : int
+        The number of outer iterations
+    
+    Optional
+    --------
+    p : int
+        The exponent of the phi_p criterion (Default: 10)
+    
+    Returns
+    -------
+    H : 2d-array
+        The optimized design
+    """
+    m, n = H.shape
+    if m<3:
+        return H
+    H = H.copy()
+    # Squared distances between points, scaled by the minimum to avoid overflow
+    # in the phi_p terms
+    D = _sqdist(H)
+    scale = np.min(D[np.triu_indices(m, 1)])
+    D /= scale
+    np.fill_diagonal(D, np.inf)
+    F = D**(-p/2.)
+    phi = F.sum()/2.
+    best = phi
+    Hbest = H.copy()
+    
+    npairs = m*(m - 1)/2
+    J = int(min(npairs/5, 50))
+    J = max(J, 1)
+    M = int(min(2*npairs*n/J, 100))
+    T = 0.005*phi**(1./p)
+    rows = np.arange(J)
+    for it in xrange(iterations):
+        best_old = best
+        nacpt = 0
+        nimp = 0
+        for i in xrange(M):
+            k = i % n
+            # Try J element exchanges in column k
+            i1 = np.random.randint(m, size=J)
+            i2 = (i1 + np.random.randint(1, m, size=J)) % m
+            x1 = H[i1, k][:, None]
+            x2 = H[i2, k][:, None]
+            delta = ((x2 - H[:, k])**2 - (x1 - H[:, k])**2)/scale
+            D1 = D[i1] + delta
+            D2 = D[i2] - delta
+            # The distance between the exchanged points does not change, it is
+            # counted in the terms of the first point only
+            D1[rows, i1] = np.inf
+            D1[rows, i2] = D[i1, i2]
+            D2[rows, i2] = np.inf
+            D2[rows, i1] = np.inf
+            F1 = D1**(-p/2.)
+            F2 = D2**(-p/2.)
+            Fnew = F1.sum(axis=1) + F2.sum(axis=1)
+            phis = phi - F[i1].sum(axis=1) - F[i2].sum(axis=1) + F[i1, i2] + Fnew
+            # Terms of the exchanged points are a lower bound in case of round-off
+            phis = np.maximum(phis, Fnew)
+            j = np.argmin(phis)
+            phitry = phis[j]
+            # Threshold acceptance
+            if phitry**(1./p) - phi**(1./p) <= T*np.random.rand():
+                a, b = i1[j], i2[j]
+                H[a, k], H[b, k] = H[b, k], H[a, k]
+                D[a], D[b] = D1[j], D2[j]
+                D[b, a] = D[a, b]
+                D[:, a], D[:, b] = D[a], D[b]
+                F[a], F[b] = F1[j], F2[j]
+                F[b, a] = F[a, b]
+                F[:, a], F[:, b] = F[a], F[b]
+                phi = phitry
+                nacpt += 1
+                if phi<best:
+                    best = phi
+                    Hbest = H.copy()
+                    nimp += 1
+        # Recompute phi_p to avoid accumulation of round-off errors
+        phi = F.sum()/2.
+        # Update threshold, improving or exploring
+        acpt = float(nacpt)/M
+        if best<best_old:
+            if acpt>0.1 and nimp<nacpt:
+                T *= 0.8
+            elif acpt<=0.1:
+                T /= 0.8
         else:
-            Hcandidate = _lhscentered(n, samples)
-        
-        d = _pdist(Hcandidate)
-        if maxdist<np.min(d):
-            maxdist = np.min(d)
-            H = Hcandidate.copy()
+            if acpt<0.1:
+                T /= 0.7
+            elif acpt>0.8:
+                T *= 0.9
     
-    return H
+    return Hbest
 
 ################################################################################
 
@@ -220,10 +323,24 @@ def _pdist(x):
     if m<2:
         return []
     
-    d = []
-    for i in xrange(n - 1):
-        for j in xrange(i + 1, n):
-            d.append((sum((x[j, :] - x[i, :])**2))**0.5)
+    # Distances of each point to the points after it
+    d = np.empty(m*(m - 1)/2)
+    k = 0
+    for i in xrange(m - 1):
+        d[k:k + m - i - 1] = np.sqrt(((x[i + 1:] - x[i])**2).sum(axis=1))
+        k += m - i - 1
     
-    return np.array(d)
+    return d
+
+################################################################################
+
+def _sqdist(x):
+    """
+    Calculate the m-by-m matrix of squared pair-wise point distances of an
+    m-by-n matrix
+    """
+    sq = (x**2).sum(axis=1)
+    D = sq[:, None] + sq[None, :] - 2*np.dot(x, x.T)
+    np.maximum(D, 0, D)
+    return D
 
@@ -0,0 +1,184 @@
+''' Low-discrepancy (quasi-Monte Carlo) sequences: Sobol and Halton '''
+import numpy
+
+# Number of bits of Sobol points
+_bits = 52
+
+# Initial direction numbers m_k of dimensions 2-40 (Joe and Kuo, 2008) in order of primitive polynomials
+_joe_kuo = [
+    [1], [1,3], [1,3,1], [1,1,1], [1,1,3,3], [1,3,5,13], [1,1,5,5,17], [1,1,5,5,5],
+    [1,1,7,11,19], [1,1,5,1,1], [1,1,1,3,11], [1,3,5,5,31], [1,3,3,9,7,49], [1,1,1,15,21,21],
+    [1,3,1,13,27,49], [1,1,1,15,7,5], [1,3,1,15,13,25], [1,1,5,5,19,61], [1,3,7,11,23,15,103],
+    [1,3,7,13,13,15,69], [1,1,3,13,7,35,63], [1,3,5,9,1,25,53], [1,3,1,13,9,35,107],
+    [1,3,1,5,27,61,31], [1,1,5,11,19,41,61], [1,3,5,3,3,13,69], [1,1,7,13,1,19,1],
+    [1,3,7,5,13,19,59], [1,1,3,9,25,29,41], [1,3,5,13,23,1,55], [1,3,7,3,13,59,17],
+    [1,3,1,3,5,53,69], [1,1,5,5,23,33,13], [1,1,7,7,1,61,123], [1,1,7,9,13,61,49],
+    [1,3,3,5,3,55,33], [1,3,1,15,31,13,49,245], [1,3,5,15,31,59,63,97], [1,3,1,11,11,11,77,249]]
+
+def sobol(n, d, skip=0, scramble=False, seed=None):
+    """ Points of the Sobol sequence in the d-dimensional unit hypercube. Points are computed
+        from their index in the sequence, so that a sequence can be continued by skipping
+        the points generated before with the same seed.
+
+        :param n: Number of points
+        :type n: int
+        :param d: Number of dimensions
+        :type d: int
+        :param skip: Number of initial points of the sequence to skip. The first point is the origin, which is mapped to the lower bound of distributions; skip it or scramble for unbounded distributions
+        :type skip: int
+        :param scramble: If True, the sequence is randomized with a linear matrix scramble and digital shift
+        :type scramble: bool
+        :param seed: Random seed of scrambling
+        :type seed: int
+        :returns: ndarray(fl64) -- n by d array of points
+    """
+    V = _sobol_directions(d)
+    if scramble:
+        V, shift = _sobol_scramble(V, seed)
+    else:
+        shift = numpy.zeros(d, dtype=numpy.uint64)
+    # Point i is the XOR of the direction numbers of the bits set in the Gray code of i
+    i = numpy.arange(skip, skip+n, dtype=numpy.uint64)
+    g = i ^ (i >> numpy.uint64(1))
+    X = numpy.tile(shift, (n,1))
+    b = 0
+    while b < _bits and numpy.any(g >> numpy.uint64(b)):
+        X ^= ((g >> numpy.uint64(b)) & numpy.uint64(1))[:,None] * V[b]
+        b += 1
+    return X.astype('float') / 2.**_bits
+
+def halton(n, d, skip=0, scramble=False, seed=None):
+    """ Points of the Halton sequence in the d-dimensional unit hypercube, using the
+        radical inverses of the point indices in the first d prime bases. Points are computed
+        from their index in the sequence, so that a sequence can be continued by skipping
+        the points generated before with the same seed.
+
+        :param n: Number of points
+        :type n: int
+        :param d: Number of dimensions
+        :type d: int
+        :param skip: Number of initial points of the sequence to skip, the sequence starts at index 1
+        :type skip: int
+        :param scramble: If True, the digits of each base are randomly permuted
+        :type scramble: bool
+        :param seed: Random seed of scrambling
+        :type seed: int
+        :returns: ndarray(fl64) -- n by d array of points
+    """
+    bases = _primes(d)
+    rng = numpy.random.RandomState(seed)
+    X = numpy.zeros((n,d))
+    i0 = numpy.arange(skip+1, skip+n+1)
+    for j,b in enumerate(bases):
+        if scramble:
+            # Permutation of nonzero digits, zero is kept so that points have finite expansions
+            perm = numpy.concatenate([[0], rng.permutation(numpy.arange(1,b))])
+        i = i0.copy()
+        f = 1.
+        while numpy.any(i):
+            f /= b
+            digit = i % b
+            if scramble: digit = perm[digit]
+            X[:,j] += f*digit
+            i //= b
+    return X
+
+def _sobol_directions(d):
+    # Direction numbers V[b,j] of bit b of dimension j, as integers with _bits bits
+    V = numpy.zeros((_bits,d), dtype=numpy.uint64)
+    V[:,0] = [1 << (_bits-1-b) for b in range(_bits)]
+    if d == 1: return V
+    polys = _primitive_polynomials(d-1)
+    rng = numpy.random.RandomState(0)
+    for j in range(1,d):
+        poly = polys[j-1]
+        s = poly.bit_length()-1
+        if j-1 < len(_joe_kuo):
+            m = list(_joe_kuo[j-1])
+        else:
+            # Odd initial direction numbers m_k < 2^k
+            m = [2*rng.randint(0, 1 << k)+1 for k in range(s)]
+        v = [m[k] << (_bits-1-k) for k in range(min(s,_bits))]
+        for b in range(s,_bits):
+            x = v[b-s] ^ (v[b-s] >> s)
+            for k in range(1,s):
+                if (poly >> (s-k)) & 1: x ^= v[b-k]
+            v.append(x)
+        V[:,j] = v
+    return V
+
+def _sobol_scramble(V, seed):
+    # Linear matrix scramble, a random lower triangular binary matrix with unit diagonal
+    # applied to the digits of each direction number, and random digital shift
+    rng = numpy.random.RandomState(seed)
+    nb,d = V.shape
+    W = numpy.zeros_like(V)
+    one = numpy.uint64(1)
+    for j in range(d):
+        L = numpy.tril(rng.randint(0, 2, size=(nb,nb)), -1) + numpy.eye(nb, dtype=int)
+        # Digits of direction numbers, most significant first
+        digits = (V[:,j][:,None] >> numpy.arange(nb-1,-1,-1).astype(numpy.uint64)) & one
+        scrambled = numpy.dot(digits, L.T) % 2
+        W[:,j] = numpy.dot(scrambled.astype(numpy.uint64), one << numpy.arange(nb-1,-1,-1).astype(numpy.uint64))
+    shift = numpy.array([rng.randint(0, 1 << 26)*(1 << (nb-26)) + rng.randint(0, 1 << (nb-26)) for j in range(d)], dtype=numpy.uint64)
+    return W, shift
+
+def _primitive_polynomials(n):
+    # First n primitive polynomials over GF(2) of degree 1 and higher, as integers with bit k
+    # the coefficient of x^k, excluding x (which Sobol sequences do not use)
+    polys = []
+    s = 1
+    while len(polys) < n:
+        for a in range(1 << (s-1)):
+            p = (1 << s) | (a << 1) | 1
+            if _is_primitive(p, s):
+                polys.append(p)
+                if len(polys) == n: break
+        s += 1
+    return polys
+
+def _is_primitive(p, s):
+    # p is primitive if x has order 2^s-1 modulo p
+    order = (1 << s) - 1
+    if not _powmod(2, order, p, s) == 1: return False
+    for q in _prime_factors(order):
+        if _powmod(2, order//q, p, s) == 1: return False
+    return True
+
+def _powmod(a, e, p, s):
+    # a^e modulo p for polynomials over GF(2)
+    r = 1
+    while e:
+        if e & 1: r = _mulmod(r, a, p, s)
+        a = _mulmod(a, a, p, s)
+        e >>= 1
+    return r
+
+def _mulmod(a, b, p, s):
+    r = 0
+    while b:
+        if b & 1: r ^= a
+        b >>= 1
+        a <<= 1
+        if a >> s: a ^= p
+    return r
+
+def _prime_factors(n):
+    f = []
+    q = 2
+    while q*q <= n:
+        if n % q == 0:
+            f.append(q)
+            while n % q == 0: n //= q
+        q += 1
+    if n > 1: f.append(n)
+    return f
+
+def _primes(n):
+    # First n prime numbers
+    p = []
+    q = 2
+    while len(p) < n:
+        if all([q % k for k in p if k*k <= q]): p.append(q)
+        q += 1
+    return p
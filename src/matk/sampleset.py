@@ -1,9 +1,14 @@
-import sys
+import sys, os
+import time
+import threading
+import json
+import struct
 import numpy
 import string
 from scipy import stats
 from shutil import rmtree
 from operator import itemgetter
+from lhs import dist_ppf, dist_cdf, lhs_augment
 try:
     from matplotlib import pyplot as plt
     from matplotlib.ticker import MaxNLocator
@@ -25,13 +30,18 @@ class SampleSet(object):
         self.name = name
         responses = None
         self._indices = None
+        self._status = None
+        self._attempts = None
+        self._sequence = None
         self._index_start = index_start
         self._parent = parent
         self.samples = DataSet(samples,self._parent.parnames,mins=self._parent.parmins,maxs=self._parent.parmaxs) 
         for k,v in kwargs.iteritems():
             if k == 'responses':
                 if not v is None:
-                    if isinstance( v, (list,numpy.ndarray)):
+                    if isinstance( v, numpy.memmap ):
+                        responses = v
+                    elif isinstance( v, (list,numpy.ndarray)):
                        responses = numpy.array(v)
                     else:
                         print "Error: Responses are not a list or ndarray"
@@ -114,15 +124,46 @@ class SampleSet(object):
         if not self.samples is None:
             self.indices = numpy.arange(self.index_start,self.index_start+self.samples.values.shape[0])
     @property
+    def sequence(self):
+        """ Low-discrepancy sequence that samples were drawn from, a dictionary of the method ('sobol' or 'halton'),
+            scramble, seed and skip, the number of sequence points used, that continue the sequence
+            (e.g. MATKobject.sobol(skip=sequence['skip'],seed=sequence['seed'])); None if samples are not from a sequence
+        """
+        return self._sequence
+    @property
+    def status(self):
+        """ Ndarray of outcomes of the model runs of samples: 'success', 'error' (model raised an exception), 
+            'timeout' (model run exceeded timeout), 'workdir' (working directory exists), 'noresult' (model
+            returned None), or None for samples that have not been run
+        """
+        return getattr(self, '_status', None)
+    @property
+    def attempts(self):
+        """ Ndarray of number of times the model was run for each sample, including retries
+        """
+        return getattr(self, '_attempts', None)
+    @property
+    def failed(self):
+        """ Boolean ndarray, True for samples whose model runs failed
+        """
+        if self.status is None: return numpy.zeros(self.samples.values.shape[0], dtype=bool)
+        return numpy.array([st is not None and st != 'success' for st in self.status])
+    @property
     def recarray(self):
-        """ Structured (record) array of samples
+        """ Structured (record) array of samples and responses. If samples and responses are 
+            stored together (samplesets loaded with matk.load_sampleset or moved to file with memmap),
+            the record array is a view of the values and changes to it change samples and responses
+            (and the file of memory-mapped samplesets, unless it is opened read-only). Samplesets 
+            created in memory store samples and responses separately, and the record array is a copy.
         """
         if self.responses is None:
-            return numpy.rec.fromarrays(self.samples._values.T,names=self.samples._names)
+            return _recview(self.samples._values,self.samples._names)
         else:
-            data = numpy.column_stack([self.samples._values,self.responses._values])
-            names = numpy.concatenate([self.samples._names,self.responses._names])
-            return numpy.rec.fromarrays(data.T,names=names.tolist())
+            names = numpy.concatenate([self.samples._names,self.responses._names]).tolist()
+            data = _joined(self.samples._values,self.responses._values)
+            if data is None:
+                data = numpy.column_stack([self.samples._values,self.responses._values])
+            return _recview(data,names)
     def pardict(self, index):
         """ Get parameter dictionary for sample with specified index
 
@@ -147,7 +188,10 @@ class SampleSet(object):
         elif self.responses is None:
             print "Responses have not been calculated. Run sampleset (e.g. sampleset.run())"
             return 0
-        self.sse = [numpy.sum((self._parent.obsvalues - self.responses.values[i,:])**2) for i in range(len(self.responses.values))]
+        obsvalues = numpy.array(self._parent.obsvalues)
+        self.sse = []
+        for i in range(0,self.responses.values.shape[0],_block_rows):
+            self.sse += numpy.sum((obsvalues - self.responses.values[i:i+_block_rows])**2,axis=1).tolist()
         return self.sse
     def corr(self, type='pearson', plot=False, printout=True, plotvals=True, figsize=None, title=None):
         """ Calculate correlation coefficients of parameters and responses
@@ -213,11 +257,12 @@ class SampleSet(object):
             if maxs is None and self.samples._maxs is not None: maxs = numpy.concatenate([self.samples._maxs,numpy.max(self.responses.values,axis=0)])
         panels( self.recarray, type=type, alpha=alpha, figsize=figsize, title=title, tight=tight, symbol=symbol,fontsize=fontsize,corrfontsize=corrfontsize,ms=ms,mins=mins,maxs=maxs,frequency=frequency,bins=bins,ylim=ylim,labels=labels,filename=filename,xticks=xticks,yticks=yticks)
     def run(self, cpus=1, workdir_base=None, save=True, reuse_dirs=False, outfile=None, 
-            logfile=None, verbose=True, hosts={} ):
+            logfile=None, verbose=True, hosts={}, chunksize=None, vectorized=None, resume=False, 
+            task_timeout=None, max_failures=None, timeout=None, retries=0, backoff=1., template_dir=None ):
         """ Run model using values in samples for parameter values
             If samples are not specified, LHS samples are produced
             
-            :param cpus: number of cpus; alternatively, dictionary of lists of processor ids keyed by hostnames to run models on (i.e. on a cluster); hostname provided as kwarg to model (hostname=<hostname>); processor id provided as kwarg to model (processor=<processor id>)
+            :param cpus: number of cpus; alternatively, dictionary of lists of processor ids keyed by hostnames to run models on (i.e. on a cluster); hostname provided as kwarg to model (hostname=<hostname>); processor id provided as kwarg to model (processor=<processor id>); ignored if persistent workers have been started with matk.start
             :type cpus: int,dict(lst)
             :param workdir_base: Base name for model run folders, run index is appended to workdir_base
             :type workdir_base: str
@@ -225,39 +270,224 @@ class SampleSet(object):
             :type save: bool
             :param reuse_dirs: Will use existing directories if True, will return an error if False and directory exists
             :type reuse_dirs: bool
-            :param outfile: File to write results to
+            :param outfile: File to write results to; rows are appended as model runs complete so that results of interrupted runs can be read with matk.read_sampleset, and the file is rewritten in sample order when all runs are finished
             :type outfile: str
             :param logfile: File to write details of run to during execution
             :type logfile: str
             :param hosts: Option deprecated, use cpus instead
             :type hosts: lst(str)
+            :param chunksize: Number of samples sent to a worker process at a time, larger chunks reduce communication overhead for fast models; if 'auto', samples are split into about four chunks per worker. Defaults to 1, or 'auto' for vectorized models
+            :type chunksize: int or str
+            :param vectorized: If True, model is called once per chunk with arrays of parameter values (see matk vectorized option); if None, matk.vectorized is used
+            :type vectorized: bool
+            :param resume: If True, only samples without responses recorded in the sampleset or in outfile (e.g. written by an interrupted run) are run
+            :type resume: bool
+            :param task_timeout: Number of seconds after which samples that are still running (e.g. on slow or hung hosts) are run again on idle workers, the first result to arrive is used
+            :type task_timeout: fl64
+            :param max_failures: Number of successive failed or timed out runs on a host after which no more samples are sent to the host
+            :type max_failures: int
+            :param timeout: Number of seconds of wall-clock time after which a model run is stopped and counted as failed. Runs with a timeout are called in a separate process group, which is killed with any external processes started by the model when the timeout expires. Outcomes of model runs are recorded in SampleSet.status
+            :type timeout: fl64
+            :param retries: Number of times model runs that raise an exception or time out are retried
+            :type retries: int
+            :param backoff: Number of seconds to wait before the first retry of a sample, doubled for each further retry
+            :type backoff: fl64
+            :param template_dir: Directory of model input files that working directories are staged from by hard linking read-only files, see matk.template_dir
+            :type template_dir: str
             :returns: tuple(ndarray(fl64),ndarray(fl64)) - (Matrix of responses from sampled model runs siz rows by npar columns, Parameter samples, same as input samples if provided)
         """
+        return self._run(cpus=cpus, workdir_base=workdir_base, save=save, reuse_dirs=reuse_dirs, outfile=outfile,
+                         logfile=logfile, verbose=verbose, hosts=hosts, chunksize=chunksize, vectorized=vectorized, resume=resume,
+                         task_timeout=task_timeout, max_failures=max_failures, timeout=timeout, retries=retries, backoff=backoff,
+                         template_dir=template_dir)
+    def run_async(self, cpus=1, workdir_base=None, save=True, reuse_dirs=False, outfile=None, 
+            logfile=None, verbose=False, chunksize=None, vectorized=None, resume=False, task_timeout=None, max_failures=None, 
+            timeout=None, retries=0, backoff=1., template_dir=None ):
+        """ Run model using values in samples for parameter values without waiting for the runs to finish.
+            Responses are filled in as model runs complete, rows of unfinished samples are NaN, so that analysis 
+            (e.g. calc_sse, corr) of completed samples can begin while the remaining samples run. 
+            The MATK object should not be modified until the run is finished. Arguments are the same as for run;
+            a vectorized model with cpus=1 is run in chunks by a worker process instead of in this process.
+
+            :returns: SampleSetFuture object
+        """
+        future = SampleSetFuture(self)
+        future._start(cpus=cpus, workdir_base=workdir_base, save=save, reuse_dirs=reuse_dirs, outfile=outfile,
+                      logfile=logfile, verbose=verbose, chunksize=chunksize, vectorized=vectorized, resume=resume,
+                      task_timeout=task_timeout, max_failures=max_failures, timeout=timeout, retries=retries, backoff=backoff,
+                      template_dir=template_dir)
+        return future
+    def extend(self, n, seed=None, run=True, **kwargs):
+        """ Add samples to sampleset and run the model for the new samples only, so that 
+            the number of samples can be increased as needed. Samples drawn with MATKobject.sobol 
+            or halton are extended with the next points of the sequence. Other samples are extended 
+            with Latin hypercube samples in the strata, of a sample of the combined size, that existing 
+            samples are not in; the combined samples are a Latin hypercube if they were one before and 
+            n is a multiple of the number of existing samples (e.g. doubling).
+            New samples get indices following the largest index of the sampleset.
+
+            :param n: Number of samples to add
+            :type n: int
+            :param seed: Random seed of Latin hypercube samples
+            :type seed: int
+            :param run: If True, the model is run for the new samples
+            :type run: bool
+            :param kwargs: Keyword arguments of SampleSet.run, e.g. cpus, workdir_base, outfile
+            :returns: ndarray(fl64) -- Responses of new samples if run is True, parameter values of new samples otherwise
+        """
+        if not n > 0:
+            print "Error: Number of samples to add must be greater than zero"
+            return
+        p = self._parent
+        values = self.samples.values
+        N = values.shape[0]
+        if self._sequence is not None:
+            sq = self._sequence
+            x = p._qmc_samples( sq['method'], n, scramble=sq['scramble'], skip=sq['skip'], seed=sq['seed'] )
+            sq['skip'] += n
+        else:
+            dists = p._dists()
+            u = dist_cdf(dists, p.pardist_pars, numpy.asarray(values, dtype=float))
+            x = dist_ppf(dists, p.pardist_pars, lhs_augment(u, n, seed=seed))
+            x = p._eval_exprs( x )
+        self.samples = DataSet(numpy.vstack([values,x.astype(values.dtype)]),p.parnames,mins=p.parmins,maxs=p.parmaxs)
+        self._indices = numpy.concatenate([self.indices, numpy.max(self.indices)+numpy.arange(1,n+1)])
+        if self.responses is not None:
+            resp = numpy.empty((n,self.responses.values.shape[1]))
+            resp.fill(numpy.nan)
+            self.responses = DataSet(numpy.vstack([self.responses.values,resp]),self.responses.names)
+        if self._status is not None:
+            self._status = numpy.concatenate([self._status, numpy.array([None]*n, dtype=object)])
+            self._attempts = numpy.concatenate([self._attempts, numpy.zeros(n, dtype=int)])
+        if not run: return x
+        new = numpy.arange(N,N+n)
+        out = self._run(rows=new, **kwargs)
+        if out is None: return None
+        return out[new]
+    def _run(self, cpus=1, workdir_base=None, save=True, reuse_dirs=False, outfile=None, 
+            logfile=None, verbose=True, hosts={}, chunksize=None, vectorized=None, resume=False, 
+            task_timeout=None, max_failures=None, timeout=None, retries=0, backoff=1., template_dir=None, future=None, rows=None ):
         if workdir_base:
             self._parent.workdir_base = workdir_base
+        if template_dir:
+            self._parent.template_dir = template_dir
 
         if len(hosts) > 0:
             print "Error: host option deprecated, use cpus instead. cpus accepts an integer or dictionary of lists of processor ids keyed by hostnames in the same way that the hosts argument functioned"
             return
                 
-        if cpus > 0:
-            out, samples = self._parent.parallel(self.samples.values, cpus, 
-                 indices=self.indices, workdir_base=workdir_base, 
-                 save=save, reuse_dirs=reuse_dirs, verbose=verbose, logfile=logfile)
-        else:
+        if not cpus > 0:
             print 'Error: number of cpus must be greater than zero'
             return
+
+        # Determine samples that need to be run
+        recorded = None
+        append = False
+        todo = numpy.arange(self.samples.values.shape[0])
+        if rows is not None:
+            # Only rows are run, responses of other rows are kept
+            todo = numpy.asarray(rows)
+            if self.responses is not None:
+                recorded = numpy.array(self.responses.values, dtype=float)
+                if outfile is not None:
+                    # Write recorded responses first, so that they are kept in outfile if the run is interrupted
+                    self.savetxt( outfile )
+                    append = True
+        elif resume:
+            recorded, append = self._recorded_responses(outfile)
+            if recorded is not None:
+                todo = numpy.where(numpy.any(numpy.isnan(recorded),axis=1))[0]
+                if verbose: print "Resuming sampleset, "+str(len(todo))+" of "+str(len(recorded))+" samples to run"
+
+        # Responses are filled in place as chunks of runs finish
+        out = recorded
+        if out is not None: self._set_responses(out)
+        if future is not None: future._init(todo, out)
+        n = self.samples.values.shape[0]
+        if self.status is None or not len(self.status) == n:
+            self._status = numpy.array([None]*n, dtype=object)
+            self._attempts = numpy.zeros(n, dtype=int)
+        if len(todo):
+            runs = self._parent._iparallel(self.samples.values[todo], cpus, 
+                 indices=numpy.asarray(self.indices)[todo], workdir_base=workdir_base, 
+                 save=save, reuse_dirs=reuse_dirs, verbose=verbose, logfile=logfile, chunksize=chunksize, vectorized=vectorized, 
+                 outfile=outfile, append=append, task_timeout=task_timeout, max_failures=max_failures, 
+                 timeout=timeout, retries=retries, backoff=backoff, in_process=future is None)
+            for lst_ind, smp_inds, names, sims, errs, status in runs:
+                rows = todo[lst_ind:lst_ind+len(smp_inds)]
+                for r,(kind,attempts) in zip(rows,status):
+                    self._status[r] = kind
+                    self._attempts[r] = attempts
+                if sims is not None:
+                    if out is None:
+                        out = numpy.empty((self.samples.values.shape[0],sims.shape[1]))
+                        out.fill(numpy.NAN)
+                        self._set_responses(out)
+                    out[rows] = sims
+                if future is not None:
+                    future._update(rows, errs, out)
+                    if future.cancelled():
+                        runs.close()
+                        break
+            if verbose:
+                failed = [st for st in self._status[todo] if st is not None and st != 'success']
+                if len(failed):
+                    print "Warning: "+str(len(failed))+" of "+str(len(todo))+" model runs failed ("+', '.join([str(failed.count(k))+' '+k for k in sorted(set(failed))])+")"
+            # Responses of failed runs are NaN, also if all runs failed
+            if out is None and len(self._parent.obs) > 0:
+                out = numpy.empty((self.samples.values.shape[0],len(self._parent.obs)))
+                out.fill(numpy.NAN)
+                self._set_responses(out)
         if out is not None:
-            out = numpy.array(out)
-            if self.responses is None:
-                self.responses = DataSet(out,self._parent.obsnames) 
-            else:
-                self.responses.values = out 
-            self._obsnames = self._parent.obsnames
+            if out.shape[1] == 1 and recorded is None and numpy.all(numpy.isnan(out)):
+                out = None
+                self.responses = None
         if not outfile is None:
             self.savetxt( outfile )
 
         return out
+    def _set_responses(self, out):
+        ''' Set responses to array that is filled as model runs finish '''
+        if self.responses is None:
+            self.responses = DataSet(out,self._parent.obsnames) 
+        else:
+            self.responses.values = out 
+        self._obsnames = self._parent.obsnames
+    def _recorded_responses(self, outfile=None):
+        ''' Collect responses recorded in sampleset and outfile, rows of samples without responses are NaN
+
+            :param outfile: MATK output file
+            :type outfile: str
+            :returns: tuple(ndarray(fl64),bool) - (Recorded responses or None if there are none, True if rows can be appended to outfile)
+        '''
+        resp = None
+        if self.responses is not None:
+            resp = numpy.array(self.responses.values, dtype=float)
+        if outfile is None or not os.path.isfile(outfile):
+            return resp, False
+        out = read_outfile(outfile)
+        if out is None or out[4] is None:
+            return resp, False
+        parnames, obsnames, indices, samples, responses = out
+        if not parnames == self.parnames:
+            print "Warning: Parameters in "+outfile+" do not match sampleset, file will be overwritten"
+            return resp, False
+        if len(self._parent.obs) == 0:
+            for nm in obsnames: self._parent.add_obs(nm)
+        elif not obsnames == self._parent.obsnames:
+            print "Warning: Observations in "+outfile+" do not match problem, file will be overwritten"
+            return resp, False
+        if resp is None:
+            resp = numpy.empty((self.samples.values.shape[0],len(obsnames)))
+            resp.fill(numpy.nan)
+        rows = dict([(ind,i) for i,ind in enumerate(self.indices)])
+        for ind,smp,r in zip(indices,samples,responses):
+            i = rows.get(ind)
+            if i is None or numpy.any(numpy.isnan(r)): continue
+            # Skip rows recorded for other parameter values, allowing for precision of file
+            if not numpy.allclose(smp, self.samples.values[i], rtol=1.e-5): continue
+            resp[i] = r
+        return resp, True
     def copy(self, newname=None):
         return self._parent.copy_sampleset(self.name,newname=newname)
     def savetxt( self, outfile):
@@ -267,10 +497,6 @@ class SampleSet(object):
             :type outfile: str
         '''
 
-        x = numpy.column_stack([self.indices,self.samples.values])
-        if not self.responses is None:
-            x = numpy.column_stack([x,self.responses.values])
-
         if outfile:
             f = open(outfile, 'w')
             f.write("Number of parameters: %d\n" % len(self.parnames) )
@@ -290,18 +516,41 @@ class SampleSet(object):
                     for nm in self.obsnames:
                         f.write(" %16s" % nm )
             f.write('\n')
-            for row in x:
-                if isinstance( row[0], str ):
-                    f.write("%-8s" % row[0] )
-                else:
-                    f.write("%-8d" % row[0] )
-                for i in range(1,len(row)):
-                    if isinstance( row[i], str):
-                        f.write(" %16s" % row[i] )
-                    else:
-                        f.write(" %16g" % row[i] )
-                f.write('\n')
+            # Write rows in blocks
+            for i in range(0,self.samples.values.shape[0],_block_rows):
+                if self.responses is None: values = self.samples.values[i:i+_block_rows]
+                else: values = numpy.column_stack([self.samples.values[i:i+_block_rows],self.responses.values[i:i+_block_rows]])
+                f.write(_format_rows(self.indices[i:i+_block_rows], values))
             f.close()
+    def save( self, outfile ):
+        ''' Save sampleset to binary file that can be read with matk.load_sampleset.
+            Values are stored at full precision and can be memory-mapped when read.
+
+            :param outfile: Name of file where sampleset will be written
+            :type outfile: str
+        '''
+        if self.responses is None: 
+            responses = None
+            obsnames = []
+        else: 
+            responses = self.responses.values
+            obsnames = self.responses.names
+            if len(obsnames) == 0: obsnames = ['obs'+str(i+1) for i in range(responses.shape[1])]
+        save_binary(outfile, self.indices, self.samples.values, responses, self.samples.names, 
+                    obsnames, mins=self.samples._mins, maxs=self.samples._maxs, name=self.name)
+    def memmap( self, outfile ):
+        ''' Move samples and responses to a binary file (see save) that is memory-mapped in 
+            place of the arrays held in memory, so that samplesets larger than memory can be 
+            processed (e.g. hist, corr, subset, calc_sse). Changes to values are written to the file.
+
+            :param outfile: Name of file where sampleset will be written
+            :type outfile: str
+        '''
+        self.save(outfile)
+        d = load_binary(outfile, mode='r+')
+        self.samples._values = d['samples']
+        if self.responses is not None:
+            self.responses._values = d['responses']
     def subset(self, boolfcn, obs, *args, **kwargs): 
         """ Collect samples based on response values, remove all others
 
@@ -311,6 +560,8 @@ class SampleSet(object):
             :type obs: str
             :param args: Additional arguments to add to boolfcn
             :param kwargs: Keyword arguments to add to boolfcn 
+
+            Samples that are kept are copied into memory, also for memory-mapped samplesets.
         """
         if self.responses is None:
             print 'Error: sampleset contains no responses'
@@ -390,10 +641,387 @@ class SampleSet(object):
             
         return pars
             
+class SampleSetFuture(object):
+    """ MATK SampleSetFuture class - Handle of a sampleset run started by SampleSet.run_async,
+        providing the progress of the run, responses of finished samples, cancellation,
+        and a wait for the run to finish
+    """
+    def __init__(self, sampleset):
+        self._sampleset = sampleset
+        self._todo = numpy.array([], dtype=int)
+        self._finished = numpy.zeros(sampleset.samples.values.shape[0], dtype=bool)
+        self._responses = None
+        self._nfailed = 0
+        self._out = None
+        self._exc_info = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+    def _start(self, **kwargs):
+        self._thread = threading.Thread(target=self._target, kwargs=kwargs)
+        self._thread.daemon = True
+        self._thread.start()
+    def _target(self, **kwargs):
+        try:
+            self._out = self._sampleset._run(future=self, **kwargs)
+        except:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+    def _init(self, todo, responses):
+        # Samples with recorded responses count as finished
+        self._todo = todo
+        self._finished[:] = True
+        self._finished[todo] = False
+        self._responses = responses
+    def _update(self, rows, errs, responses):
+        self._responses = responses
+        self._finished[rows] = True
+        self._nfailed += len(errs)
+    @property
+    def sampleset(self):
+        """ SampleSet being run
+        """
+        return self._sampleset
+    @property
+    def responses(self):
+        """ Ndarray of responses updated in place as model runs finish, rows of unfinished 
+            or failed samples are NaN; None until the first model run succeeds
+        """
+        return self._responses
+    @property
+    def finished(self):
+        """ Boolean ndarray, True for samples whose model runs are finished (successfully or not)
+        """
+        return self._finished
+    @property
+    def ndone(self):
+        """ Number of samples run, including failed runs and samples with recorded responses when resuming
+        """
+        return int(numpy.sum(self._finished))
+    @property
+    def nfailed(self):
+        """ Number of failed model runs
+        """
+        return self._nfailed
+    @property
+    def progress(self):
+        """ Fraction of samples run
+        """
+        if len(self._finished) == 0: return 1.
+        return float(self.ndone)/len(self._finished)
+    def done(self):
+        """ Return True if run is finished or cancelled
+        """
+        return self._done.is_set()
+    def running(self):
+        """ Return True if run is in progress
+        """
+        return not self._done.is_set()
+    def cancel(self):
+        """ Cancel samples that have not been started; model runs in progress are finished
+            but their responses are discarded. Responses of finished samples are kept.
+
+            :returns: bool -- False if run was already finished
+        """
+        if self.done(): return False
+        self._cancel.set()
+        return True
+    def cancelled(self):
+        """ Return True if run was cancelled
+        """
+        return self._cancel.is_set()
+    def result(self, timeout=None):
+        """ Wait for run to finish, exceptions raised during the run are raised again here
+
+            :param timeout: Maximum number of seconds to wait, if None, wait until finished
+            :type timeout: fl64
+            :returns: ndarray(fl64) -- Matrix of responses, same as SampleSet.run, or None if timeout expires
+        """
+        # Wait in short intervals so that the wait can be interrupted with Ctrl-C
+        t0 = time.time()
+        while not self._done.wait(0.1):
+            if timeout is not None and time.time() - t0 >= timeout:
+                print "Error: Sampleset run did not finish within timeout"
+                return None
+        self._thread.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._out
+    def __repr__(self):
+        if self.cancelled(): state = 'cancelled'
+        elif self.done(): state = 'finished'
+        else: state = 'running'
+        return '<SampleSetFuture '+str(self._sampleset.name)+': '+state+', '+str(self.ndone)+' of '+str(len(self._finished))+' samples run>'
+
+class ResultsWriter(object):
+    """ MATK results writer - Appends sample indices, parameter values, and 
+        responses to a MATK output file as model runs complete so that results
+        of interrupted runs can be recovered with matk.read_sampleset
+    """
+    def __init__(self, outfile, parnames, obsnames=None, append=False):
+        self._parnames = parnames
+        self._obsnames = None
+        self._pending = []
+        if append and obsnames:
+            # Header already exists, end incomplete last row of an interrupted run
+            self._f = open(outfile, 'a+')
+            self._f.seek(0,2)
+            if self._f.tell() > 0:
+                self._f.seek(-1,2)
+                if self._f.read(1) != '\n': self._f.write('\n')
+            self._obsnames = obsnames
+        else:
+            self._f = open(outfile, 'w')
+            if obsnames: self._write_header(obsnames)
+    def _write_header(self, obsnames):
+        self._obsnames = obsnames
+        self._f.write("Number of parameters: %d\n" % len(self._parnames) )
+        self._f.write("Number of responses: %d\n" % len(obsnames) )
+        self._f.write("%-8s" % 'index' )
+        for nm in self._parnames:
+            self._f.write(" %16s" % nm )
+        for nm in obsnames:
+            self._f.write(" %16s" % nm )
+        self._f.write('\n')
+        for indices,parsets in self._pending:
+            self._write_rows(indices, parsets, None)
+        self._pending = []
+    def _write_rows(self, indices, parsets, responses):
+        if responses is None:
+            responses = numpy.empty((len(indices),len(self._obsnames)))
+            responses.fill(numpy.nan)
+        self._f.write(_format_rows(indices, numpy.column_stack([parsets,responses])))
+    def write(self, indices, parsets, responses=None, obsnames=None):
+        """ Append rows to file, rows are held back until the observation names are known
+
+            :param indices: Sample indices
+            :type indices: lst(int)
+            :param parsets: Parameter values with a row for each sample
+            :type parsets: ndarray(fl64)
+            :param responses: Responses with a row for each sample, None if model runs failed
+            :type responses: ndarray(fl64)
+            :param obsnames: Names of response columns
+            :type obsnames: lst(str)
+        """
+        if self._obsnames is None:
+            if responses is None:
+                self._pending.append((indices,parsets))
+                return
+            self._write_header(obsnames)
+        self._write_rows(indices, parsets, responses)
+        self._f.flush()
+    def close(self):
+        """ Write remaining rows and close file
+        """
+        if self._obsnames is None:
+            self._write_header([])
+        self._f.close()
+
+_block_rows = 10000 # Number of rows formatted at a time when writing text files
+_block_bytes = 1<<24 # Approximate number of bytes parsed at a time when reading text files
+
+def _format_rows(indices, values):
+    """ Format rows of MATK output file, sample index followed by values
+
+        :param indices: Sample indices
+        :type indices: lst(int)
+        :param values: Values with a row for each sample
+        :type values: ndarray(fl64)
+        :returns: str
+    """
+    fmt = "%-8d" + " %16g"*values.shape[1] + "\n"
+    return ''.join([fmt % tuple(row) for row in numpy.column_stack([indices,values]).tolist()])
+
+def read_outfile(file):
+    """ Parse MATK output file. Incomplete rows (e.g. last row of an interrupted run) 
+        are skipped and, if an index appears more than once (e.g. in the file of a 
+        resumed run), the last row with that index is used.
+
+        :param file: Path to MATK output file
+        :type file: str
+        :returns: tuple(lst(str),lst(str),ndarray(int),ndarray(fl64),ndarray(fl64)) -- parameter names, observation names, indices, samples, and responses (None if there are no responses), or None if no samples are found
+    """
+    fp = open(file)
+    npar = int(fp.readline().rstrip().split(':')[1])
+    nobs = int(fp.readline().rstrip().split(':')[1])
+    headers = fp.readline().rstrip().split()
+    ncols = npar+nobs+1
+    blocks = []
+    while True:
+        lines = fp.readlines(_block_bytes)
+        if not lines: break
+        # Parse block at once, parse line by line if block contains incomplete rows
+        vals = numpy.fromstring(''.join(lines), sep=' ')
+        nlines = len(lines) - sum([1 for line in lines if line.isspace()])
+        if vals.size == nlines*ncols:
+            blocks.append(vals.reshape(nlines,ncols))
+            continue
+        rows = []
+        for line in lines:
+            if line.isspace(): continue
+            try: row = [float(num) for num in line.split()]
+            except ValueError: row = []
+            if len(row) == ncols: rows.append(row)
+            else: print 'Warning: Skipping incomplete line in '+file+': '+line.rstrip()
+        if len(rows): blocks.append(numpy.array(rows))
+    fp.close()
+    if len(blocks) == 0: return None
+    data = numpy.concatenate(blocks)
+    indices = data[:,0].astype(int)
+    # Keep last row of repeated indices
+    uinds,last = numpy.unique(indices[::-1], return_index=True)
+    if len(uinds) < len(indices):
+        keep = numpy.sort(len(indices)-1-last)
+        data = data[keep]
+        indices = indices[keep]
+    samples = data[:,1:npar+1]
+    if nobs > 0: responses = data[:,npar+1:]
+    else: responses = None
+    return headers[1:npar+1], headers[npar+1:], indices, samples, responses
+
+_binary_magic = 'MATKSS\x01\x00'
+_binary_align = 64
+
+def save_binary(outfile, indices, samples, responses, parnames, obsnames, mins=None, maxs=None, name=None):
+    """ Write samples and responses to a MATK binary file. The file consists of an 
+        8 byte identifier, the length of a JSON header as a little-endian 
+        uint64, the JSON header with names, bounds, and the offset, dtype and 
+        shape of each array, followed by the raw little-endian arrays, each 
+        starting at a multiple of 64 bytes. Samples and responses are stored 
+        together in a values array with a row for each sample.
+
+        :param outfile: Name of file where samples will be written
+        :type outfile: str
+        :param indices: Sample indices
+        :type indices: lst(int)
+        :param samples: Parameter samples with npar columns
+        :type samples: ndarray(fl64)
+        :param responses: Responses with nobs columns, None if there are no responses
+        :type responses: ndarray(fl64)
+        :param parnames: Parameter names
+        :type parnames: lst(str)
+        :param obsnames: Observation names
+        :type obsnames: lst(str)
+    """
+    if responses is None: obsnames = []
+    indices = numpy.asarray(indices,dtype='<i8')
+    nvals = numpy.shape(samples)[1]+len(obsnames)
+    arrays = [('indices',indices.dtype.str,indices.shape,indices.nbytes), 
+              ('values','<f8',(len(indices),nvals),len(indices)*nvals*8)]
+    header = {'name':name, 'parnames':list(parnames), 'obsnames':list(obsnames),
+              'mins':None if mins is None else [None if v is None else float(v) for v in mins],
+              'maxs':None if maxs is None else [None if v is None else float(v) for v in maxs],
+              'arrays':OrderedDict()}
+    # Header size depends on offsets, so iterate until offsets are consistent
+    start = 0
+    while True:
+        offset = start
+        for nm,dtype,shape,nbytes in arrays:
+            header['arrays'][nm] = {'offset':offset, 'dtype':dtype, 'shape':list(shape)}
+            offset += -(-nbytes//_binary_align)*_binary_align
+        hstr = json.dumps(header)
+        hlen = len(_binary_magic) + 8 + len(hstr)
+        if -(-hlen//_binary_align)*_binary_align == start: break
+        start = -(-hlen//_binary_align)*_binary_align
+    f = open(outfile, 'wb')
+    f.write(_binary_magic)
+    f.write(struct.pack('<Q', len(hstr)))
+    f.write(hstr)
+    f.write('\0'*(header['arrays']['indices']['offset']-f.tell()))
+    f.write(indices.tostring())
+    f.write('\0'*(header['arrays']['values']['offset']-f.tell()))
+    for i in range(0,len(indices),_block_rows):
+        if responses is None: values = numpy.asarray(samples[i:i+_block_rows],dtype='<f8')
+        else: values = numpy.column_stack([samples[i:i+_block_rows],responses[i:i+_block_rows]]).astype('<f8')
+        f.write(numpy.ascontiguousarray(values).tostring())
+    f.close()
+
+def load_binary(file, mmap=True, mode='c'):
+    """ Read MATK binary file written by save_binary
+
+        :param file: Path to MATK binary file
+        :type file: str
+        :param mmap: If True, arrays are memory-mapped instead of read into memory
+        :type mmap: bool
+        :param mode: Mode of memory-mapped arrays, 'c' (copy-on-write), 'r' (read only) or 'r+' (changes are written to file)
+        :type mode: str
+        :returns: dict -- header entries (name, parnames, obsnames, mins, maxs) and arrays (indices, samples, responses); samples and responses are column views of one array
+    """
+    f = open(file, 'rb')
+    if f.read(len(_binary_magic)) != _binary_magic:
+        f.close()
+        raise IOError(file+" does not appear to be a MATK binary sampleset file")
+    hlen = struct.unpack('<Q', f.read(8))[0]
+    header = json.loads(f.read(hlen))
+    out = dict([(str(k),v) for k,v in header.items() if k != 'arrays'])
+    out['parnames'] = [str(nm) for nm in out['parnames']]
+    out['obsnames'] = [str(nm) for nm in out['obsnames']]
+    out['responses'] = None
+    for nm,a in header['arrays'].items():
+        shape = tuple(a['shape'])
+        if mmap and numpy.prod(shape) > 0:
+            out[str(nm)] = numpy.memmap(file, dtype=a['dtype'], mode=mode, offset=a['offset'], shape=shape)
+        else:
+            f.seek(a['offset'])
+            out[str(nm)] = numpy.fromfile(f, dtype=a['dtype'], count=int(numpy.prod(shape))).reshape(shape)
+    f.close()
+    values = out.pop('values')
+    npar = len(out['parnames'])
+    out['samples'] = values[:,:npar]
+    if len(out['obsnames']): out['responses'] = values[:,npar:]
+    return out
+
+def _owner(a):
+    """ Array whose buffer array a views, the last array in the chain of bases of a
+    """
+    while isinstance(getattr(a,'base',None), numpy.ndarray): a = a.base
+    return a
+
+def _view(a, shape, strides, dtype):
+    """ Array with shape, strides and dtype viewing the buffer of array a starting at the first element of a,
+        None if the buffer cannot be viewed (e.g. it is not contiguous)
+    """
+    owner = _owner(a)
+    offset = a.__array_interface__['data'][0] - owner.__array_interface__['data'][0]
+    try:
+        return numpy.ndarray(shape, dtype=dtype, buffer=owner, offset=offset, strides=strides)
+    except (TypeError,ValueError):
+        return None
+
+def _joined(a, b):
+    """ 2D view of the columns of a followed by the columns of b if a and b are adjacent column blocks of the same array, otherwise None
+    """
+    if not isinstance(a,numpy.ndarray) or not isinstance(b,numpy.ndarray): return None
+    if a.ndim != 2 or b.ndim != 2 or a.dtype != b.dtype or a.shape[0] != b.shape[0] or a.strides != b.strides: return None
+    if _owner(a) is not _owner(b): return None
+    if b.__array_interface__['data'][0] != a.__array_interface__['data'][0]+a.shape[1]*a.strides[1]: return None
+    return _view(a, (a.shape[0],a.shape[1]+b.shape[1]), a.strides, a.dtype)
+
+def _recview(values, names):
+    """ Record array with a field for each column of values, a view of values if the columns of each row are contiguous, otherwise a copy
+    """
+    names = list(names)
+    if isinstance(values,numpy.ndarray) and values.ndim == 2 and values.shape[1] == len(names) and values.dtype.fields is None \
+       and values.strides[1] == values.itemsize and values.strides[0] >= values.shape[1]*values.itemsize:
+        dtype = numpy.dtype({'names':names, 'formats':[values.dtype]*len(names), 
+                             'offsets':[i*values.itemsize for i in range(len(names))], 'itemsize':values.shape[1]*values.itemsize})
+        rc = _view(values, values.shape[:1], values.strides[:1], dtype)
+        if rc is not None: return rc.view(numpy.recarray)
+    return numpy.rec.fromarrays(numpy.asarray(values).T,names=names)
+
+def _hasnan(rc):
+    """ True if any field of record array contains NaN
+    """
+    return any([numpy.any(numpy.isnan(rc[nm])) for nm in rc.dtype.names])
+
 class DataSet(object):
     """ MATK Samples class
     """
     def __init__(self,samples,names,mins=None,maxs=None):
+        # Store rows contiguously so that recarray can be a view of values
+        if isinstance(samples,numpy.ndarray) and samples.ndim == 2 and not samples.strides[1] == samples.itemsize:
+            samples = numpy.ascontiguousarray(samples)
         self._values = samples
         self._names = names
         if mins is None: self._mins = [None]*self._values.shape[1]
@@ -421,10 +1049,17 @@ class DataSet(object):
         else:
             self._values = value
     @property
+    def filename(self):
+        """ Name of file that values are memory-mapped from, None if values are in memory
+        """
+        return getattr(self._values,'filename',None)
+    @property
     def recarray(self):
-        """ Structured (record) array of samples
+        """ Structured (record) array of values. The record array is a view of values if the
+            values of each row are contiguous (e.g. C-ordered arrays), so that changes to it
+            change the values, otherwise it is a copy.
         """
-        return numpy.rec.fromarrays(self._values.T,names=self._names)
+        return _recview(self._values,self._names)
     def hist(self, ncols=4, alpha=0.2, figsize=None, title=None, tight=False, mins=None, maxs=None,frequency=False,bins=10,ylim=None,printout=True,labels=[],filename=None,fontsize=None,xticks=3):
         """ Plot histograms of dataset
 
@@ -539,7 +1174,7 @@ def corr(rc1, rc2, type='pearson', plot=False, printout=True, plotvals=True, fig
         :type title: str
         :returns: ndarray(fl64) -- Correlation coefficients
     """
-    if numpy.any(numpy.isnan(rc1.tolist())) or numpy.any(numpy.isnan(rc2.tolist())):
+    if _hasnan(rc1) or _hasnan(rc2):
         print "Error: Nan values exist probably due to failed simulations. Use subset (e.g. subset([('obs','!=',numpy.nan)]) to remove"
         return
     corrlist = []
@@ -587,15 +1222,15 @@ def panels(rc, type='pearson', alpha=0.2, figsize=None, title=None, tight=False,
         if not fontsize is None:
             font = {'size': fontsize}
             mplrc('font', **font)
-        smp_mins = numpy.min(rc.tolist(),axis=0)
-        smp_maxs = numpy.max(rc.tolist(),axis=0)
+        smp_mins = numpy.array([numpy.min(rc[nm]) for nm in rc.dtype.names])
+        smp_maxs = numpy.array([numpy.max(rc[nm]) for nm in rc.dtype.names])
         if mins is None: mins = smp_mins
         else:
             mins = [ smp_mins[i] if mins[i] is None else mins[i] for i in range(len(mins)) ]
         if maxs is None: maxs = smp_maxs
         else:
             maxs = [ smp_maxs[i] if maxs[i] is None else maxs[i] for i in range(len(maxs)) ]
-        if numpy.any(numpy.isnan(rc.tolist())):
+        if _hasnan(rc):
             print "Error: Nan values exist probably due to failed simulations. Use subset (e.g. subset([('obs','!=',numpy.nan)]) to remove"
             return
         siz = len(rc.dtype)
@@ -717,15 +1352,15 @@ def hist(rc,ncols=4,figsize=None,alpha=0.2,title=None,tight=False,mins=None,maxs
         elif not len(labels) == len(rc.dtype.names):
             print "Error: number of labels does not match number of parameters"
             return
-        smp_mins = numpy.min(rc.tolist(),axis=0)
-        smp_maxs = numpy.max(rc.tolist(),axis=0)
+        smp_mins = numpy.array([numpy.min(rc[nm]) for nm in rc.dtype.names])
+        smp_maxs = numpy.array([numpy.max(rc[nm]) for nm in rc.dtype.names])
         if mins is None: mins = smp_mins
         else:
             mins = [ smp_mins[i] if mins[i] is None else mins[i] for i in range(len(mins)) ]
         if maxs is None: maxs = smp_maxs
         else:
             maxs = [ smp_maxs[i] if maxs[i] is None else maxs[i] for i in range(len(maxs)) ]
-        if numpy.any(numpy.isnan(rc.tolist())):
+        if _hasnan(rc):
             print "Error: Nan values exist probably due to failed simulations. Use subset (e.g. subset([('obs','!=',numpy.nan)]) to remove"
             return
         siz = len(rc.dtype)
@@ -739,8 +1374,6 @@ def hist(rc,ncols=4,figsize=None,alpha=0.2,title=None,tight=False,mins=None,maxs
         if figsize is None:
             figsize = (ncols*3,nrows*3)
         fig = plt.figure(figsize=figsize)
-        if mins is None: mins = numpy.min(rc.tolist(),axis=0)
-        if maxs is None: maxs = numpy.max(rc.tolist(),axis=0)
         hist_dict = OrderedDict()
         ns = []
         ax = []
@@ -0,0 +1,73 @@
+''' Staging of model run directories from a template directory using hard links '''
+import os
+import stat
+import shutil
+
+def link_tree(src, dst):
+    """ Stage directory dst from template directory src, creating the subdirectories of src
+        and hard linking its read-only files. Files with write permission, which a model could
+        modify in place, and files that cannot be hard linked (e.g. dst is on another file system)
+        are copied. Files that already exist in dst are kept.
+
+        :param src: Template directory
+        :type src: str
+        :param dst: Directory to stage, created if it does not exist
+        :type dst: str
+    """
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        d = dst if rel == os.curdir else os.path.join(dst, rel)
+        if not os.path.isdir(d): os.makedirs(d)
+        for f in files:
+            target = os.path.join(d, f)
+            if os.path.lexists(target): continue
+            _link(os.path.join(root, f), target)
+
+def reset_tree(src, dst, clean=True):
+    """ Restore staged directory dst to the state of template directory src so that it can be
+        reused for another model run. Template files that were removed or replaced are linked
+        again, and if clean is True, files and directories that are not in the template are removed.
+
+        :param src: Template directory
+        :type src: str
+        :param dst: Staged directory
+        :type dst: str
+        :param clean: If True, files and directories created by model runs are removed
+        :type clean: bool
+    """
+    for root, dirs, files in os.walk(dst):
+        rel = os.path.relpath(root, dst)
+        s = src if rel == os.curdir else os.path.join(src, rel)
+        for d in list(dirs):
+            if not os.path.isdir(os.path.join(s, d)):
+                if clean: shutil.rmtree(os.path.join(root, d))
+                dirs.remove(d)
+        for f in files:
+            target = os.path.join(root, f)
+            source = os.path.join(s, f)
+            if not os.path.isfile(source):
+                if clean: os.remove(target)
+            elif not _same(source, target):
+                os.remove(target)
+                _link(source, target)
+    link_tree(src, dst)
+
+def _link(src, dst):
+    # Writing to a linked file would modify the template and all staged directories
+    if os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        shutil.copy2(src, dst)
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _same(src, dst):
+    # Linked file, or unmodified copy of a file that could not be linked
+    try:
+        if os.path.samefile(src, dst): return True
+    except OSError:
+        return False
+    s1 = os.stat(src)
+    s2 = os.lstat(dst)
+    return s1.st_size == s2.st_size and s1.st_mtime == s2.st_mtime
@@ -0,0 +1,439 @@
+''' Persistent pool of worker processes for concurrent model evaluations '''
+import os
+import sys
+import select
+import traceback
+import signal
+import cPickle as pickle
+from time import time
+from Queue import Empty
+from multiprocessing import Process, Value
+from multiprocessing.queues import Queue
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+class WorkerPool(object):
+    """ MATK worker pool class - Long-lived set of processes, each holding a
+        copy of the parent MATK object, that run the model on parameter sets
+        put on a shared work queue. Idle workers take the next parameter sets
+        from the queue, so that faster hosts run more of a batch. Optionally,
+        parameter sets running longer than task_timeout are run again on idle
+        workers, and hosts that repeatedly fail are blacklisted.
+    """
+    def __init__(self, parent, cpus=1, task_timeout=None, max_failures=None):
+        self._parent = parent
+        self.cpus = cpus
+        self.task_timeout = task_timeout
+        self.max_failures = max_failures
+        self.stale = False
+        self._procs = []
+        self._pids = []
+        self._stopped = []
+        self._work = None
+        self._results = None
+        self._cancelled = None
+        self._batch = 0
+        self._busy = {}
+        self._blacklist = set()
+        self._failures = {}
+        self._new_batch()
+    @property
+    def cpus(self):
+        """ Number of worker processes; alternatively, dictionary of lists of processor ids keyed by hostnames
+        """
+        return self._cpus
+    @cpus.setter
+    def cpus(self,value):
+        self._cpus = value
+    @property
+    def task_timeout(self):
+        """ Number of seconds after which parameter sets that are still running are run again
+            on an idle worker, the first result to arrive is used; None to wait indefinitely
+        """
+        return self._task_timeout
+    @task_timeout.setter
+    def task_timeout(self,value):
+        if value is not None and not value > 0:
+            print "Error: task_timeout must be greater than zero"
+            return
+        self._task_timeout = value
+    @property
+    def max_failures(self):
+        """ Number of successive failed or timed out model runs on a host after which the host
+            is blacklisted and receives no more parameter sets; None to never blacklist hosts.
+            The last host with running workers is never blacklisted.
+        """
+        return self._max_failures
+    @max_failures.setter
+    def max_failures(self,value):
+        self._max_failures = value
+    @property
+    def blacklist(self):
+        """ List of blacklisted hostnames
+        """
+        return list(self._blacklist)
+    @property
+    def host_stats(self):
+        """ Dictionary of statistics of the last batch keyed by hostname (None for local workers),
+            each a dictionary with the number of parameter sets run ('runs'), failed runs ('failures'),
+            runs that exceeded task_timeout ('timeouts'), model run time summed over processors ('time'),
+            runs per second of batch wall time ('throughput') and whether the host is blacklisted ('blacklisted')
+        """
+        stats = OrderedDict()
+        for hostname,s in self._stats.items():
+            s = dict(s)
+            wall = s.pop('last') - self._t0
+            s['throughput'] = s['runs']/wall if wall > 0 else float('nan')
+            s['blacklisted'] = hostname in self._blacklist
+            stats[hostname] = s
+        return stats
+    @property
+    def started(self):
+        """ True if worker processes are running
+        """
+        return len(self._procs) > 0
+    @property
+    def size(self):
+        """ Number of running worker processes
+        """
+        return len(self._procs)
+    @property
+    def pids(self):
+        """ Process ids of all worker processes started by the pool, including stopped workers
+        """
+        return list(self._pids)
+    @property
+    def slots(self):
+        """ List of (hostname, processor) tuples, one for each worker process
+        """
+        if isinstance( self.cpus, dict ):
+            return [(k,v) for k,l in self.cpus.items() for v in l]
+        else:
+            return [(None,None)]*self.cpus
+    def start(self, nmax=None):
+        """ Start worker processes
+
+            :param nmax: Maximum number of worker processes to start
+            :type nmax: int
+        """
+        if self.started: return
+        slots = self.slots
+        if nmax is not None: slots = slots[:nmax]
+        self._work = Queue()
+        self._results = Queue()
+        self._cancelled = Value('i', self._batch)
+        for hostname,processor in slots:
+            stopped = Value('b', hostname in self._blacklist)
+            p = Process(target=self._parent.child, args=(self._work, self._results, hostname, processor, self._cancelled, stopped))
+            p.daemon = True
+            p.start()
+            p.hostname = hostname
+            self._procs.append(p)
+            self._pids.append(p.pid)
+            self._stopped.append(stopped)
+        self.stale = False
+    def shutdown(self):
+        """ Stop worker processes after queued work is finished. If task_timeout is set,
+            workers still running after task_timeout seconds (e.g. on hung hosts) are terminated.
+        """
+        if not self.started: return
+        for p in self._procs:
+            self._work.put(None)
+        for p in self._procs:
+            p.join(self.task_timeout)
+            if p.is_alive(): p.terminate()
+        self._procs = []
+        self._stopped = []
+        self._busy = {}
+        self._work.close()
+        self._results.close()
+        self._work = None
+        self._results = None
+        self._cancelled = None
+    def restart(self):
+        """ Restart worker processes so that they hold a current copy of the parent MATK object
+        """
+        self.shutdown()
+        self.start()
+    def submit(self, parsets, indices, workdir_base=None, save=True, reuse_dirs=False, chunksize=1, vectorized=False,
+               timeout=None, retries=0, backoff=1.):
+        """ Put parameter sets on the work queue
+
+            :param parsets: Parameter sets, one per row
+            :type parsets: ndarray(fl64)
+            :param indices: Sample indices used for working directories and error messages
+            :type indices: lst(int)
+            :param chunksize: Number of parameter sets sent to a worker at a time; if 'auto', parameter sets are split into about four chunks per worker
+            :type chunksize: int or str
+            :param vectorized: If True, the model is called once for each chunk with arrays of parameter values
+            :type vectorized: bool
+            :param timeout: Number of seconds after which a model run is stopped and counted as failed
+            :type timeout: fl64
+            :param retries: Number of times a failed or timed out model run is retried
+            :type retries: int
+            :param backoff: Number of seconds to wait before the first retry, doubled for each further retry
+            :type backoff: fl64
+            :returns: int -- batch id to pass to get
+        """
+        self._new_batch()
+        n = len(parsets)
+        if chunksize == 'auto':
+            chunksize, extra = divmod(n, 4*max(self.size,1))
+            if extra: chunksize += 1
+        chunksize = max(int(chunksize),1)
+        opts = {'workdir_base':workdir_base, 'save':save, 'reuse_dirs':reuse_dirs, 'vectorized':vectorized,
+                'timeout':timeout, 'retries':retries, 'backoff':backoff}
+        for lst_ind in range(0,n,chunksize):
+            self._put(('run', self._batch, lst_ind, indices[lst_ind:lst_ind+chunksize], parsets[lst_ind:lst_ind+chunksize], opts))
+        return self._batch
+    def cancel(self, batch=None):
+        """ Cancel parameter sets of a batch that have not been started, runs in progress
+            are finished but their results are discarded
+
+            :param batch: Batch id returned by submit, if None, the last batch is cancelled
+            :type batch: int
+        """
+        if not self.started: return
+        if batch is None: batch = self._batch
+        with self._cancelled.get_lock():
+            if batch > self._cancelled.value: self._cancelled.value = batch
+    def get(self, batch):
+        """ Get next finished result of batch, results left over from interrupted batches are discarded.
+            Results of submitted parameter sets are returned as tuple(sample indices, observation names,
+            ndarray of responses with a row for each parameter set in the chunk, list of (row, output) for failed runs,
+            list of (failure class, number of attempts) for each parameter set)
+
+            :param batch: Batch id returned by submit or map
+            :type batch: int
+            :returns: tuple(int,any) -- (list index of first item in chunk, result)
+        """
+        while True:
+            if self.task_timeout is None:
+                msg = self._results.get()
+            else:
+                # Wake up regularly to look for stragglers
+                try: msg = self._results.get(timeout=min(0.25*self.task_timeout,1.))
+                except Empty: msg = None
+            if msg is None:
+                self._redispatch()
+                continue
+            kind, b, lst_ind, resp, pid, hostname, elapsed = msg
+            if kind == 'start':
+                self._busy[pid] = b
+                if b == batch:
+                    self._queued -= 1
+                    self._running.setdefault(lst_ind, []).append((time(), hostname))
+                continue
+            self._busy.pop(pid, None)
+            if b != batch: continue
+            self._record(hostname, resp, elapsed)
+            # Discard results of parameter sets that were also run on another worker
+            if lst_ind in self._finished: continue
+            self._finished.add(lst_ind)
+            self._running.pop(lst_ind, None)
+            if self.task_timeout is not None: self._redispatch()
+            return lst_ind, resp
+    def running(self):
+        """ Process ids of workers running a model, including runs of cancelled batches and
+            copies of parameter sets that were also run on another worker. Results left on
+            the result queue are discarded.
+
+            :returns: set(int) -- process ids
+        """
+        if not self.started: return set()
+        while True:
+            try: msg = self._results.get(False)
+            except Empty: break
+            kind, b, lst_ind, resp, pid, hostname, elapsed = msg
+            if kind == 'start': self._busy[pid] = b
+            else: self._busy.pop(pid, None)
+        return set(self._busy.keys()) & set([p.pid for p in self._procs if p.is_alive()])
+    def results(self, batch, n):
+        """ Generator of finished chunk results of a batch of n submitted parameter sets
+
+            :param batch: Batch id returned by submit
+            :type batch: int
+            :param n: Number of parameter sets in batch
+            :type n: int
+        """
+        nrecv = 0
+        while nrecv < n:
+            lst_ind, resp = self.get(batch)
+            nrecv += len(resp[0])
+            yield lst_ind, resp
+    def map(self, func, iterable):
+        """ Apply function to each item of iterable in worker processes.
+            Allows the pool to be passed to emcee as its pool.
+
+            :param func: Picklable function taking a single argument
+            :type func: function
+            :param iterable: Function arguments
+            :type iterable: iterable
+            :returns: lst -- function outputs in order of iterable
+        """
+        self._new_batch()
+        n = 0
+        for lst_ind,arg in enumerate(iterable):
+            self._put(('call', self._batch, lst_ind, func, arg))
+            n += 1
+        out = [None]*n
+        errs = []
+        for i in range(n):
+            lst_ind, resp = self.get(self._batch)
+            if isinstance( resp, _CallError ):
+                errs.append(resp.msg)
+            out[lst_ind] = resp
+        if len(errs):
+            raise RuntimeError('\n'.join(errs))
+        return out
+    def _new_batch(self):
+        # Reset bookkeeping of tasks and host statistics for a new batch
+        self._batch += 1
+        self._tasks = {}
+        self._queued = 0
+        self._running = {}
+        self._finished = set()
+        self._stats = OrderedDict()
+        self._t0 = time()
+    def _put(self, task):
+        self._tasks[task[2]] = task
+        self._queued += 1
+        self._work.put(task)
+    def _host(self, hostname):
+        if hostname not in self._stats:
+            self._stats[hostname] = {'runs':0, 'failures':0, 'timeouts':0, 'time':0., 'last':self._t0}
+        return self._stats[hostname]
+    def _record(self, hostname, resp, elapsed):
+        # Update host statistics with a finished task
+        s = self._host(hostname)
+        if isinstance( resp, tuple ):
+            nruns = len(resp[0])
+            nfail = len(resp[3])
+        else:
+            nruns = 1
+            nfail = int(isinstance( resp, _CallError ))
+        s['runs'] += nruns
+        s['failures'] += nfail
+        s['time'] += elapsed
+        s['last'] = time()
+        if nfail: self._fail(hostname, nfail)
+        else: self._failures[hostname] = 0
+    def _workers_up(self):
+        # Process ids of live workers on hosts that are not blacklisted
+        return set([p.pid for p,s in zip(self._procs,self._stopped) if not s.value and p.is_alive()])
+    def _fail(self, hostname, n=1):
+        # Count successive failures of a host and blacklist host if there are too many
+        self._failures[hostname] = self._failures.get(hostname, 0) + n
+        if self.max_failures is None or hostname in self._blacklist: return
+        if self._failures[hostname] < self.max_failures: return
+        others = [p for p,s in zip(self._procs,self._stopped) if p.hostname != hostname and not s.value and p.is_alive()]
+        if len(others) == 0: return
+        print "Warning: Host " + str(hostname) + " blacklisted after " + str(self._failures[hostname]) + " successive failures"
+        self._blacklist.add(hostname)
+        for p,s in zip(self._procs,self._stopped):
+            if p.hostname == hostname: s.value = True
+    def _redispatch(self):
+        # Run parameter sets that exceeded task_timeout again on idle workers,
+        # once all parameter sets have been started
+        if self._queued > 0: return
+        nidle = len(self._workers_up() - set(self._busy.keys()))
+        if nidle <= 0: return
+        now = time()
+        stragglers = []
+        for lst_ind,starts in self._running.items():
+            tstart, hostname = starts[-1]
+            if now - tstart > self.task_timeout:
+                stragglers.append((tstart, lst_ind, hostname))
+        for tstart, lst_ind, hostname in sorted(stragglers)[:nidle]:
+            self._host(hostname)['timeouts'] += 1
+            self._fail(hostname)
+            self._put(self._tasks[lst_ind])
+    def __enter__(self):
+        self.start()
+        return self
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
+    def __getstate__(self):
+        raise TypeError('WorkerPool objects cannot be pickled')
+
+class Timeout(object):
+    """ Runner stopping function calls after timeout seconds of wall-clock time. On posix systems
+        the function is called in a forked process leading its own process group, and the group,
+        including external processes started by the model, is killed when the timeout expires.
+        Changes the function makes to the calling process (e.g. its working directory or the
+        attributes of the MATK object) are discarded, only its output is returned.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.expired = False
+    def call(self, func):
+        """ Call func without arguments
+
+            :param func: Function to call, its output must be picklable
+            :type func: function
+            :returns: any -- output of func, or error string if the timeout expired or the process running func died
+        """
+        self.expired = False
+        if self.timeout is None: return func()
+        if not hasattr(os, 'fork'):
+            print "Warning: Model run timeout only available on posix systems, timeout ignored"
+            return func()
+        r, w = os.pipe()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                os.setpgid(0, 0)
+                try: out = func()
+                except: out = traceback.format_exc()
+                f = os.fdopen(w, 'wb')
+                try: pickle.dump(out, f, pickle.HIGHEST_PROTOCOL)
+                except: pickle.dump(traceback.format_exc(), f, pickle.HIGHEST_PROTOCOL)
+                f.close()
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        os.close(w)
+        # Also set process group here, in case the timeout expires before the child sets it
+        try: os.setpgid(pid, pid)
+        except OSError: pass
+        deadline = time() + self.timeout
+        data = []
+        done = False
+        while not done and time() < deadline:
+            try: ready = select.select([r], [], [], max(deadline - time(), 0.))[0]
+            except select.error: continue
+            if ready:
+                chunk = os.read(r, 65536)
+                if chunk: data.append(chunk)
+                else: done = True
+        os.close(r)
+        if not done:
+            self.expired = True
+            try: os.killpg(pid, signal.SIGKILL)
+            except OSError: pass
+        os.waitpid(pid, 0)
+        if not done:
+            return "Model run exceeded timeout of "+str(self.timeout)+" seconds"
+        if not len(data):
+            return "Model run process died without output"
+        return pickle.loads(''.join(data))
+
+class _CallError(object):
+    """ Wrapper for traceback of exception raised in function applied by WorkerPool.map
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+def call(func, arg):
+    """ Call func with arg, wrapping any exception traceback in a _CallError
+    """
+    try:
+        return func(arg)
+    except:
+        return _CallError(traceback.format_exc())
+
@@ -0,0 +1,69 @@
+''' Benchmark of Latin hypercube sampling against the previous loop based implementation
+
+    USAGE: python benchmark_lhs.py [nsamples] [npars] [dtype]
+'''
+import sys,os
+try:
+    from matk.lhs import lhs
+except:
+    try:
+        sys.path.append(os.path.join('..','src','matk'))
+        from lhs import lhs
+    except ImportError as err:
+        print 'Unable to load MATK module: '+str(err)
+import numpy
+import scipy.stats as stats
+from numpy.random import uniform, shuffle
+from numpy.linalg import cholesky,inv
+from time import time
+
+if len(sys.argv) > 1: nsamples = int(float(sys.argv[1]))
+else: nsamples = 100000
+if len(sys.argv) > 2: npars = int(sys.argv[2])
+else: npars = 20
+if len(sys.argv) > 3: dtype = sys.argv[3]
+else: dtype = 'float64'
+
+def lhs_loop(dists, parms, siz=100, noCorrRestr=False, seed=None):
+    # Previous implementation of lhs.lhs with uncorrelated restriction
+    if seed: numpy.random.seed( seed )
+    nvars = len(dists)
+    if noCorrRestr:
+        inds = numpy.arange(siz)
+        indices = []
+        for i in xrange(nvars):
+            shuffle(inds)
+            indices.append(inds.copy())
+    else:
+        s=stats.norm().ppf(numpy.arange(1.,siz+1)/(siz+1.))
+        s1 = []
+        for i in xrange(nvars):
+            shuffle(s)
+            s1.append(s.copy())
+        S=numpy.matrix(s1)
+        P=cholesky(numpy.identity(nvars))
+        Q=cholesky(numpy.corrcoef(S))
+        Final=S.transpose()*inv(Q).transpose()*P.transpose()
+        indices = [stats.stats.rankdata(Final.transpose()[i,]) for i in xrange(nvars)]
+    smplist = []
+    for j,d in enumerate(dists):
+        step = 1./(siz)
+        perc = numpy.arange(0, 1, step)
+        s_pos = [uniform(i, i+ step) for i in perc[:]]
+        v = d(*parms[j]).ppf(s_pos)
+        smplist.append(v[map(int,indices[j]-1)])
+    return numpy.array(smplist).transpose()
+
+dists = [stats.uniform,stats.norm]*(npars/2) + [stats.uniform]*(npars%2)
+parms = [(0.,1.),(0.,1.)]*(npars/2) + [(0.,1.)]*(npars%2)
+print "Samples: %d, Parameters: %d" % (nsamples, npars)
+for noCorrRestr in [True,False]:
+    t0 = time()
+    x0 = lhs_loop(dists, parms, siz=nsamples, noCorrRestr=noCorrRestr, seed=1000)
+    tloop = time()-t0
+    t0 = time()
+    x = lhs(dists, parms, siz=nsamples, noCorrRestr=noCorrRestr, seed=1000, dtype=dtype)
+    tvec = time()-t0
+    print "noCorrRestr=%-5s loop: %8.2f s  vectorized (%s): %8.2f s  speedup: %6.1f  max difference: %g" % (noCorrRestr, tloop, dtype, tvec, tloop/tvec, numpy.abs(x-x0).max())
+    print "%18s memory: %8.1f MB  vectorized memory: %8.1f MB" % ('', x0.nbytes/1.e6, x.nbytes/1.e6)
+    del x0, x
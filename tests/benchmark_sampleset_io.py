@@ -0,0 +1,41 @@
+''' Benchmark of writing and reading MATK sample files
+
+    USAGE: python benchmark_sampleset_io.py [nsamples] [npars]
+'''
+import sys,os
+try:
+    import matk
+except:
+    try:
+        sys.path.append(os.path.join('..','src','matk'))
+        import matk
+    except ImportError as err:
+        print 'Unable to load MATK module: '+str(err)
+import numpy
+from time import time
+
+if len(sys.argv) > 1: nsamples = int(float(sys.argv[1]))
+else: nsamples = 1000000
+if len(sys.argv) > 2: npars = int(sys.argv[2])
+else: npars = 50
+
+p = matk.matk()
+for i in range(npars):
+    p.add_par('par'+str(i+1), min=0., max=1.)
+ss = p.create_sampleset(numpy.random.rand(nsamples,npars))
+
+print "Samples: %d, Parameters: %d" % (nsamples, npars)
+for fmt,write,read in [('text', lambda f: ss.savetxt(f), lambda f: p.read_sampleset(f)),
+                       ('binary', lambda f: ss.save(f), lambda f: p.load_sampleset(f))]:
+    fname = 'benchmark_sampleset_io.'+fmt
+    t0 = time()
+    write(fname)
+    twrite = time()-t0
+    mb = os.path.getsize(fname)/1.e6
+    t0 = time()
+    rs = read(fname)
+    tread = time()-t0
+    print "%-8s write: %8.2f s %10.0f rows/s %8.1f MB/s" % (fmt, twrite, nsamples/twrite, mb/twrite)
+    print "%-8s  read: %8.2f s %10.0f rows/s %8.1f MB/s" % (fmt, tread, nsamples/tread, mb/tread)
+    del rs
+    os.remove(fname)
@@ -8,10 +8,17 @@ except:
         import matk
     except ImportError as err:
         print 'Unable to load MATK module: '+str(err)
+import pest_io
+import lhs
 from exp_model_int import dbexpl
 from sine_decay_model import sine_decay
 import numpy
+import scipy.sparse
+import time
+import subprocess
 from cPickle import dump, load, PicklingError
+from shutil import rmtree
+import glob
 
 def fv(a):
     ''' Exponential function from marquardt.py
@@ -23,6 +30,49 @@ def fv(a):
     out = a0 / (1. + a1 * numpy.exp( X * a2))
     return out 
 
+def fslow(a):
+    ''' Slow version of fv
+    '''
+    time.sleep(0.05)
+    return fv(a)
+
+def fhung(a, hostname=None, processor=None):
+    ''' Version of fv that hangs on host 'slow'
+    '''
+    if hostname == 'slow': time.sleep(30)
+    return fv(a)
+
+def fbad(a):
+    ''' Version of fv that hangs or fails in parts of parameter space
+    '''
+    if a['a0'] > 0.75: time.sleep(30)
+    if a['a1'] > 10.5: raise ValueError('a1 too large')
+    return fv(a)
+
+def fexternal(a):
+    ''' Model waiting for a hung external process
+    '''
+    p = subprocess.Popen(['sleep','30'])
+    open('fexternal.pid','w').write(str(p.pid))
+    p.wait()
+    return [a['a0']]
+
+def ftemplate(a):
+    ''' Model reading input file staged from template directory
+    '''
+    c = float(open(os.path.join('sub','input.txt')).read())
+    stale = os.path.exists('out.txt')
+    open('out.txt','w').write(str(a['a0']))
+    # Overwrite writable file staged from template directory
+    if os.path.exists('log.txt'): open('log.txt','w').write(str(a['a0']))
+    return [c*a['a0'], float(stale), float(os.stat(os.path.join('sub','input.txt')).st_ino)]
+
+def fhungtemplate(a, hostname=None, processor=None):
+    ''' Version of ftemplate that hangs on host 'slow'
+    '''
+    if hostname == 'slow': time.sleep(1.5)
+    return ftemplate(a)
+
 # Define basic function for mcmc
 def fmcmc(pars):
     a = pars['a']
@@ -31,6 +81,16 @@ def fmcmc(pars):
     m=a*(m**2)+c
     return m
 
+def fvec(a):
+    ''' Vectorized version of fv, parameter values are arrays
+    '''
+    X = numpy.array([1.,2.,3.,4.,5.,6.,7.,8.,9.,10.,11.,12.])
+    return a['a0'][:,None] / (1. + a['a1'][:,None] * numpy.exp( X * a['a2'][:,None]))
+
+def fvecslow(a):
+    time.sleep(0.2)
+    return fvec(a)
+
 #Define basic function for emcee
 def femcee(args):
         return numpy.array([args["k"] * 1, args["k"] * 2, args["k"] * 3])
@@ -76,6 +136,114 @@ class Tests(unittest.TestCase):
         lb = self.p.parmins
         ub = self.p.parmaxs
         self.assertTrue( (maxs >= lb).any() and (mins <= ub).any(), 'Sample outside parameter bounds' )
+        # One sample in each of the equal probability strata of each parameter
+        s = self.p.lhs(siz=100,seed=1000).samples.values
+        strata = numpy.floor( (s-lb)/(numpy.array(ub)-lb)*100 )
+        self.assertTrue( all([numpy.array_equal(numpy.sort(c),numpy.arange(100)) for c in strata.T]), 'Sample is not a Latin hypercube' )
+        s32 = self.p.lhs(siz=100,seed=1000,dtype='float32').samples.values
+        self.assertEqual( s32.dtype, numpy.float32, 'Sample data type is incorrect' )
+        self.assertTrue( numpy.allclose(s32, s, atol=1.e-6), 'Single precision sample does not match double precision sample' )
+        # Sample transformed in blocks of variables matches sample transformed at once
+        dists = self.p._dists()*3
+        pars = self.p.pardist_pars*3
+        s = lhs.lhs(dists, pars, siz=100, seed=1000)
+        sb = lhs.lhs(dists, pars, siz=100, seed=1000, dtype='float32', blocksize=250)
+        self.assertTrue( numpy.array_equal(sb, s.astype('float32')), 'Sample transformed in blocks is incorrect' )
+
+    def testsample_expr(self):
+        # Parameters with expressions are evaluated on whole sample columns, conditional expressions row by row
+        self.p.add_par('par5',expr='2*par1+sqrt(par2)')
+        self.p.add_par('par6',expr='par1 if par1 > 0.5 else par5')
+        s = self.p.lhs(siz=10,seed=1000).samples.values
+        self.assertTrue( numpy.allclose(s[:,4], 2*s[:,0]+numpy.sqrt(s[:,1])), 'Sampled parameter expression values are incorrect' )
+        self.assertTrue( numpy.allclose(s[:,5], numpy.where(s[:,0]>0.5,s[:,0],s[:,4])), 'Sampled conditional parameter expression values are incorrect' )
+        self.p.forward(pardict={'par1':0.25,'par2':0.04,'par3':0.5,'par4':0.1})
+        self.assertEqual( self.p.parvalues[4:], [0.7,0.7], 'Parameter expression values of forward run are incorrect' )
+        # Expressions are compiled once
+        aeval = self.p._compile_exprs()[0]
+        self.p.lhs(siz=10,seed=1000)
+        self.p.forward(pardict={'par1':0.75,'par2':0.04,'par3':0.5,'par4':0.1})
+        self.assertTrue( self.p._compile_exprs()[0] is aeval, 'Parameter expressions were compiled again' )
+        self.assertEqual( self.p.parvalues[4:], [1.7,0.75], 'Parameter expression values of forward run are incorrect' )
+        # Expressions that cannot be evaluated are NaN
+        self.p.pars['par6'].expr = 'par1 + undefined'
+        s = self.p._eval_exprs( [[0.5,0.1,0.5,0.1,0.,0.]] )
+        self.assertTrue( numpy.isnan(s[0,5]) and s[0,4] == 1.+numpy.sqrt(0.1), 'Expression that cannot be evaluated is not NaN' )
+
+    def testsample_corr(self):
+        # Block diagonal correlation matrix, dense and sparse
+        C = numpy.identity(4)
+        C[0,1] = C[1,0] = 0.8
+        C[2,3] = C[3,2] = -0.5
+        s = self.p.lhs(siz=2000,corrmat=C,seed=1000).samples.values
+        T,R,maxdiff,rmsdiff = lhs.corr_report(s, C, printout=False)
+        self.assertTrue( maxdiff < 0.05, 'Correlation of sample does not match correlation matrix' )
+        self.assertTrue( abs(R[0,1]-0.8) < 0.05 and abs(R[2,3]+0.5) < 0.05, 'Correlation of sample does not match correlation matrix' )
+        ssp = self.p.lhs(siz=2000,corrmat=scipy.sparse.csr_matrix(C),seed=1000).samples.values
+        self.assertTrue( numpy.array_equal(ssp, s), 'Sample with sparse correlation matrix does not match dense correlation matrix' )
+        blocks = lhs.corr_blocks(C, 4)
+        self.assertEqual( [list(b) for b,c in blocks], [[0,1],[2,3]], 'Blocks of correlation matrix are incorrect' )
+
+    def testsample_maximin(self):
+        # Space-filling design has larger minimum distance between samples and is still a Latin hypercube
+        s = self.p.lhs(siz=50,seed=1000).samples.values
+        sm = self.p.lhs(siz=50,seed=1000,criterion='maximin').samples.values
+        lb = numpy.array(self.p.parmins)
+        ub = numpy.array(self.p.parmaxs)
+        mindist = lambda x: min([numpy.sqrt((((x[i+1:]-x[i])/(ub-lb))**2).sum(axis=1)).min() for i in range(len(x)-1)])
+        self.assertTrue( mindist(sm) > mindist(s), 'Maximin design does not increase minimum distance between samples' )
+        strata = numpy.floor( (sm-lb)/(ub-lb)*50 )
+        self.assertTrue( all([numpy.array_equal(numpy.sort(c),numpy.arange(50)) for c in strata.T]), 'Maximin design is not a Latin hypercube' )
+
+    def testsample_qmc(self):
+        # Sobol samples are balanced in each parameter and sequences can be continued
+        lb = numpy.array(self.p.parmins)
+        ub = numpy.array(self.p.parmaxs)
+        for method in [self.p.sobol, self.p.halton]:
+            ss = method(siz=64,seed=1000)
+            s = ss.samples.values
+            self.assertTrue( (s >= lb).all() and (s <= ub).all(), 'Low-discrepancy sample outside parameter bounds' )
+            ss2 = method(siz=32,seed=1000,skip=ss.sequence['skip'])
+            ss3 = method(siz=96,seed=1000)
+            self.assertTrue( numpy.allclose(ss3.samples.values[64:], ss2.samples.values), 'Continued low-discrepancy sequence does not match' )
+        strata = numpy.floor( (self.p.sobol(siz=64,seed=1000).samples.values-lb)/(ub-lb)*64 )
+        self.assertTrue( all([numpy.array_equal(numpy.sort(c),numpy.arange(64)) for c in strata.T]), 'Sobol sample is not balanced' )
+        u = matk.qmc.sobol(4, 2, scramble=False)
+        self.assertTrue( numpy.array_equal(u, [[0.,0.],[0.5,0.5],[0.75,0.25],[0.25,0.75]]), 'Sobol sequence is incorrect' )
+
+    def testextend(self):
+        # Doubled Latin hypercube is a Latin hypercube, only new samples are run
+        ss = self.p.lhs(siz=10,seed=1000)
+        ss.run( verbose=False )
+        ss.responses.values[0,0] = 999.
+        out = ss.extend(10, seed=1001, verbose=False)
+        self.assertTrue( numpy.array_equal(ss.indices, numpy.arange(1,21)), 'Indices of extended sampleset are incorrect' )
+        self.assertEqual( ss.responses.values[0,0], 999., 'Existing samples were run again' )
+        self.assertTrue( numpy.array_equal(out, ss.responses.values[10:]) and not numpy.any(numpy.isnan(out)), 'Responses of new samples are incorrect' )
+        lb = numpy.array(self.p.parmins)
+        ub = numpy.array(self.p.parmaxs)
+        strata = numpy.floor( (ss.samples.values-lb)/(ub-lb)*20 )
+        self.assertTrue( all([numpy.array_equal(numpy.sort(c),numpy.arange(20)) for c in strata.T]), 'Extended sample is not a Latin hypercube' )
+        # Responses of existing samples are kept in outfile if run of new samples is interrupted
+        ss = self.p.lhs(siz=10,seed=1000)
+        ss.run( verbose=False, outfile='test_results.dat' )
+        iparallel = self.p._iparallel
+        def interrupted(*args, **kwargs):
+            for chunk in iparallel(*args, **kwargs):
+                yield chunk
+                raise KeyboardInterrupt
+        self.p._iparallel = interrupted
+        try: ss.extend(10, seed=1001, verbose=False, outfile='test_results.dat')
+        except KeyboardInterrupt: pass
+        del self.p._iparallel
+        parnames, obsnames, indices, samples, responses = matk.read_outfile('test_results.dat')
+        os.remove('test_results.dat')
+        recorded = set([ind for ind,r in zip(indices,responses) if not numpy.any(numpy.isnan(r))])
+        self.assertTrue( set(range(1,12)) <= recorded, 'Responses in outfile lost by interrupted run of new samples' )
+        # Low-discrepancy sequence is continued
+        ss = self.p.sobol(siz=8,seed=1000)
+        ss.extend(8, run=False)
+        self.assertTrue( numpy.allclose(ss.samples.values, self.p.sobol(siz=16,seed=1000).samples.values), 'Extended Sobol sequence is incorrect' )
 
     def testparallel(self):
         # Without working directories
@@ -86,6 +254,11 @@ class Tests(unittest.TestCase):
             self.p.forward()
             self.p.obsvalues =  out
             self.assertTrue( sum(self.p.residuals) == 0., 'A parallel run does not match a forward run' )
+        # Chunked dispatch
+        for chunksize in [3,'auto']:
+            out = ss.responses.values.copy()
+            ss.run( cpus=2, save=False, verbose=False, chunksize=chunksize)
+            self.assertTrue( numpy.array_equal(out, ss.responses.values), 'Chunked parallel run does not match unchunked run' )
 
     def testparallel_workdir(self):
         # With working directories
@@ -99,6 +272,307 @@ class Tests(unittest.TestCase):
             self.p.obsvalues = out 
             self.assertTrue( sum(self.p.residuals) == 0., 'A parallel run with a working directory does not match a forward run' )
 
+    def testtemplate_dir(self):
+        os.makedirs(os.path.join('template','sub'))
+        open(os.path.join('template','sub','input.txt'),'w').write('2.0')
+        # Read-only files are linked, writable files are copied
+        os.chmod(os.path.join('template','sub','input.txt'), 0444)
+        open(os.path.join('template','log.txt'),'w').write('template')
+        ino = os.stat(os.path.join('template','sub','input.txt')).st_ino
+        s = matk.matk(model=ftemplate)
+        s.add_par('a0', min=0.6, max=0.8)
+        s.add_par('a1', min=9., max=11.)
+        ss = s.lhs(siz=10)
+        # Pooled working directories, directories of other runs are kept
+        os.makedirs('tworkdir.pool.other')
+        ss.run( cpus=2, verbose=False, workdir_base='tworkdir', template_dir='template', save=False )
+        self.assertEqual( glob.glob('tworkdir.*'), ['tworkdir.pool.other'], 'Pooled working directory of other run was removed' )
+        rmtree('tworkdir.pool.other')
+        self.assertTrue( numpy.allclose(ss.responses.values[:,0], 2.*ss.samples.values[:,0]), 'Template input file not read' )
+        self.assertTrue( numpy.all(ss.responses.values[:,1] == 0.), 'Pooled working directory was not reset' )
+        self.assertTrue( numpy.all(ss.responses.values[:,2] == ino), 'Template input file was not hard linked' )
+        self.assertEqual( len(glob.glob('tworkdir.*')), 0, 'Pooled working directories were not removed' )
+        # Saved working directories
+        ss.run( cpus=2, verbose=False, workdir_base='tworkdir', save=True )
+        self.assertTrue( numpy.all(ss.responses.values[:,2] == ino), 'Template input file was not hard linked' )
+        self.assertEqual( len(glob.glob('tworkdir.*')), 10, 'Working directories were not saved' )
+        self.assertEqual( open(os.path.join('template','log.txt')).read(), 'template', 'Writable template file was modified by model' )
+        for d in glob.glob('tworkdir.*'): rmtree(d)
+        # Pooled working directory of straggler still running on a persistent worker is kept
+        s = matk.matk(model=fhungtemplate)
+        s.add_par('a0', min=0.6, max=0.8)
+        s.add_par('a1', min=9., max=11.)
+        ss = s.lhs(siz=4)
+        s.start( cpus={'fast':[0],'slow':[0]}, task_timeout=0.3, max_failures=1 )
+        try:
+            ss.run( verbose=False, workdir_base='tworkdir', template_dir='template', save=False )
+            slow = [p.pid for p in s.workers._procs if p.hostname == 'slow']
+            self.assertEqual( glob.glob('tworkdir.*'), ['tworkdir.pool.'+str(slow[0])], 'Pooled working directory in use was removed' )
+            time.sleep(1.5)
+            ss.run( verbose=False, workdir_base='tworkdir', template_dir='template', save=False )
+            self.assertFalse( numpy.any(numpy.isnan(ss.responses.values)), 'Samples are missing responses' )
+            self.assertEqual( len(glob.glob('tworkdir.*')), 0, 'Pooled working directories were not removed' )
+        finally:
+            s.shutdown()
+        rmtree('template')
+
+    def testworkers(self):
+        # Persistent workers reused across runs
+        with self.p:
+            pid = [w.pid for w in self.p.workers._procs]
+            ss = self.p.lhs(siz=10 )
+            ss.run( cpus=2, save=False, verbose=False)
+            ss2 = self.p.lhs(siz=10 )
+            ss2.run( cpus=2, save=False, verbose=False)
+            self.assertTrue( [w.pid for w in self.p.workers._procs] == pid, 'Worker processes were not reused' )
+            # Replacing an existing observation outdates the workers' copy of the problem
+            self.p.add_obs('obs1', value=self.p.obs['obs1'].value)
+            self.assertTrue( self.p.workers.stale, 'Workers not flagged as outdated after observation was replaced' )
+            ss2.run( cpus=2, save=False, verbose=False)
+            try: dump( self.p, open('test.p', 'wb'))
+            except PicklingError: dumpbool = False
+            else: dumpbool = True
+            os.remove('test.p')
+            self.assertTrue( dumpbool, 'MATK object with started workers cannot be pickled' )
+        self.assertTrue( self.p.workers is None, 'Workers not shut down' )
+        for smp,out in zip(ss2.samples.values,ss2.responses.values):
+            self.p.parvalues = smp
+            self.p.forward()
+            self.p.obsvalues =  out
+            self.assertTrue( sum(self.p.residuals) == 0., 'A run on persistent workers does not match a forward run' )
+
+    def testrun_async(self):
+        ss = self.p.lhs(siz=10 )
+        future = ss.run_async( cpus=2, save=False )
+        out = future.result().copy()
+        self.assertTrue( future.done() and future.progress == 1., 'Asynchronous run did not finish' )
+        ss.run( cpus=2, save=False, verbose=False)
+        self.assertTrue( numpy.array_equal(out, ss.responses.values), 'Asynchronous run does not match run' )
+        # Cancel run, responses of finished samples are kept
+        s = matk.matk(model=fslow)
+        s.add_par('a0', min=0.6, max=0.8)
+        s.add_par('a1', min=9., max=11.)
+        s.add_par('a2', min=-0.5, max=-0.3)
+        ss = s.lhs(siz=40)
+        future = ss.run_async( cpus=2 )
+        while future.ndone == 0: time.sleep(0.01)
+        self.assertTrue( future.cancel(), 'Asynchronous run could not be cancelled' )
+        future.result()
+        self.assertTrue( future.cancelled() and future.ndone < 40, 'Asynchronous run was not cancelled' )
+        self.assertFalse( numpy.any(numpy.isnan(future.responses[future.finished])), 'Responses of finished samples are missing' )
+        self.assertTrue( numpy.all(numpy.isnan(ss.responses.values[~future.finished])), 'Unfinished samples have responses' )
+        # Vectorized model on a single cpu is run in chunks, without changing the working directory of this process
+        v = matk.matk(model=fvecslow, vectorized=True, workdir_base='vecworkdir')
+        v.add_par('a0', min=0.5, max=1.)
+        v.add_par('a1', min=5., max=15.)
+        v.add_par('a2', min=-0.5, max=-0.3)
+        ss = v.lhs(siz=40)
+        curdir = os.getcwd()
+        future = ss.run_async( cpus=1, save=False )
+        cwds = set()
+        while future.ndone == 0 and future.running():
+            cwds.add(os.getcwd())
+            time.sleep(0.01)
+        self.assertTrue( cwds <= set([curdir]), 'Asynchronous vectorized run changed working directory' )
+        self.assertTrue( future.cancel(), 'Asynchronous vectorized run could not be cancelled' )
+        future.result()
+        self.assertTrue( 0 < future.ndone < 40, 'Asynchronous vectorized run did not report progress or was not cancelled' )
+        self.assertFalse( numpy.any(numpy.isnan(future.responses[future.finished])), 'Responses of finished vectorized samples are missing' )
+
+    def teststragglers(self):
+        s = matk.matk(model=fhung)
+        s.add_par('a0', min=0.6, max=0.8)
+        s.add_par('a1', min=9., max=11.)
+        s.add_par('a2', min=-0.5, max=-0.3)
+        ss = s.lhs(siz=6)
+        t0 = time.time()
+        ss.run( cpus={'fast':[0],'slow':[0]}, verbose=False, task_timeout=0.5, max_failures=1 )
+        self.assertTrue( time.time() - t0 < 10., 'Sample hung on slow host was not run again' )
+        self.assertFalse( numpy.any(numpy.isnan(ss.responses.values)), 'Samples are missing responses' )
+        self.assertEqual( s.host_stats['fast']['runs'], 6, 'Incorrect number of runs on fast host' )
+        self.assertEqual( s.host_stats['slow']['timeouts'], 1, 'Timeout on slow host not recorded' )
+        self.assertTrue( s.host_stats['slow']['blacklisted'], 'Slow host was not blacklisted' )
+
+    def testtimeout(self):
+        s = matk.matk(model=fbad)
+        s.add_par('a0', min=0.6, max=0.8)
+        s.add_par('a1', min=9., max=11.)
+        s.add_par('a2', min=-0.5, max=-0.3)
+        ss = s.lhs(siz=8, seed=1000)
+        t0 = time.time()
+        ss.run( cpus=2, verbose=False, timeout=0.5, retries=1, backoff=0.1 )
+        self.assertTrue( time.time() - t0 < 10., 'Hung model runs were not stopped' )
+        hung = ss.samples.values[:,0] > 0.75
+        error = ~hung & (ss.samples.values[:,1] > 10.5)
+        self.assertTrue( numpy.all(ss.status[hung] == 'timeout'), 'Timed out runs not recorded' )
+        self.assertTrue( numpy.all(ss.status[error] == 'error'), 'Failed runs not recorded' )
+        self.assertTrue( numpy.all(ss.status[~hung & ~error] == 'success'), 'Successful runs not recorded' )
+        self.assertTrue( numpy.all(ss.attempts[hung | error] == 2) and numpy.all(ss.attempts[~hung & ~error] == 1), 'Incorrect number of attempts' )
+        self.assertTrue( numpy.array_equal(ss.failed, hung | error), 'Incorrect failed samples' )
+        self.assertTrue( numpy.all(numpy.isnan(ss.responses.values[hung | error])), 'Failed runs have responses' )
+        # External processes of timed out runs are killed
+        se = matk.matk(model=fexternal)
+        se.add_par('a0', min=0.6, max=0.8)
+        sse = se.create_sampleset([[0.7]])
+        sse.run( cpus=1, verbose=False, timeout=0.5 )
+        self.assertEqual( sse.status[0], 'timeout', 'Run waiting for external process did not time out' )
+        pid = int(open('fexternal.pid').read())
+        os.remove('fexternal.pid')
+        time.sleep(0.1)
+        if os.path.isdir('/proc'):
+            # Killed process may be left as zombie if its new parent does not reap it
+            alive = os.path.isfile('/proc/%d/stat' % pid) and not open('/proc/%d/stat' % pid).read().split()[2] == 'Z'
+            self.assertFalse( alive, 'External process of timed out run was not killed' )
+        # Responses are NaN if all runs fail
+        ssf = s.create_sampleset([[0.7,11.,-0.4]]*2)
+        ssf.run( cpus=2, verbose=False )
+        self.assertEqual( ssf.responses.values.shape, (2,len(s.obs)), 'Shape of responses of failed runs is incorrect' )
+        self.assertTrue( numpy.all(numpy.isnan(ssf.responses.values)), 'Failed runs have responses' )
+        out, parsets = s.parallel( ssf.samples.values, cpus=2, verbose=False )
+        self.assertTrue( out.shape == (2,len(s.obs)) and numpy.all(numpy.isnan(out)), 'Responses of failed parallel runs are incorrect' )
+
+    def testvectorized(self):
+        v = matk.matk(model=fvec, vectorized=True)
+        v.add_par('a0', value=0.7, min=0.5, max=1.)
+        v.add_par('a1', value=10., min=5., max=15.)
+        v.add_par('a2', value=-0.4, min=-0.5, max=-0.3)
+        ss = self.j.create_sampleset(v.lhs(siz=10).samples.values)
+        ss.run( verbose=False )
+        vs = v.create_sampleset(ss.samples.values)
+        for cpus in [1,2]:
+            vs.run( cpus=cpus, verbose=False )
+            self.assertTrue( numpy.allclose(vs.responses.values, ss.responses.values), 'Vectorized run does not match run with a call per sample' )
+        v.forward()
+        self.j.forward()
+        self.assertTrue( numpy.allclose(v.simvalues, self.j.simvalues), 'Vectorized forward run does not match forward run' )
+        self.assertTrue( numpy.allclose(v.Jac(), self.j.Jac()), 'Vectorized Jacobian does not match Jacobian' )
+
+    def testoutfile(self):
+        ss = self.p.lhs(siz=10 )
+        ss.run( cpus=2, verbose=False, outfile='test_results.dat', chunksize=3)
+        rs = self.p.read_sampleset('test_results.dat')
+        self.assertTrue( numpy.array_equal(rs.indices, ss.indices), 'Indices read from results file do not match' )
+        self.assertTrue( numpy.allclose(rs.responses.values, ss.responses.values, rtol=1.e-5), 'Responses read from results file do not match' )
+        # Results of an interrupted run can be read
+        lines = open('test_results.dat').readlines()
+        open('test_results.dat','w').write(''.join(lines[:8])+lines[8][:20])
+        rs = self.p.read_sampleset('test_results.dat')
+        os.remove('test_results.dat')
+        self.assertTrue( numpy.array_equal(rs.indices, ss.indices[:5]), 'Incomplete results file not read correctly' )
+
+    def testresume(self):
+        ss = self.p.lhs(siz=10 )
+        ss.run( cpus=2, verbose=False, outfile='test_results.dat')
+        out = ss.responses.values.copy()
+        # Simulate interrupted run
+        lines = open('test_results.dat').readlines()
+        open('test_results.dat','w').write(''.join(lines[:7])+lines[7][:20])
+        ss.responses = None
+        ss.run( cpus=2, verbose=False, outfile='test_results.dat', logfile='test_log.dat', resume=True)
+        nruns = len(open('test_log.dat').readlines()) - 1
+        os.remove('test_log.dat')
+        os.remove('test_results.dat')
+        self.assertTrue( nruns == 6, 'Resumed run did not skip completed samples: '+str(nruns)+' samples run' )
+        self.assertTrue( numpy.allclose(out, ss.responses.values, rtol=1.e-5), 'Responses of resumed run do not match' )
+
+    def testbinary(self):
+        ss = self.p.lhs(siz=10 )
+        ss.run( cpus=2, verbose=False )
+        ss.save('test_results.mss')
+        for mmap in [True,False]:
+            bs = self.p.load_sampleset('test_results.mss', mmap=mmap)
+            self.assertTrue( numpy.array_equal(bs.indices, ss.indices), 'Indices read from binary file do not match' )
+            self.assertTrue( numpy.array_equal(bs.samples.values, ss.samples.values), 'Samples read from binary file do not match' )
+            self.assertTrue( numpy.array_equal(bs.responses.values, ss.responses.values), 'Responses read from binary file do not match' )
+        del bs
+        os.remove('test_results.mss')
+
+    def testtextio(self):
+        ss = self.p.lhs(siz=25 )
+        ss.run( cpus=2, verbose=False )
+        ss.savetxt('test_results.txt')
+        lines = open('test_results.txt').readlines()
+        row = "%-8d" % ss.indices[0] + ''.join([" %16g" % v for v in ss.samples.values[0]]) + ''.join([" %16g" % v for v in ss.responses.values[0]]) + '\n'
+        self.assertEqual( lines[3], row, 'Row written by savetxt does not match expected format' )
+        rs = self.p.read_sampleset('test_results.txt')
+        self.assertTrue( numpy.array_equal(rs.indices, ss.indices), 'Indices read from text file do not match' )
+        self.assertTrue( numpy.allclose(rs.samples.values, ss.samples.values, rtol=1e-5), 'Samples read from text file do not match' )
+        self.assertTrue( numpy.allclose(rs.responses.values, ss.responses.values, rtol=1e-5), 'Responses read from text file do not match' )
+        os.remove('test_results.txt')
+
+    def testmemmap(self):
+        ss = self.p.lhs(siz=10 )
+        ss.run( cpus=2, verbose=False )
+        self.p.obsvalues = ss.responses.values[0]
+        rc = ss.recarray
+        sse = ss.calc_sse()
+        ss.memmap('test_results.mss')
+        self.assertEqual( ss.samples.filename, os.path.abspath('test_results.mss'), 'Samples are not memory-mapped' )
+        self.assertTrue( numpy.may_share_memory(ss.samples.recarray, ss.samples.values), 'Samples record array is not a view' )
+        self.assertTrue( numpy.may_share_memory(ss.recarray, ss.responses.values), 'Sampleset record array is not a view' )
+        self.assertTrue( numpy.array_equal(ss.recarray.tolist(), rc.tolist()), 'Record array of memory-mapped sampleset does not match' )
+        self.assertTrue( numpy.allclose(ss.calc_sse(), sse), 'Sum of squared errors of memory-mapped sampleset do not match' )
+        ss.recarray[ss.parnames[0]][0] = 0.
+        bs = self.p.load_sampleset('test_results.mss')
+        self.assertEqual( bs.samples.values[0,0], 0., 'Change to memory-mapped sampleset not written to file' )
+        del ss, bs
+        os.remove('test_results.mss')
+
+    def testcache(self):
+        self.p.enable_cache(maxsize=2)
+        self.p.parvalues = [0.5,0.1,0.5,0.1]
+        sims = self.p.forward()
+        self.assertEqual( self.p.forward(), sims, 'Cached simulated values do not match' )
+        self.assertEqual( (self.p.cache_hits,self.p.cache_misses), (1,1), 'Cache hits and misses incorrect' )
+        self.p.forward(pardict={'par1':0.6,'par2':0.1,'par3':0.5,'par4':0.1})
+        self.p.forward(pardict={'par1':0.7,'par2':0.1,'par3':0.5,'par4':0.1})
+        self.p.parvalues = [0.5,0.1,0.5,0.1]
+        self.p.forward()
+        self.assertEqual( (self.p.cache_hits,self.p.cache_misses), (1,4), 'Least recently used run not discarded from cache' )
+        # Cached runs do not create working directories
+        self.p.forward(workdir='cachedir')
+        self.p.workdir = None
+        self.assertFalse( os.path.isdir('cachedir'), 'Working directory created for cached run' )
+        self.p.enable_cache(filename='test_cache.pkl')
+        self.p.forward()
+        self.assertEqual( len(self.p.enable_cache(filename='test_cache.pkl')), 1, 'Cache not loaded from file' )
+        self.assertEqual( self.p.forward(), sims, 'Simulated values loaded from cache file do not match' )
+        self.assertEqual( self.p.cache_hits, 1, 'Cache loaded from file not used' )
+        # Cache file is kept when the model changes
+        self.p.model = self.p.model
+        self.assertTrue( len(self.p.cache) == 0 and os.path.isfile('test_cache.pkl'), 'Cache file removed after model change' )
+        self.p.disable_cache()
+        os.remove('test_cache.pkl')
+        # Parallel runs are cached and written to file by the parent process
+        self.p.enable_cache(filename='test_cache.pkl')
+        ss = self.p.lhs(siz=50, seed=1000)
+        ss.run(cpus=4, verbose=False)
+        out = ss.responses.values.copy()
+        self.assertFalse( numpy.any(numpy.isnan(out)), 'Parallel runs with cache file failed' )
+        self.assertEqual( len(self.p.cache), 50, 'Parallel runs not cached' )
+        self.assertEqual( len(self.p.enable_cache(filename='test_cache.pkl')), 50, 'Parallel runs not written to cache file' )
+        ss.run(cpus=4, verbose=False)
+        self.assertEqual( (self.p.cache_hits,self.p.cache_misses), (50,0), 'Cached parallel runs were rerun' )
+        self.assertTrue( numpy.array_equal(ss.responses.values, out), 'Cached parallel responses do not match' )
+        self.p.disable_cache()
+        self.assertEqual( glob.glob('test_cache.pkl.*'), [], 'Temporary cache files left behind' )
+        os.remove('test_cache.pkl')
+        # Incomplete run at end of cache file is discarded
+        c = self.p.enable_cache(filename='test_cache.pkl')
+        for v in [0.5,0.6,0.7]:
+            self.p.forward(pardict={'par1':v,'par2':0.1,'par3':0.5,'par4':0.1})
+        c.save()
+        for v in [0.8,0.9]:
+            self.p.forward(pardict={'par1':v,'par2':0.1,'par3':0.5,'par4':0.1})
+        data = open('test_cache.pkl','rb').read()
+        nruns = []
+        for i in range(len(data)):
+            open('test_cache.pkl','wb').write(data[:i])
+            nruns.append(len(self.p.enable_cache(filename='test_cache.pkl')))
+        self.assertTrue( nruns[-1] == 4 and nruns == sorted(nruns), 'Runs of truncated cache file not loaded' )
+        self.p.disable_cache()
+        os.remove('test_cache.pkl')
+
     def testcorrelation(self):
         samples = numpy.array([[  2.79514388e-01,   1.83572352e-01,   1.15954591e-01,   4.64518743e-02],
           [  7.03315739e-01,   7.84390758e-02,   3.01698515e-01,   1.88716879e-01],
@@ -155,16 +629,85 @@ class Tests(unittest.TestCase):
         sims = self.c.simvalues
         self.assertTrue( self.c.ssr < 1.e-10, 'Objective function value is ' + str(self.c.ssr) )
 
+    def testpest_template(self):
+        t = pest_io.template('exp_model.tpl')
+        self.assertTrue( t is pest_io.template('exp_model.tpl'), 'Template was not cached' )
+        self.assertEqual( t.expressions, ['a1','k1','a2','k2'], 'Template expressions are incorrect' )
+        self.assertEqual( t.render({'a1':1.5,'k1':2,'a2':1.e-7,'k2':0.25}), '1.5\n2\n1e-07\n0.25\n', 'Rendered template is incorrect' )
+        self.assertTrue( t.render({'a1':1.5,'k1':2,'a2':1.e-7}) is None, 'Parameter value of earlier render was used' )
+        f = open('pest_expr.tpl','w')
+        f.write('ptf #\n# a1*k1 #\n')
+        f.close()
+        te = pest_io.template('pest_expr.tpl')
+        self.assertEqual( te.render({'a1':1.5,'k1':2.}), '3.0\n', 'Rendered template expression is incorrect' )
+        self.assertTrue( te.render({'a1':1.5}) is None, 'Parameter value of earlier render was used in expression' )
+        os.remove('pest_expr.tpl')
+        fs = pest_io.tpl_write_batch([[1.,2.,3.,4.],[5.,6.,7.,8.]], 'exp_model.tpl', 'exp_model.%d.in', parnames=['a1','k1','a2','k2'])
+        self.assertEqual( open(fs[1]).read(), '5.0\n6.0\n7.0\n8.0\n', 'Template written in batch is incorrect' )
+        for f in fs: os.remove(f)
+
+    def testpest_instruction(self):
+        f = open('pest_instruction.out','w')
+        f.write('header line\n results at time 1.0\n   x =  1.5   y= 2.0D+01  z 3.25\n flux table\n node   value\n    1   1.0e-3\n    2   2.0e-3\n')
+        f.close()
+        f = open('pest_instruction.ins','w')
+        f.write('pif %\n%results at% l1 %x =% !x! %y=% !y! w w !z!\n%flux table%\nl2 [f1]9:14\nl1 (f2)7:9\n')
+        f.close()
+        ins = pest_io.instruction('pest_instruction.ins')
+        self.assertTrue( ins is pest_io.instruction('pest_instruction.ins'), 'Instruction file was not cached' )
+        self.assertEqual( ins.obsnames, ['x','y','z','f1','f2'], 'Instruction file observation names are incorrect' )
+        v = pest_io.ins_read('pest_instruction.ins', 'pest_instruction.out')
+        self.assertTrue( numpy.allclose(v, [1.5,20.,3.25,1.e-3,2.e-3]), 'Values read with instruction file are incorrect' )
+        v = pest_io.ins_read('pest_instruction.ins', 'pest_instruction.out', obsnames=['f2','x','q'])
+        self.assertTrue( numpy.allclose(v[:2], [2.e-3,1.5]) and numpy.isnan(v[2]), 'Values read in order of observation names are incorrect' )
+        # Lines starting with & continue the preceding instruction line
+        open('pest_instruction.out','w').write('a 1.0 b 2.0\n')
+        open('pest_instruction.ins','w').write('pif %\nl1 %a% !x!\n& %b% !y!\n')
+        v = pest_io.ins_read('pest_instruction.ins', 'pest_instruction.out')
+        self.assertTrue( numpy.allclose(v, [1.,2.]), 'Values read with continued instruction line are incorrect' )
+        os.remove('pest_instruction.ins')
+        os.remove('pest_instruction.out')
+
     def testjacobian(self):
         # Check condition number
         J = self.j.Jac()
         C = numpy.linalg.cond(J)
         self.assertTrue(numpy.abs(C - 225.684681059)<1.e-8, 'Condition number ('+str(C)+') of Jacobian is incorrect')
+        # Simulated values at current parameters are reused
+        self.j.forward()
+        self.assertTrue( numpy.array_equal(self.j.Jac(), J), 'Jacobian reusing current simulated values is incorrect' )
+        self.assertEqual( len(self.j.sampleset['_jac_'].indices), 3, 'Current simulated values were rerun' )
+        Jc = self.j.Jac(method='central')
+        self.assertEqual( len(self.j.sampleset['_jac_'].indices), 6, 'Incorrect number of central difference runs' )
+        self.assertTrue( numpy.allclose(Jc, J, rtol=1.e-4), 'Central difference Jacobian is incorrect' )
 
     def testcalibrate(self):
         self.j.obsvalues = [5.308,7.24,9.638,12.866,17.069,23.192,31.443,38.558,50.156,62.948,75.995,91.972]
-        self.j.calibrate()
+        res = self.j.calibrate()
         self.assertTrue( self.j.ssr < 2.587278, 'Final SSR of sine model is incorrect' + str(self.j.ssr) )
+        self.assertEqual( res.ssr, self.j.ssr, 'SSR of calibration result is incorrect' )
+        self.assertEqual( res.parvalues, self.j.parvalues, 'Parameter values of calibration result are incorrect' )
+        self.assertEqual( res.jacobian.shape, (12,3), 'Shape of Jacobian of calibration result is incorrect' )
+        self.assertEqual( res.covariance.shape, (3,3), 'Shape of covariance of calibration result is incorrect' )
+        self.assertEqual( min([h['ssr'] for h in res.history if h['accepted']]), res.ssr, 'Calibration history is incorrect' )
+        self.assertEqual( res.jac_runs, 6*res.njev, 'Number of model runs for Jacobians is incorrect' )
+        self.assertEqual( res.nruns, res.nfev+res.jac_runs, 'Total number of model runs is incorrect' )
+        self.assertTrue( res.times['total'] >= res.times['jacobian'] + res.times['upgrade'], 'Calibration times are incorrect' )
+        ssr = self.j.ssr
+        parvalues = self.j.parvalues
+        for nlambda in [2,3]:
+            self.j.parvalues = {'a0':0.7,'a1':10.,'a2':-0.4}
+            self.j.calibrate(nlambda=nlambda, cpus=2)
+            self.assertEqual( self.j.ssr, ssr, 'Final SSR using concurrent lambda search does not match serial lambda search' )
+            self.assertEqual( self.j.parvalues, parvalues, 'Final parameters using concurrent lambda search do not match serial lambda search' )
+        self.j.parvalues = {'a0':0.7,'a1':10.,'a2':-0.4}
+        self.j.calibrate(method='auto')
+        self.assertTrue( self.j.ssr < 2.587278, 'Final SSR of sine model using auto Jacobian method is incorrect' + str(self.j.ssr) )
+        self.j.parvalues = {'a0':0.7,'a1':10.,'a2':-0.4}
+        res = self.j.calibrate(broyden=3)
+        self.assertTrue( self.j.ssr < 2.587278, 'Final SSR of sine model using Broyden updates is incorrect' + str(self.j.ssr) )
+        self.assertTrue( res.nupdates > 0, 'Jacobian was not updated with Broyden corrections' )
+        self.assertEqual( res.jac_runs, 6*res.njev, 'Number of model runs for Jacobians is incorrect' )
         self.c.parvalues = {'amp':10.,'decay':0.1,'shift':0.,'omega':3.0}
         self.c.calibrate()
         self.assertTrue( self.c.ssr < 1.e-27, 'Final SSR of marquardt model is incorrect ' + str(self.c.ssr) )
@@ -249,13 +792,27 @@ def suite(case):
     suite = unittest.TestSuite()
     if case == 'base' or case == 'all':
         suite.addTest( Tests('testforward') )
+        suite.addTest( Tests('testcache') )
         suite.addTest( Tests('testsample') )
+        suite.addTest( Tests('testsample_expr') )
+        suite.addTest( Tests('testsample_corr') )
+        suite.addTest( Tests('testsample_maximin') )
+        suite.addTest( Tests('testsample_qmc') )
+        suite.addTest( Tests('testextend') )
         suite.addTest( Tests('testparstudy') )
         suite.addTest( Tests('testfullfact') )
         suite.addTest( Tests('testcalibrate_lmfit') )
         suite.addTest( Tests('testjacobian') )
+        suite.addTest( Tests('testpest_template') )
+        suite.addTest( Tests('testpest_instruction') )
+        suite.addTest( Tests('testvectorized') )
         suite.addTest( Tests('testcalibrate') )
         suite.addTest( Tests('testcorrelation') )
+        suite.addTest( Tests('testoutfile') )
+        suite.addTest( Tests('testresume') )
+        suite.addTest( Tests('testbinary') )
+        suite.addTest( Tests('testtextio') )
+        suite.addTest( Tests('testmemmap') )
         suite.addTest( Tests('testpickle_test') )
         suite.addTest( Tests('testmcmc') )
         suite.addTest( Tests('testemcee') )
@@ -263,6 +820,11 @@ def suite(case):
     if case == 'parallel' or case == 'all':
         suite.addTest( Tests('testparallel') )
         suite.addTest( Tests('testparallel_workdir') )
+        suite.addTest( Tests('testworkers') )
+        suite.addTest( Tests('testrun_async') )
+        suite.addTest( Tests('teststragglers') )
+        suite.addTest( Tests('testtimeout') )
+        suite.addTest( Tests('testtemplate_dir') )
     if case == 'mcmc':
         #suite.addTest( Tests('mcmc') )
         suite.addTest( Tests('testemcee2') )